@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 from argparse import ArgumentParser
+import chain_io as cio
 import correlated_likelihood as cl
 from gzip import GzipFile
 import numpy as np
@@ -24,12 +25,11 @@ def draw_logarithmic(min, max, size=1):
 if __name__ == '__main__':
     parser=ArgumentParser()
     
-    parser.add_argument('--input', metavar='FILE', required=True, help='input chain file')
+    parser.add_argument('--input', metavar='FILE', required=True, help='input chain (binary chain file, text chain file or prefix of either)')
     parser.add_argument('--prefix', metavar='FILE', default='chain', help='output file prefix')
     parser.add_argument('--rvs', metavar='FILE', default=[], action='append', help='radial velocity file')
 
-    parser.add_argument('--nwalkers', metavar='N', default=1000, type=int, help='number of ensemble walkers')
-    parser.add_argument('--npl', metavar='N', default=1, type=int, help='number of planets in chain')
+    parser.add_argument('--nwalkers', metavar='N', default=None, type=int, help='number of ensemble walkers (only for text chains without an accept file)')
     parser.add_argument('--ntemps', metavar='N', default=20, type=int, help='number of temperatures')
 
     args=parser.parse_args()
@@ -41,36 +41,42 @@ if __name__ == '__main__':
         ts.append(data[:,0])
         rvs.append(data[:,1])
 
+    reader = cio.ChainReader(args.input, nwalkers=args.nwalkers)
+    if reader.nobs != len(ts) or any(reader.nterms):
+        parser.error('the chain must have one observatory per --rvs file, and no additional noise terms')
+
     nobs = len(ts)
-    npl = args.npl
+    npl = reader.npl
     newnpl = npl + 1
+    nwalkers = reader.nwalkers
 
     pmin,pmax = cl.prior_bounds_from_data(newnpl, ts, rvs)
 
-    chain = pr.Parameters(arr=np.loadtxt(args.input)[-args.nwalkers:, 2:], npl=npl, nobs=nobs)
-    newchain = pr.Parameters(arr=np.zeros((args.nwalkers, chain.shape[1]+5)), npl=newnpl, nobs=nobs)
+    # The final ensemble at the lowest temperature
+    chain = reader.parameters(samples=-1, temps=0)
+    newchain = pr.Parameters(arr=np.zeros((nwalkers, chain.shape[1]+5)), npl=newnpl, nobs=nobs)
 
     newchain[:, :-5] = chain
     
     newks = newchain.K
-    newks[:, -1] = draw_logarithmic(pmin.K[0], pmax.K[0], size=args.nwalkers)
+    newks[:, -1] = draw_logarithmic(pmin.K[0], pmax.K[0], size=nwalkers)
     newchain.K = newks
 
     newes = newchain.e
-    newes[:,-1] = nr.uniform(low=0.0, high=1.0, size=args.nwalkers)
+    newes[:,-1] = nr.uniform(low=0.0, high=1.0, size=nwalkers)
     newchain.e = newes
 
     newchis = newchain.chi
-    newchis[:,-1] = nr.uniform(low=0.0, high=1.0, size=args.nwalkers)
+    newchis[:,-1] = nr.uniform(low=0.0, high=1.0, size=nwalkers)
     newchain.chi = newchis
 
     newomegas = newchain.omega
-    newomegas[:,-1] = nr.uniform(low=0.0, high=2.0*np.pi, size=args.nwalkers)
+    newomegas[:,-1] = nr.uniform(low=0.0, high=2.0*np.pi, size=nwalkers)
     newchain.omega = newomegas
 
     newns = newchain.n
     nmin = pmin.n[0]
-    for i in range(args.nwalkers):
+    for i in range(nwalkers):
         newns[i,-1] = draw_logarithmic(nmin, newns[i,-2])
     newchain.n = newns
 
@@ -81,13 +87,13 @@ if __name__ == '__main__':
 
     oldlogp = cl.LogPrior(oldpmin, oldpmax, npl, nobs)
 
-    for i in range(args.nwalkers):
+    for i in range(nwalkers):
         if oldlogp(chain[i,:]) == float('-inf'):
             print 'Found one'
 
-    logls=np.zeros(args.nwalkers)
-    logps=np.zeros(args.nwalkers)
-    for i in range(args.nwalkers):
+    logls=np.zeros(nwalkers)
+    logps=np.zeros(nwalkers)
+    for i in range(nwalkers):
         logls[i] = logl(newchain[i,:])
         logps[i] = logp(newchain[i,:])
 
@@ -0,0 +1,258 @@
+from emcee import autocorr
+from emcee.ptsampler import default_beta_ladder
+import numpy as np
+import numpy.random as nr
+
+class BlockedPTSampler(object):
+    """A parallel-tempered ensemble sampler that alternates
+    affine-invariant stretch moves in two blocks of parameters: the
+    observatory block (``V``, ``sigma0``, ``sigma``, ``tau`` and any
+    additional noise terms) and the planet block (``K``, ``n``,
+    ``chi``, ``e`` and ``omega``).
+
+    Each walker keeps the factorization of its noise covariance (see
+    :meth:`correlated_likelihood.LogLikelihood.factor`), which only
+    changes when an observatory-block move is accepted.  Planet-block
+    moves therefore cost one evaluation of the RV model and one solve
+    against the cached factorization, rather than a full
+    refactorization.  With the ``'dense'`` likelihood method the cache
+    holds an N by N Cholesky factor per walker and observatory.
+
+    The interface follows :class:`emcee.PTSampler`: :meth:`sample`
+    yields ``(p, lnprob, logl)`` after each iteration, and the
+    ``betas``, ``acceptance_fraction``, ``tswap_acceptance_fraction``,
+    ``chain`` and ``acor`` attributes have the same meaning.
+
+    Each evaluation names its walker by ``(temperature, index)``, so a
+    likelihood constructed with ``warm_start`` reuses the eccentric
+    anomalies of that walker's previous evaluation; walkers exchanged
+    in temperature swaps are evicted from its cache."""
+
+    def __init__(self, ntemps, nwalkers, dim, log_likelihood, log_prior, noise_mask, betas=None, a=2.0):
+        """Initialize the sampler.
+
+        :param ntemps: The number of temperatures.
+
+        :param nwalkers: The number of walkers at each temperature;
+          must be even.
+
+        :param dim: The number of parameters.
+
+        :param log_likelihood: A
+          :class:`correlated_likelihood.LogLikelihood`, which must not
+          be marginalizing.
+
+        :param log_prior: The log-prior, called on single parameter
+          vectors.
+
+        :param noise_mask: A boolean array selecting the parameters of
+          the observatory block (see
+          :attr:`parameters.Parameters.noise_mask`); the remaining
+          parameters form the planet block.
+
+        :param betas: The inverse temperatures; by default the ladder
+          of :class:`emcee.PTSampler`.
+
+        :param a: The scale of the stretch move."""
+
+        assert nwalkers % 2 == 0, 'must have an even number of walkers'
+
+        self.ntemps = ntemps
+        self.nwalkers = nwalkers
+        self.dim = dim
+        self.log_likelihood = log_likelihood
+        self.log_prior = log_prior
+        self.a = a
+
+        noise_mask = np.asarray(noise_mask, dtype=bool)
+        self.blocks = [np.nonzero(noise_mask)[0], np.nonzero(~noise_mask)[0]]
+        self.blocks = [b for b in self.blocks if b.shape[0] > 0]
+
+        if betas is None:
+            self.betas = default_beta_ladder(dim, ntemps=ntemps)
+        else:
+            self.betas = np.asarray(betas)
+
+        self.reset()
+
+    def reset(self):
+        """Clear the chain and the acceptance statistics."""
+
+        self.nprop = np.zeros((self.ntemps, self.nwalkers))
+        self.nprop_accepted = np.zeros((self.ntemps, self.nwalkers))
+        self.nswap = np.zeros(self.ntemps)
+        self.nswap_accepted = np.zeros(self.ntemps)
+
+        self._chain = None
+        self._lnprob = None
+        self._lnlikelihood = None
+
+    @property
+    def acceptance_fraction(self):
+        """The fraction of accepted proposals, over both blocks, for
+        each walker; shape ``(ntemps, nwalkers)``."""
+        return self.nprop_accepted/self.nprop
+
+    @property
+    def tswap_acceptance_fraction(self):
+        """The fraction of accepted temperature swaps at each
+        temperature."""
+        return self.nswap_accepted/self.nswap
+
+    @property
+    def chain(self):
+        return self._chain
+
+    @property
+    def lnprobability(self):
+        return self._lnprob
+
+    @property
+    def lnlikelihood(self):
+        return self._lnlikelihood
+
+    @property
+    def acor(self):
+        """The autocorrelation lengths of each parameter at each
+        temperature, shape ``(ntemps, dim)``."""
+        acors = np.zeros((self.ntemps, self.dim))
+        for i in range(self.ntemps):
+            acors[i,:] = autocorr.integrated_time(np.mean(self._chain[i,...], axis=0))
+        return acors
+
+    def sample(self, p0, iterations=1, thin=1):
+        """Advance the chains from ``p0``, of shape ``(ntemps,
+        nwalkers, dim)``, ``iterations`` steps as a generator, storing
+        every ``thin`` steps in :attr:`chain`.  Each iteration is a
+        stretch move in each block followed by a round of temperature
+        swaps.  Yields ``(p, lnprob, logl)`` after each iteration.
+
+        Unlike :meth:`emcee.PTSampler.sample`, there is no way to pass
+        in the initial posterior values, because the factorizations
+        must be computed for the initial points anyway."""
+
+        p = np.array(p0)
+        factors = np.empty((self.ntemps, self.nwalkers), dtype=object)
+        logps = np.zeros((self.ntemps, self.nwalkers))
+        logls = np.zeros((self.ntemps, self.nwalkers))
+
+        for k in range(self.ntemps):
+            for j in range(self.nwalkers):
+                logps[k,j], logls[k,j], factors[k,j] = self._evaluate(p[k,j,:], (k,j))
+
+        nsave = iterations // thin
+        if self._chain is None:
+            isave = 0
+            self._chain = np.zeros((self.ntemps, self.nwalkers, nsave, self.dim))
+            self._lnprob = np.zeros((self.ntemps, self.nwalkers, nsave))
+            self._lnlikelihood = np.zeros((self.ntemps, self.nwalkers, nsave))
+        else:
+            isave = self._chain.shape[2]
+            self._chain = np.concatenate((self._chain, np.zeros((self.ntemps, self.nwalkers, nsave, self.dim))), axis=2)
+            self._lnprob = np.concatenate((self._lnprob, np.zeros((self.ntemps, self.nwalkers, nsave))), axis=2)
+            self._lnlikelihood = np.concatenate((self._lnlikelihood, np.zeros((self.ntemps, self.nwalkers, nsave))), axis=2)
+
+        for i in range(iterations):
+            for iblock, block in enumerate(self.blocks):
+                refactor = (iblock == 0)
+                for half in [0, 1]:
+                    self._stretch(p, logps, logls, factors, block, half, refactor)
+
+            self._temperature_swaps(p, logps, logls, factors)
+
+            lnprob = logls*np.reshape(self.betas, (-1, 1)) + logps
+
+            if (i+1) % thin == 0 and isave < self._chain.shape[2]:
+                self._chain[:,:,isave,:] = p
+                self._lnprob[:,:,isave] = lnprob
+                self._lnlikelihood[:,:,isave] = logls
+                isave += 1
+
+            yield p, lnprob, logls
+
+    def _evaluate(self, q, walker):
+        # Returns (logp, logl, factors) for the point q, refactoring
+        # the noise covariance; the likelihood is not evaluated
+        # outside the prior.
+        lp = self.log_prior(q)
+        if lp == float('-inf'):
+            return lp, lp, None
+
+        factors = self.log_likelihood.factor(q)
+        return lp, self.log_likelihood.factored(q, factors, walker=walker), factors
+
+    def _stretch(self, p, logps, logls, factors, block, half, refactor):
+        # A stretch move of the walkers half::2 in the parameters
+        # block, using the complementary walkers.  If refactor, the
+        # proposals move the noise parameters, so each is factored
+        # afresh; otherwise the cached factorizations are reused.
+        nhalf = self.nwalkers // 2
+        iupdate = np.arange(half, self.nwalkers, 2)
+        isample = np.arange(1-half, self.nwalkers, 2)
+        ndim = block.shape[0]
+
+        for k in range(self.ntemps):
+            zs = ((self.a - 1.0)*nr.uniform(size=nhalf) + 1.0)**2/self.a
+            js = isample[nr.randint(nhalf, size=nhalf)]
+
+            for z, j, jc in zip(zs, iupdate, js):
+                q = p[k,j,:].copy()
+                q[block] = p[k,jc,block] + z*(p[k,j,block] - p[k,jc,block])
+
+                if refactor or factors[k,j] is None:
+                    lp, ll, fs = self._evaluate(q, (k,j))
+                else:
+                    lp = self.log_prior(q)
+                    if lp == float('-inf'):
+                        ll = lp
+                    else:
+                        ll = self.log_likelihood.factored(q, factors[k,j], walker=(k,j))
+                    fs = factors[k,j]
+
+                self.nprop[k,j] += 1
+
+                lnpdiff = (ndim - 1.0)*np.log(z) + self.betas[k]*(ll - logls[k,j]) + lp - logps[k,j]
+                if np.isnan(lnpdiff):
+                    continue
+
+                if np.log(nr.uniform()) < lnpdiff:
+                    p[k,j,:] = q
+                    logps[k,j] = lp
+                    logls[k,j] = ll
+                    factors[k,j] = fs
+                    self.nprop_accepted[k,j] += 1
+
+    def _temperature_swaps(self, p, logps, logls, factors):
+        # Swap walkers between adjacent temperatures, carrying their
+        # cached factorizations with them.  Their cached anomalies are
+        # evicted instead.
+        cache = self.log_likelihood.anomaly_cache
+
+        for i in range(self.ntemps - 1, 0, -1):
+            dbeta = self.betas[i-1] - self.betas[i]
+
+            iperm = nr.permutation(self.nwalkers)
+            i1perm = nr.permutation(self.nwalkers)
+
+            raccept = np.log(nr.uniform(size=self.nwalkers))
+            with np.errstate(invalid='ignore'):
+                paccept = dbeta*(logls[i, iperm] - logls[i-1, i1perm])
+
+            self.nswap[i] += self.nwalkers
+            self.nswap[i-1] += self.nwalkers
+
+            asel = paccept > raccept
+            nacc = np.sum(asel)
+
+            self.nswap_accepted[i] += nacc
+            self.nswap_accepted[i-1] += nacc
+
+            for arr in (p, logps, logls, factors):
+                temp = arr[i, iperm[asel], ...].copy()
+                arr[i, iperm[asel], ...] = arr[i-1, i1perm[asel], ...]
+                arr[i-1, i1perm[asel], ...] = temp
+
+            if cache is not None:
+                for j, j1 in zip(iperm[asel], i1perm[asel]):
+                    cache.evict((i, j))
+                    cache.evict((i-1, j1))
@@ -0,0 +1,585 @@
+#!/usr/bin/env python
+
+"""Binary, append-only storage for the chains of ``run.py``.
+
+A chain file holds every output step of a run, at all temperatures.
+It starts with the 8 bytes ``RVCHAIN1``, followed by the length of a
+JSON header as a little-endian 64-bit integer, and then the header
+itself, padded with spaces to a multiple of 16 bytes.  The header
+records ``nobs``, ``npl``, ``nterms``, ``ntemps``, ``nwalkers``,
+``ndim``, the inverse temperatures ``betas``, the parameter
+``columns``, the storage ``dtype`` and ``marginalize``, the
+``--marginalize`` mode of the run (``null`` if it sampled the full
+parameters).
+
+Fixed-size records follow the header, one per output step (see
+:func:`record_dtype`).  Each record holds the log-likelihood,
+log-prior and (full) parameters of every walker at every temperature,
+and the mean acceptance and temperature-swap fractions at each
+temperature.  Records are only ever appended, so the file can be read
+while a run is still writing it.  A reader counts only the complete
+records, and ignores any partial record at the end.
+
+The log-prior is the prior density over the natural parameters
+alone: the sampler's tempered posterior at inverse temperature
+``beta`` is ``logp + beta*logl``.
+
+:class:`ChainReader` gives the analysis scripts a common view of a
+chain, in this format or in the gzipped text files of ``run.py
+--chain-format text``: arrays of shape ``(nsamples, ntemps, nwalkers,
+...)``, memory-mapped from a binary file, together with the metadata
+of the run."""
+
+from argparse import ArgumentParser
+from gzip import GzipFile
+import json
+import numpy as np
+import os
+import parameters as pr
+import re
+import struct
+
+MAGIC = 'RVCHAIN1'
+
+def record_dtype(header):
+    """Returns the structured dtype of one record of a chain with the
+    given header, with fields ``logl`` and ``logp`` of shape
+    ``(ntemps, nwalkers)``, ``params`` of shape ``(ntemps, nwalkers,
+    ndim)``, and ``acceptance`` and ``tswap`` of shape
+    ``(ntemps,)``."""
+
+    dt = np.dtype(str(header['dtype']))
+    ntemps = header['ntemps']
+    nwalkers = header['nwalkers']
+
+    return np.dtype([('logl', dt, (ntemps, nwalkers)),
+                     ('logp', dt, (ntemps, nwalkers)),
+                     ('params', dt, (ntemps, nwalkers, header['ndim'])),
+                     ('acceptance', dt, (ntemps,)),
+                     ('tswap', dt, (ntemps,))])
+
+def read_header(filename):
+    """Returns ``(header, offset)``, the header dictionary of the
+    chain file ``filename`` and the offset of its first record."""
+
+    with open(filename, 'rb') as inp:
+        magic = inp.read(len(MAGIC))
+        if magic != MAGIC:
+            raise ValueError('%s is not a chain file'%filename)
+
+        nheader, = struct.unpack('<Q', inp.read(8))
+        header = json.loads(inp.read(nheader))
+
+    return header, len(MAGIC) + 8 + nheader
+
+def read_records(filename):
+    """Returns ``(header, records)``: the header of the chain file
+    ``filename``, and a read-only memory map of its complete records
+    (see :func:`record_dtype`)."""
+
+    header, offset = read_header(filename)
+    dt = record_dtype(header)
+
+    nrecords = (os.path.getsize(filename) - offset) // dt.itemsize
+    if nrecords == 0:
+        return header, np.zeros(0, dtype=dt)
+
+    return header, np.memmap(filename, dtype=dt, mode='r', offset=offset, shape=(nrecords,))
+
+class ChainWriter(object):
+    """Appends the output steps of a run to a chain file, keeping the
+    file open between steps.
+
+    Records are buffered, and written and flushed ``chunk`` at a
+    time, so readers see whole chunks."""
+
+    def __init__(self, filename, ntemps, nwalkers, nobs, npl, nterms=0, betas=None, dtype=np.float64, mode='w', chunk=1, marginalize=None):
+        """:param filename: The chain file.
+
+        :param ntemps: The number of temperatures.
+
+        :param nwalkers: The number of walkers at each temperature.
+
+        :param nobs: The number of observatories.
+
+        :param npl: The number of planets.
+
+        :param nterms: The number of additional noise terms (see
+          :class:`parameters.Parameters`).
+
+        :param betas: The inverse temperatures, recorded in the
+          header.
+
+        :param dtype: The storage type, ``float64`` or ``float32``.
+          Single precision halves the file size, but keeps only about
+          seven significant figures of the parameters and
+          log-likelihoods.
+
+        :param mode: ``'w'`` to start a new file, or ``'a'`` to
+          append to an existing one, which must have the same
+          parameter layout, shape, storage type and ``marginalize``;
+          a partial record left at its end (for example by a run that
+          was killed) is discarded.  If the file does not exist,
+          ``'a'`` starts a new one.
+
+        :param chunk: The number of records buffered between
+          writes.
+
+        :param marginalize: The ``--marginalize`` mode of the run,
+          recorded in the header, since such a run samples a different
+          prior (see :class:`correlated_likelihood.LogPrior`)."""
+
+        p = pr.Parameters(nobs=nobs, npl=npl, nterms=nterms)
+
+        header = {'nobs' : nobs,
+                  'npl' : npl,
+                  'nterms' : list(p.nterms),
+                  'ntemps' : ntemps,
+                  'nwalkers' : nwalkers,
+                  'ndim' : p.shape[-1],
+                  'betas' : [] if betas is None else [float(b) for b in betas],
+                  'columns' : ['logl', 'logp'] + p.header[1:].split(),
+                  'dtype' : np.dtype(dtype).newbyteorder('<').str,
+                  'marginalize' : marginalize}
+
+        if mode == 'a' and os.path.exists(filename):
+            old, offset = read_header(filename)
+            for key in ('nobs', 'npl', 'nterms', 'ntemps', 'nwalkers', 'ndim', 'dtype', 'marginalize'):
+                if old[key] != header[key]:
+                    raise ValueError('cannot append to %s: %s is %s, not %s'%(filename, key, old[key], header[key]))
+            header = old
+
+            self._dtype = record_dtype(header)
+            nrecords = (os.path.getsize(filename) - offset) // self._dtype.itemsize
+
+            self._file = open(filename, 'r+b')
+            self._file.seek(offset + nrecords*self._dtype.itemsize)
+            self._file.truncate()
+        elif mode in ('w', 'a'):
+            text = json.dumps(header)
+            text += ' '*(-(len(MAGIC) + 8 + len(text)) % 16)
+
+            self._dtype = record_dtype(header)
+            self._file = open(filename, 'wb')
+            self._file.write(MAGIC)
+            self._file.write(struct.pack('<Q', len(text)))
+            self._file.write(text)
+            self._file.flush()
+        else:
+            raise ValueError('mode must be \'w\' or \'a\'')
+
+        self._header = header
+        self._buffer = np.zeros(chunk, dtype=self._dtype)
+        self._nbuffered = 0
+
+    @property
+    def header(self):
+        return self._header
+
+    def append(self, logls, logps, pts, acceptance, tswap):
+        """Appends one output step.
+
+        :param logls: The log-likelihoods, shape ``(ntemps,
+          nwalkers)``.
+
+        :param logps: The log-priors, shape ``(ntemps, nwalkers)``.
+
+        :param pts: The full parameters, shape ``(ntemps, nwalkers,
+          ndim)``.
+
+        :param acceptance: The mean acceptance fraction at each
+          temperature.
+
+        :param tswap: The temperature-swap acceptance fraction at each
+          temperature."""
+
+        rec = self._buffer[self._nbuffered]
+        rec['logl'] = logls
+        rec['logp'] = logps
+        rec['params'] = pts
+        rec['acceptance'] = acceptance
+        rec['tswap'] = tswap
+        self._nbuffered += 1
+
+        if self._nbuffered == self._buffer.shape[0]:
+            self.flush()
+
+    def flush(self):
+        """Writes the buffered records, and flushes the file."""
+        if self._nbuffered > 0:
+            self._buffer[:self._nbuffered].tofile(self._file)
+            self._nbuffered = 0
+        self._file.flush()
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def is_chain_file(filename):
+    """Returns ``True`` if ``filename`` is a binary chain file."""
+
+    if not os.path.isfile(filename):
+        return False
+
+    with open(filename, 'rb') as inp:
+        return inp.read(len(MAGIC)) == MAGIC
+
+def text_metadata(columns):
+    """Returns ``(nobs, npl, nterms)`` from the column names of a text
+    chain (see :attr:`parameters.Parameters.header`)."""
+
+    nobs = len([c for c in columns if re.match(r'V\d*$', c)])
+    npl = len([c for c in columns if re.match(r'K\d*$', c)])
+
+    nterms = [0]*nobs
+    for c in columns:
+        m = re.match(r'sigma(\d*)_\d+$', c)
+        if m is not None:
+            nterms[int(m.group(1) or 0)] += 1
+
+    return nobs, npl, nterms
+
+def read_text_header(filename):
+    """Returns the column names from the header line of the text
+    chain ``filename``; raises ``ValueError`` if it has none."""
+
+    with (GzipFile(filename, 'r') if filename.endswith('.gz') else open(filename, 'r')) as inp:
+        line = inp.readline()
+
+    if not line.startswith('#'):
+        raise ValueError('%s has no header of column names'%filename)
+
+    return line[1:].split()
+
+def read_text_marginalize(prefix):
+    """Returns the ``--marginalize`` mode recorded in
+    ``<prefix>.marginalize.txt`` for the text chain of ``prefix``, or
+    ``None`` if it sampled the full parameters."""
+
+    if prefix is not None and os.path.isfile(prefix + '.marginalize.txt'):
+        with open(prefix + '.marginalize.txt', 'r') as inp:
+            return inp.read().strip()
+    return None
+
+def _load_text(filename, ncols):
+    # The rows of a text chain; much faster than np.loadtxt.
+    with (GzipFile(filename, 'r') if filename.endswith('.gz') else open(filename, 'r')) as inp:
+        text = inp.read()
+
+    if '#' in text:
+        text = '\n'.join(l for l in text.split('\n') if not l.startswith('#'))
+
+    data = np.fromstring(text, sep=' ')
+    return np.reshape(data[:data.shape[0] - data.shape[0] % ncols], (-1, ncols))
+
+class _TextField(object):
+    # One field of a text chain, indexed like the corresponding array
+    # of a binary chain; only the temperatures selected are loaded.
+
+    def __init__(self, reader, columns, shape):
+        self._reader = reader
+        self._columns = columns
+        self.shape = shape
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        return np.asarray(self[:], dtype=dtype)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),)*(3 - len(key))
+
+        itemps = np.arange(self.shape[1])[key[1]]
+        if np.size(itemps) == 0:
+            data = np.zeros((self.shape[0], 0) + self.shape[2:])
+        else:
+            data = np.stack([self._reader._temperature(i)[..., self._columns] for i in np.atleast_1d(itemps)], axis=1)
+
+        if np.ndim(itemps) == 0:
+            return data[(key[0], 0) + key[2:]]
+        else:
+            return data[(key[0], slice(None)) + key[2:]]
+
+class ChainReader(object):
+    """Read-only access to the chain of a run, as arrays of shape
+    ``(nsamples, ntemps, nwalkers, ...)`` that are sliced by sample,
+    temperature and walker, like ``reader.params[100:, 0, :]``.
+
+    A binary chain file is memory-mapped, so only the slices used are
+    read.  Text chains cannot be mapped; each temperature's file is
+    parsed the first time it is used, and kept.  The metadata come from
+    the file: the binary header, or for text the column names, the
+    number of rows of ``<prefix>.accept.txt.gz`` (one per sample),
+    ``<prefix>.betas.txt`` and ``<prefix>.marginalize.txt``.  Samples still being written by a run are
+    ignored."""
+
+    def __init__(self, path, nwalkers=None, format=None):
+        """:param path: A binary chain file, a text chain file for a
+          single temperature, or the prefix of either (``<prefix>.chain``
+          or ``<prefix>.NN.txt.gz``).
+
+        :param nwalkers: The number of walkers, only used for a text
+          chain without an accept file.
+
+        :param format: ``'binary'`` or ``'text'`` to choose between the
+          two chains of a prefix; by default the binary chain, if it
+          exists."""
+
+        if format != 'text' and is_chain_file(path):
+            filename = path
+        elif format != 'text' and is_chain_file(path + '.chain'):
+            filename = path + '.chain'
+        else:
+            filename = None
+
+        if filename is not None:
+            self._init_binary(filename)
+        elif format == 'binary':
+            raise IOError('no binary chain at %s'%path)
+        else:
+            self._init_text(path, nwalkers)
+
+    def _init_binary(self, filename):
+        self._format = 'binary'
+        self._header, records = read_records(filename)
+
+        self._logl = records['logl']
+        self._logp = records['logp']
+        self._params = records['params']
+        self._acceptance = records['acceptance']
+        self._tswap = records['tswap']
+
+    def _init_text(self, path, nwalkers):
+        m = re.match(r'(.*)\.(\d\d)\.txt(\.gz)?$', path)
+        if os.path.isfile(path):
+            # A single temperature; its betas and acceptance are
+            # picked out of the files of the whole run.
+            files = [path]
+            prefix = None if m is None else m.group(1)
+            itemps = None if m is None else slice(int(m.group(2)), int(m.group(2))+1)
+        else:
+            itemps = slice(None)
+            files = []
+            while os.path.isfile('%s.%02d.txt.gz'%(path, len(files))):
+                files.append('%s.%02d.txt.gz'%(path, len(files)))
+            prefix = path
+
+        if len(files) == 0:
+            raise IOError('no chain at %s'%path)
+
+        columns = read_text_header(files[0])
+        nobs, npl, nterms = text_metadata(columns)
+
+        def companion(suffix):
+            if prefix is not None and os.path.isfile(prefix + suffix):
+                return np.loadtxt(prefix + suffix, ndmin=2)[:, itemps]
+            return None
+
+        self._files = files
+        self._cache = {}
+
+        rows = self._load(0, len(columns))
+        accept = companion('.accept.txt.gz')
+        if accept is not None and accept.shape[0] > 0:
+            if rows.shape[0] % accept.shape[0] != 0:
+                raise ValueError('%s does not hold whole samples of %d rows each'%(files[0], accept.shape[0]))
+            nwalkers = rows.shape[0] // accept.shape[0]
+        elif nwalkers is None:
+            raise ValueError('the number of walkers in %s is unknown; pass nwalkers'%files[0])
+
+        nsamples = rows.shape[0] // nwalkers
+        p = pr.Parameters(nobs=nobs, npl=npl, nterms=nterms)
+
+        betas = companion('.betas.txt')
+
+        marginalize = read_text_marginalize(prefix)
+
+        self._format = 'text'
+        self._header = {'nobs' : nobs,
+                        'npl' : npl,
+                        'nterms' : list(p.nterms),
+                        'ntemps' : len(files),
+                        'nwalkers' : nwalkers,
+                        'ndim' : p.shape[-1],
+                        'betas' : [] if betas is None else list(betas.flatten()),
+                        'columns' : columns,
+                        'dtype' : '<f8',
+                        'marginalize' : marginalize}
+
+        self._nsamples = nsamples
+
+        shape = (nsamples, len(files), nwalkers)
+        self._logl = _TextField(self, 0, shape)
+        self._logp = _TextField(self, 1, shape)
+        self._params = _TextField(self, slice(2, None), shape + (p.shape[-1],))
+
+        self._acceptance = companion('.accept.txt.gz')
+        self._tswap = companion('.aswaps.txt.gz')
+        if self._acceptance is not None:
+            self._acceptance = self._acceptance[:nsamples]
+        if self._tswap is not None:
+            self._tswap = self._tswap[:nsamples]
+
+    def _load(self, i, ncols):
+        if i not in self._cache:
+            self._cache[i] = _load_text(self._files[i], ncols)
+        return self._cache[i]
+
+    def _temperature(self, i):
+        # The rows of temperature i of a text chain, shape (nsamples,
+        # nwalkers, ncolumns).
+        rows = self._load(i, len(self._header['columns']))
+        nrows = self._nsamples*self.nwalkers
+        if rows.shape[0] < nrows:
+            raise ValueError('%s is shorter than %s'%(self._files[i], self._files[0]))
+        return np.reshape(rows[:nrows], (self._nsamples, self.nwalkers, -1))
+
+    @property
+    def format(self):
+        """``'binary'`` or ``'text'``."""
+        return self._format
+
+    @property
+    def header(self):
+        """The metadata of the chain, as in the header of a binary
+        chain file."""
+        return self._header
+
+    @property
+    def nobs(self):
+        return self._header['nobs']
+
+    @property
+    def npl(self):
+        return self._header['npl']
+
+    @property
+    def nterms(self):
+        return self._header['nterms']
+
+    @property
+    def ntemps(self):
+        return self._header['ntemps']
+
+    @property
+    def nwalkers(self):
+        return self._header['nwalkers']
+
+    @property
+    def ndim(self):
+        return self._header['ndim']
+
+    @property
+    def nsamples(self):
+        return self._logl.shape[0]
+
+    @property
+    def betas(self):
+        """The inverse temperatures, or ``None`` if they were not
+        recorded."""
+        if len(self._header['betas']) == 0:
+            return None
+        return np.array(self._header['betas'])
+
+    @property
+    def marginalize(self):
+        """The ``--marginalize`` mode of the run, or ``None`` if it
+        sampled the full parameters."""
+        return self._header.get('marginalize')
+
+    @property
+    def logl(self):
+        """The log-likelihoods, shape ``(nsamples, ntemps,
+        nwalkers)``."""
+        return self._logl
+
+    @property
+    def logp(self):
+        """The log-priors, shape ``(nsamples, ntemps, nwalkers)``."""
+        return self._logp
+
+    @property
+    def params(self):
+        """The full parameters, shape ``(nsamples, ntemps, nwalkers,
+        ndim)``."""
+        return self._params
+
+    @property
+    def acceptance(self):
+        """The mean acceptance fraction at each temperature, shape
+        ``(nsamples, ntemps)``, or ``None`` if not recorded."""
+        return self._acceptance
+
+    @property
+    def tswap(self):
+        """The temperature-swap acceptance fraction at each
+        temperature, shape ``(nsamples, ntemps)``, or ``None`` if not
+        recorded."""
+        return self._tswap
+
+    def parameters(self, samples=slice(None), temps=slice(None), walkers=slice(None)):
+        """Returns the selected parameters as
+        :class:`parameters.Parameters` in double precision.
+
+        :param samples: An index or slice of the samples.
+
+        :param temps: An index or slice of the temperatures.
+
+        :param walkers: An index or slice of the walkers."""
+
+        return pr.Parameters(np.array(self._params[samples, temps, walkers], dtype=np.float64),
+                             nobs=self.nobs, npl=self.npl, nterms=self.nterms)
+
+def export_text(filename, prefix):
+    """Writes the chain file ``filename`` in the text format of
+    ``run.py --chain-format text``: ``<prefix>.NN.txt.gz`` for each
+    temperature, ``<prefix>.accept.txt.gz``,
+    ``<prefix>.aswaps.txt.gz`` and, if the file records them, the
+    inverse temperatures in ``<prefix>.betas.txt``.  Each file is
+    written in a single pass."""
+
+    header, records = read_records(filename)
+
+    text_header = str('# ' + ' '.join(header['columns']) + '\n')
+
+    for i in range(header['ntemps']):
+        with GzipFile('%s.%02d.txt.gz'%(prefix, i), 'w') as out:
+            out.write(text_header)
+            rows = np.concatenate((records['logl'][:,i,:,np.newaxis], records['logp'][:,i,:,np.newaxis], records['params'][:,i,:,:]), axis=-1)
+            np.savetxt(out, np.reshape(rows, (-1, rows.shape[-1])))
+
+    with GzipFile('%s.accept.txt.gz'%prefix, 'w') as out:
+        np.savetxt(out, records['acceptance'])
+
+    with GzipFile('%s.aswaps.txt.gz'%prefix, 'w') as out:
+        np.savetxt(out, records['tswap'])
+
+    if len(header['betas']) > 0:
+        np.savetxt('%s.betas.txt'%prefix, np.reshape(header['betas'], (1, -1)))
+
+    if header.get('marginalize') is not None:
+        with open('%s.marginalize.txt'%prefix, 'w') as out:
+            out.write(header['marginalize'] + '\n')
+
+if __name__ == '__main__':
+    parser=ArgumentParser(description='export a binary chain file to text')
+
+    parser.add_argument('--input', metavar='FILE', required=True, help='binary chain file')
+    parser.add_argument('--prefix', metavar='PRE', required=True, help='prefix of the text files (<prefix>.NN.txt.gz)')
+
+    args=parser.parse_args()
+
+    export_text(args.input, args.prefix)
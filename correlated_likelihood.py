@@ -1,38 +1,129 @@
 import numpy as np
 import numpy.linalg as nl
 import numpy.random as nr
+from multiprocessing.pool import ThreadPool
 import parameters as params
 import rv_model as rv
 import scipy.linalg as sl
 import scipy.stats as ss
+import threading
+
+# The compiled kernels; without them the likelihood falls back to the
+# 'dense' method and the RV models of rv_model.
+try:
+    import kepler as kp
+except ImportError:
+    kp = None
+
+try:
+    import noise
+except ImportError:
+    noise = None
 
 def correlated_gaussian_loglikelihood(xs, means, cov):
     """Returns the likelihood for data xs, assumed to be multivariate
-    Gaussian with the given means and covariance."""
-    lu,piv=sl.lu_factor(cov)
+    Gaussian with the given means and covariance.  
 
-    lambdas=np.diag(lu)
+    Both the log-determinant and the quadratic form come from a single
+    Cholesky factorization of cov.  If cov is not positive-definite,
+    returns ``-inf``."""
+    try:
+        L=sl.cholesky(cov, lower=True)
+    except (sl.LinAlgError, ValueError):
+        # ValueError: cov has NaN or infinite entries
+        return float('-inf')
 
     ndim=xs.shape[0]
-    
-    ds=(xs-means)*sl.lu_solve((lu,piv), xs-means)/2.0
 
-    return -np.log(2.0*np.pi)*(ndim/2.0)-0.5*np.sum(np.log(lambdas))-np.sum(ds)
+    ys=sl.solve_triangular(L, xs-means, lower=True)
+
+    return -np.log(2.0*np.pi)*(ndim/2.0)-np.sum(np.log(np.diag(L)))-0.5*np.dot(ys,ys)
+
+def exponential_gaussian_loglikelihood(ts, xs, means, sigma0, sigma, tau):
+    """Returns the likelihood for data xs observed at times ts,
+    assumed to be multivariate Gaussian with the given means and the
+    covariance of :func:`generate_covariance`.  
+
+    Uses the Markov property of the exponential kernel to compute the
+    same value as ``correlated_gaussian_loglikelihood(xs, means,
+    generate_covariance(ts, sigma0, sigma, tau))`` in O(N) time and
+    memory.  The times ts must be sorted.  Without the compiled
+    :mod:`noise` module, the dense computation is used."""
+
+    if noise is None:
+        return correlated_gaussian_loglikelihood(xs, means, generate_covariance(ts, sigma0, sigma, tau))
+
+    return noise.ou_loglikelihood(ts, xs-means, sigma0, sigma, tau)
+
+def multiterm_gaussian_loglikelihood(ts, xs, means, sigma0, sigma, tau, terms):
+    """Returns the likelihood for data xs observed at times ts,
+    assumed to be multivariate Gaussian with the given means and the
+    covariance of :func:`generate_covariance` with additional noise
+    ``terms``.
+
+    The covariance is semiseparable, so the likelihood is computed in
+    O(N J^2) time for J terms.  The times ts must be sorted.  Without
+    the compiled :mod:`noise` module, the dense computation is used."""
+
+    if noise is None:
+        return correlated_gaussian_loglikelihood(xs, means, generate_covariance(ts, sigma0, sigma, tau, terms))
+
+    a,c,d = noise_coefficients(sigma, tau, terms)
+
+    return noise.celerite_loglikelihood(ts, xs-means, sigma0, a, c, d)
 
-def generate_covariance(ts, sigma0, sigma, tau):
+def noise_coefficients(sigma, tau, terms):
+    r"""Returns ``(a, c, d)``, the coefficients of the correlated noise
+    terms
+
+    .. math::
+
+      a_k \exp\left[ -c_k \left| t_i - t_j \right| \right] \cos\left( d_k \left| t_i - t_j \right| \right)
+
+    for the exponential term with amplitude ``sigma`` and timescale
+    ``tau`` followed by the additional ``terms``, of shape ``(...,
+    nterms, 3)``.  Each coefficient array has shape ``(...,
+    nterms+1)``."""
+
+    sigma = np.asarray(sigma)
+    tau = np.asarray(tau)
+    terms = np.asarray(terms)
+
+    sigmas = np.concatenate((sigma[...,np.newaxis], terms[...,0]), axis=-1)
+    taus = np.concatenate((tau[...,np.newaxis], terms[...,1]), axis=-1)
+    nus = np.concatenate((np.zeros_like(sigma)[...,np.newaxis], terms[...,2]), axis=-1)
+
+    return (np.ascontiguousarray(sigmas*sigmas/(2.0*taus)),
+            np.ascontiguousarray(1.0/taus),
+            np.ascontiguousarray(nus))
+
+def generate_covariance(ts, sigma0, sigma, tau, terms=None):
     r"""Generates a covariance matrix according to an exponential
     autocovariance, with a white noise component:
 
     .. math::
       
-      \left\langle x_i x_j \right\rangle = \sigma_0^2 \delta_{ij} + \frac{\sigma^2}{2\tau} \exp\left[ \frac{\left| t_i - t_j\right|}{\tau} \right]"""
+      \left\langle x_i x_j \right\rangle = \sigma_0^2 \delta_{ij} + \frac{\sigma^2}{2\tau} \exp\left[ \frac{\left| t_i - t_j\right|}{\tau} \right]
+
+    If given, ``terms`` is an array of shape ``(nterms, 3)`` giving
+    ``(sigma, tau, nu)`` for additional terms
+
+    .. math::
+
+      \frac{\sigma^2}{2\tau} \exp\left[ \frac{\left| t_i - t_j\right|}{\tau} \right] \cos\left( \nu \left| t_i - t_j \right| \right)"""
 
     ndim = ts.shape[0]
 
     tis = np.tile(np.reshape(ts, (-1, 1)), (1, ndim))
     tjs = np.tile(ts, (ndim, 1))
 
-    return sigma0*sigma0*np.eye(ndim) + sigma*sigma/(2.0*tau)*np.exp(-np.abs(tis-tjs)/tau)
+    cov = sigma0*sigma0*np.eye(ndim) + sigma*sigma/(2.0*tau)*np.exp(-np.abs(tis-tjs)/tau)
+
+    if terms is not None:
+        for s, t, nu in terms:
+            cov += s*s/(2.0*t)*np.exp(-np.abs(tis-tjs)/t)*np.cos(nu*np.abs(tis-tjs))
+
+    return cov
 
 def correlated_gaussian_quantiles(xs, means, cov):
     """Returns an array of quantiles for each of the xs in the
@@ -45,21 +136,396 @@ def correlated_gaussian_quantiles(xs, means, cov):
 
     return ss.norm.cdf(ys)
 
+class CovarianceWorkspace(object):
+    """Preallocated buffers for evaluating the correlated noise
+    likelihood of the data from one observatory.
+
+    The observation times never change during a run, so the matrix of
+    lags :math:`\\left| t_i - t_j \\right|` is computed once, and the
+    covariance matrix, its factorization and the solution vector are
+    all assembled in place in buffers that are reused from call to
+    call."""
+
+    def __init__(self, ts, dense=True, nterms=0, counts=None, nthreads=1):
+        """Initialize the workspace for observations at times ``ts``.
+
+        :param ts: The observation times.
+
+        :param dense: If ``True``, also allocate the N by N lag and
+          covariance buffers needed by :meth:`loglikelihood`.
+          Otherwise, only the length-N buffers are allocated.
+
+        :param nterms: The number of additional noise terms.
+
+        :param counts: The number of observations averaged into each
+          data point (see :func:`compress_observations`); the white
+          noise variance of each point is divided by its count.  By
+          default, one for each point.
+
+        :param nthreads: The number of threads with which
+          :meth:`season_loglikelihood` factors independent blocks of
+          the covariance."""
+
+        self._ts = ts
+        self._dense = dense
+        self._nterms = nterms
+        self._nthreads = nthreads
+        self._pool = None
+
+        nts = ts.shape[0]
+
+        if counts is None:
+            self._counts = np.ones(nts)
+        else:
+            self._counts = np.ascontiguousarray(counts, dtype=np.float64)
+
+        # The white noise variance of each point is sigma0^2/count.
+        self._invcounts = 1.0/self._counts
+
+        if dense:
+            self._lags = np.abs(np.reshape(ts, (-1, 1)) - np.reshape(ts, (1, -1)))
+            self._gaps = np.diff(ts)
+
+            # Fortran order, so LAPACK can factor the buffer in place.
+            self._cov = np.zeros((nts, nts), order='F')
+            self._diagonal = np.reshape(self._cov, -1, order='F')[::nts+1]
+
+            self._solution = np.zeros(nts)
+            self._scratch = np.zeros(nts)
+
+            if nterms > 0:
+                self._term = np.zeros((nts, nts), order='F')
+                self._oscillation = np.zeros((nts, nts), order='F')
+
+    def __getstate__(self):
+        # Do not ship the N by N buffers to worker processes; they are
+        # rebuilt on arrival.
+        return {'ts' : self._ts, 'dense' : self._dense, 'nterms' : self._nterms, 'counts' : self._counts, 'nthreads' : self._nthreads}
+
+    def __setstate__(self, state):
+        self.__init__(state['ts'], dense=state['dense'], nterms=state['nterms'], counts=state['counts'], nthreads=state['nthreads'])
+
+    @property
+    def ts(self):
+        return self._ts
+
+    @property
+    def counts(self):
+        return self._counts
+
+    def covariance(self, sigma0, sigma, tau, terms=None):
+        """Assembles the covariance of :func:`generate_covariance` in
+        place, and returns the (reused) buffer that holds it."""
+
+        cov = self._cov
+
+        np.multiply(self._lags, -1.0/tau, out=cov)
+        np.exp(cov, out=cov)
+        cov *= sigma*sigma/(2.0*tau)
+        np.multiply(self._invcounts, sigma0*sigma0, out=self._scratch)
+        self._diagonal += self._scratch
+
+        if terms is not None and len(terms) > 0:
+            term, oscillation = self._term, self._oscillation
+            for s, t, nu in terms:
+                np.multiply(self._lags, -1.0/t, out=term)
+                np.exp(term, out=term)
+                term *= s*s/(2.0*t)
+
+                np.multiply(self._lags, nu, out=oscillation)
+                np.cos(oscillation, out=oscillation)
+                term *= oscillation
+
+                cov += term
+
+        return cov
+
+    def loglikelihood(self, residual, sigma0, sigma, tau, terms=None):
+        """Returns the log-likelihood of the (zero-mean) residuals
+        under the covariance of :func:`generate_covariance`, taking the
+        Cholesky factor of the covariance in place.  Returns ``-inf``
+        if the covariance is not positive-definite."""
+
+        ndim = residual.shape[0]
+
+        try:
+            L,lower = sl.cho_factor(self.covariance(sigma0, sigma, tau, terms), lower=True, overwrite_a=True, check_finite=False)
+        except sl.LinAlgError:
+            return float('-inf')
+
+        y = self._solution
+        y[:] = residual
+        y = sl.solve_triangular(L, y, lower=True, overwrite_b=True, check_finite=False)
+
+        # The diagonal view now holds the diagonal of the Cholesky
+        # factor.
+        halflogdet = np.sum(np.log(self._diagonal, out=self._scratch))
+
+        ll = -np.log(2.0*np.pi)*(ndim/2.0) - halflogdet - 0.5*np.dot(y, y)
+
+        if np.isnan(ll):
+            return float('-inf')
+        else:
+            return ll
+
+    def whiten(self, ys, sigma0, sigma, tau, terms=None):
+        """Returns ``(zs, halflogdet)``, where ``zs`` is :math:`L^{-1}
+        y` for the columns of ``ys`` and the Cholesky factor :math:`L`
+        of the covariance, and ``halflogdet`` is the half
+        log-determinant of the covariance (``inf`` if it is not
+        positive-definite)."""
+
+        try:
+            L,lower = sl.cho_factor(self.covariance(sigma0, sigma, tau, terms), lower=True, overwrite_a=True, check_finite=False)
+        except sl.LinAlgError:
+            return ys, float('inf')
+
+        zs = sl.solve_triangular(L, ys, lower=True, check_finite=False)
+
+        return zs, np.sum(np.log(self._diagonal, out=self._scratch))
+
+    def loglikelihood_gradient(self, residual, sigma0, sigma, tau, terms=None):
+        """Returns ``(ll, dres, dnoise, dterms)``: the log-likelihood of
+        :meth:`loglikelihood`, and its gradient with respect to the
+        residuals, to ``(sigma0, sigma, tau)``, and to the ``(sigma,
+        tau, nu)`` of each additional term (shape ``(nterms, 3)``).
+
+        Uses :math:`\\partial \\log L/\\partial \\theta = \\frac{1}{2}
+        \\mathrm{tr}\\left[ \\left(\\alpha \\alpha^T - C^{-1}\\right)
+        \\partial C/\\partial \\theta \\right]` with :math:`\\alpha =
+        C^{-1} r`, which costs O(N^3).  If the covariance is not
+        positive-definite, ``ll`` is ``-inf`` and the gradients are
+        zero."""
+
+        nts = residual.shape[0]
+        nterms = 0 if terms is None else len(terms)
+
+        dres = np.zeros(nts)
+        dnoise = np.zeros(3)
+        dterms = np.zeros((nterms, 3))
+
+        cov = np.array(self.covariance(sigma0, sigma, tau, terms))
+        try:
+            cho = sl.cho_factor(cov, lower=True, check_finite=False)
+        except sl.LinAlgError:
+            return float('-inf'), dres, dnoise, dterms
+
+        alpha = sl.cho_solve(cho, residual, check_finite=False)
+        ll = -np.log(2.0*np.pi)*(nts/2.0) - np.sum(np.log(np.diag(cho[0]))) - 0.5*np.dot(residual, alpha)
+
+        if np.isnan(ll):
+            return float('-inf'), dres, dnoise, dterms
+
+        W = 0.5*(np.outer(alpha, alpha) - sl.cho_solve(cho, np.eye(nts), check_finite=False))
+
+        dres[:] = -alpha
+
+        expterm = np.exp(-self._lags/tau)
+        dnoise[0] = np.sum(np.diag(W)*2.0*sigma0/self._counts)
+        dnoise[1] = np.sum(W*expterm)*sigma/tau
+        dnoise[2] = np.sum(W*expterm*(self._lags/tau - 1.0))*sigma*sigma/(2.0*tau*tau)
+
+        for k in range(nterms):
+            s, t, nu = terms[k]
+            expterm = np.exp(-self._lags/t)
+            costerm = np.cos(nu*self._lags)
+            dterms[k,0] = np.sum(W*expterm*costerm)*s/t
+            dterms[k,1] = np.sum(W*expterm*costerm*(self._lags/t - 1.0))*s*s/(2.0*t*t)
+            dterms[k,2] = -np.sum(W*expterm*np.sin(nu*self._lags)*self._lags)*s*s/(2.0*t)
+
+        return ll, dres, dnoise, dterms
+
+    def seasons(self, tau, tol):
+        """Returns a list of ``(istart, istop)`` giving the blocks
+        (seasons) of observations separated by gaps across which the
+        correlation :math:`\exp(-\mathrm{gap}/\tau)` is below
+        ``tol``."""
+
+        ibreaks = np.nonzero(self._gaps > -tau*np.log(tol))[0] + 1
+        bounds = np.concatenate(([0], ibreaks, [self._ts.shape[0]]))
+
+        return zip(bounds[:-1], bounds[1:])
+
+    def season_whiten(self, ys, sigma0, sigma, tau, terms=None, tol=1e-10):
+        """Like :meth:`whiten`, but treats the covariance as block
+        diagonal, with one block per season (see :meth:`seasons`,
+        applied to the longest correlation time of any noise term).
+        The blocks are factored independently, in parallel if the
+        workspace has more than one thread.  If the correlation across
+        every gap exceeds ``tol``, falls back to :meth:`whiten`.
+
+        The neglected elements of the covariance are smaller than
+        ``tol`` times the variance of the correlated noise."""
+
+        taumax = tau
+        if terms is not None and len(terms) > 0:
+            taumax = max(tau, np.max(terms[:,1]))
+
+        blocks = self.seasons(taumax, tol)
+
+        if len(blocks) == 1:
+            return self.whiten(ys, sigma0, sigma, tau, terms)
+
+        def whiten_block(block):
+            istart, istop = block
+            lags = self._lags[istart:istop, istart:istop]
+
+            cov = sigma*sigma/(2.0*tau)*np.exp(-lags/tau)
+            if terms is not None:
+                for s, t, nu in terms:
+                    cov += s*s/(2.0*t)*np.exp(-lags/t)*np.cos(nu*lags)
+            cov[np.diag_indices_from(cov)] += sigma0*sigma0/self._counts[istart:istop]
+
+            try:
+                L = sl.cholesky(cov, lower=True, overwrite_a=True, check_finite=False)
+            except sl.LinAlgError:
+                return None, float('inf')
+
+            return sl.solve_triangular(L, ys[istart:istop,...], lower=True, check_finite=False), np.sum(np.log(np.diag(L)))
+
+        if self._nthreads > 1:
+            if self._pool is None:
+                self._pool = ThreadPool(self._nthreads)
+            results = self._pool.map(whiten_block, blocks)
+        else:
+            results = map(whiten_block, blocks)
+
+        halflogdet = sum(hld for zs, hld in results)
+        if halflogdet == float('inf'):
+            return ys, halflogdet
+
+        return np.concatenate([zs for zs, hld in results], axis=0), halflogdet
+
+    def season_loglikelihood(self, residual, sigma0, sigma, tau, terms=None, tol=1e-10):
+        """Returns the log-likelihood of :meth:`loglikelihood`,
+        factoring the covariance season by season (see
+        :meth:`season_whiten`)."""
+
+        taumax = tau
+        if terms is not None and len(terms) > 0:
+            taumax = max(tau, np.max(terms[:,1]))
+
+        if len(self.seasons(taumax, tol)) == 1:
+            return self.loglikelihood(residual, sigma0, sigma, tau, terms)
+
+        zs, halflogdet = self.season_whiten(residual, sigma0, sigma, tau, terms, tol)
+        if halflogdet == float('inf'):
+            return float('-inf')
+
+        ll = -np.log(2.0*np.pi)*(residual.shape[0]/2.0) - halflogdet - 0.5*np.dot(zs, zs)
+
+        if np.isnan(ll):
+            return float('-inf')
+        else:
+            return ll
+
+class NoiseFactor(object):
+    """A factorization of the noise covariance of one observatory for
+    fixed noise parameters, which evaluates the likelihood of any
+    residuals without refactoring the covariance.
+
+    For the ``'kalman'`` and ``'celerite'`` methods the factorization
+    is the residual-independent part of the filter recursion, and
+    applying it costs O(N) (O(N J) for J semiseparable columns); for
+    ``'dense'`` it is a copy of the Cholesky factor, and applying it
+    is an O(N^2) triangular solve."""
+
+    def __init__(self, ws, method, sigma0, sigma, tau, terms=None):
+        """Factor the covariance for the times of the
+        :class:`CovarianceWorkspace` ``ws`` with the given noise
+        parameters, using ``method`` (see :class:`LogLikelihood`)."""
+
+        t = ws.ts
+        nts = t.shape[0]
+
+        self._method = method
+
+        if method == 'kalman':
+            self._factor = (np.zeros(nts), np.zeros(nts), np.zeros(nts))
+            self._constant = noise.ou_factor(t, sigma0, sigma, tau, *(self._factor + (ws.counts,)))
+        elif method == 'celerite':
+            a,c,d = noise_coefficients(sigma, tau, terms)
+            J = a.shape[0] + np.count_nonzero(d)
+            self._factor = (np.zeros((nts, J)), np.zeros((nts, J)), np.zeros((nts, J)), np.zeros(nts))
+            self._scratch = np.zeros(J)
+            self._constant = noise.celerite_factor(t, sigma0, a, c, d, *(self._factor + (ws.counts,)))
+        else:
+            try:
+                L,lower = sl.cho_factor(ws.covariance(sigma0, sigma, tau, terms), lower=True, overwrite_a=True, check_finite=False)
+            except sl.LinAlgError:
+                self._factor = None
+                self._constant = float('-inf')
+            else:
+                self._factor = np.array(L)
+                self._constant = -np.log(2.0*np.pi)*(nts/2.0) - np.sum(np.log(np.diag(self._factor)))
+
+            if np.isnan(self._constant):
+                self._constant = float('-inf')
+
+    @property
+    def constant(self):
+        """The part of the log-likelihood that does not depend on the
+        residuals; ``-inf`` if the covariance is not
+        positive-definite."""
+        return self._constant
+
+    def loglikelihood(self, residual):
+        """Returns the log-likelihood of the (zero-mean) ``residual``."""
+
+        if self.constant == float('-inf'):
+            return float('-inf')
+
+        if self._method == 'kalman':
+            ll = noise.ou_solve(*(self._factor + (residual,)))
+        elif self._method == 'celerite':
+            ll = noise.celerite_solve(*(self._factor + (residual, self._scratch)))
+        else:
+            y = sl.solve_triangular(self._factor, residual, lower=True, check_finite=False)
+            ll = -0.5*np.dot(y, y)
+
+        ll += self.constant
+
+        if np.isnan(ll):
+            return float('-inf')
+        else:
+            return ll
+
 class LogPrior(object):
     """Log of the prior function."""
 
-    def __init__(self, pmin=None, pmax=None, npl=1, nobs=1):
-        """Initialize with the given bounds on the priors."""
+    def __init__(self, pmin=None, pmax=None, npl=1, nobs=1, nterms=0, reduced=False, sampling_coordinates=False, wrap=False):
+        """Initialize with the given bounds on the priors.  If
+        ``reduced``, the prior is over reduced parameters, without
+        ``V`` and ``K``; together with a marginalizing
+        :class:`LogLikelihood` this amounts to a flat prior on ``V``
+        and ``K`` over all reals, in place of the bounds on ``V`` and
+        the Jeffreys prior on ``K``.  Such runs sample a different
+        model, and their evidence is not comparable with that of full
+        runs.  If ``sampling_coordinates``, the prior is a
+        density over the sampling coordinates of
+        :class:`parameters.Layout`, including the Jacobian of their
+        map to the natural parameters; the bounds remain on the
+        natural parameters.  The Jeffreys priors are then uniform in
+        the logarithms of the scales and the period.
+
+        If ``wrap``, the prior is evaluated at the :meth:`canonical`
+        form of each point, so that ``chi`` and ``omega`` are periodic
+        and the planets are relabeled in order of period, rather than
+        rejecting points outside the ranges of ``chi`` and ``omega``
+        or with planets out of order.  The likelihood is unchanged by
+        these maps, so the posterior is too.  :attr:`nwrapped` counts
+        the evaluations that would otherwise have been rejected."""
 
         if pmin is None:
-            self._pmin = params.Parameters(npl=npl, nobs=nobs)
+            self._pmin = params.Parameters(npl=npl, nobs=nobs, nterms=nterms, reduced=reduced)
             self._pmin = 0.0*self._pmin
-            self._pmin.V = float('-inf')
+            if not reduced:
+                self._pmin.V = float('-inf')
         else:
             self._pmin = pmin
 
         if pmax is None:
-            self._pmax = params.Parameters(npl=npl, nobs=nobs)
+            self._pmax = params.Parameters(npl=npl, nobs=nobs, nterms=nterms, reduced=reduced)
             self._pmax = self._pmax + float('inf')
             self._pmax.chi = 1.0
             self._pmax.e = 1.0
@@ -69,58 +535,378 @@ class LogPrior(object):
 
         self._npl = npl
         self._nobs = nobs
+        self._nterms = params.normalize_nterms(nterms, nobs)
+        self._reduced = reduced
+        self._sampling_coordinates = sampling_coordinates
+        self._wrap = wrap
+        self._nwrapped = 0
+
+        # Indices into the parameter vector of the parameters with
+        # Jeffreys scale priors (sigma0, sigma, tau, K, n, and the
+        # amplitude and timescale of additional noise terms), the
+        # thermal prior (e), and the mean motions, so that the prior
+        # is a sum over the flat vector rather than a loop over its
+        # fields.  The prior is uniform in the remaining parameters.
+        layout = params.layout(nobs, npl, nterms=self._nterms, reduced=reduced)
+        idx = layout.fields(np.arange(layout.ndim))
+
+        jeffreys = [idx.sigma0, idx.sigma, idx.tau, idx.K, idx.n] + [t[:,0:2] for t in idx.terms]
+        self._ijeffreys = np.concatenate([np.reshape(j, -1) for j in jeffreys])
+        self._ithermal = idx.e
+        self._imotion = idx.n
+        self._layout = layout
+
+        # The indices of chi and omega, and of the fields of each
+        # planet, shape (npl, nfields), for canonical().
+        self._ichi = idx.chi
+        self._iomega = idx.omega
+        self._iplanets = np.transpose([f for f in (idx.K, idx.n, idx.chi, idx.e, idx.omega) if f.shape[0] > 0])
+
+    @property
+    def sampling_coordinates(self):
+        return self._sampling_coordinates
+
+    @property
+    def wrap(self):
+        return self._wrap
+
+    @property
+    def nwrapped(self):
+        """The number of evaluations, with ``wrap``, at points outside
+        the ranges of ``chi`` or ``omega`` or with planets out of
+        order, whose canonical form is inside the prior.  Without
+        ``wrap`` the prior would have rejected these points, at the
+        cost of a sampler step each."""
+        return self._nwrapped
+
+    def canonical(self, ps):
+        """Returns a copy of the parameters ``ps``, shape ``(...,
+        Ndim)``, with ``chi`` wrapped into :math:`[0,1)`, ``omega`` (in
+        natural coordinates) into :math:`[0, 2\\pi)`, and the planets of
+        each vector relabeled in increasing order of period."""
+
+        arr = np.array(ps, dtype=np.float64)
+        flat = np.reshape(arr, (-1, arr.shape[-1]))
+
+        flat[:,self._ichi] = np.mod(flat[:,self._ichi], 1.0)
+        if not self._sampling_coordinates:
+            flat[:,self._iomega] = np.mod(flat[:,self._iomega], 2.0*np.pi)
+
+        if self._npl > 1:
+            # In sampling coordinates the mean motion is replaced by
+            # log(P)
+            if self._sampling_coordinates:
+                order = np.argsort(flat[:,self._imotion], axis=-1, kind='mergesort')
+            else:
+                order = np.argsort(-flat[:,self._imotion], axis=-1, kind='mergesort')
+
+            irows = np.arange(flat.shape[0])[:,np.newaxis,np.newaxis]
+            flat[:,self._iplanets] = flat[irows, self._iplanets[order]]
+
+        return arr
 
     def __call__(self, p):
-        p = params.Parameters(p, npl=self._npl, nobs=self._nobs)
+        p = np.asarray(p)
+
+        wrapped = False
+        if self._wrap:
+            q = self.canonical(p)
+            wrapped = np.any(q != p)
+            p = q
+
+        logjac = 0.0
+        if self._sampling_coordinates:
+            logjac = self._layout.log_jacobian(p)
+            p = self._layout.to_natural(p)
 
         # Check bounds
         if np.any(p < self._pmin) or np.any(p > self._pmax):
             return float('-inf')
 
         # Ensure unique labeling of planets: in increasing order of
-        # period
-        if p.npl > 1 and np.any(p.P[1:] < p.P[:-1]):
+        # period, so decreasing mean motion
+        ns = p[self._imotion]
+        if self._npl > 1 and np.any(ns[1:] > ns[:-1]):
             return float('-inf')
 
-        pr=0.0
+        if wrapped:
+            self._nwrapped += 1
+
+        return logjac + np.sum(np.log(p[self._ithermal])) - np.sum(np.log(p[self._ijeffreys]))
+
+    def batch(self, ps):
+        """Returns the log-prior for each of the parameter vectors in
+        ``ps``, of shape ``(..., Ndim)``, as an array of shape
+        ``ps.shape[:-1]``.  Equivalent to calling the prior on each
+        vector in turn, but vectorized over the whole ensemble."""
 
-        # Uniform prior on velocity offset
+        shape = ps.shape[:-1]
+        arr = np.reshape(np.asarray(ps), (-1, ps.shape[-1]))
 
-        # Jeffreys scale prior on sigma0
-        for s in p.sigma0:
-            pr -= np.sum(np.log(s))
+        if self._wrap:
+            q = self.canonical(arr)
+            wrapped = np.any(q != arr, axis=-1)
+            arr = q
 
-        # Jeffreys scale prior on sigma
-        for s in p.sigma:
-            pr -= np.sum(np.log(s))
+        logjac = 0.0
+        if self._sampling_coordinates:
+            logjac = self._layout.log_jacobian(arr)
+            arr = self._layout.to_natural(arr)
 
-        # Jeffreys scale prior on tau
-        for t in p.tau:
-            pr -= np.sum(np.log(t))
+        out = np.any(arr < np.asarray(self._pmin), axis=-1) | np.any(arr > np.asarray(self._pmax), axis=-1)
 
-        # Jeffreys scale prior on K
-        for k in p.K:
-            pr -= np.sum(np.log(k))
+        if self._npl > 1:
+            ns = arr[:,self._imotion]
+            out |= np.any(ns[:,1:] > ns[:,:-1], axis=-1)
 
-        # Jeffreys scale prior on n
-        for n in p.n:
-            pr -= np.sum(np.log(n))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            prs = logjac + np.sum(np.log(arr[:,self._ithermal]), axis=-1) - np.sum(np.log(arr[:,self._ijeffreys]), axis=-1)
 
-        # Uniform prior on chi
+        prs[out] = float('-inf')
+
+        if self._wrap:
+            self._nwrapped += np.count_nonzero(wrapped & ~out)
+
+        return np.reshape(prs, shape)
+
+    @property
+    def pmin(self):
+        return self._pmin
+
+    @property
+    def pmax(self):
+        return self._pmax
+
+    def gradient(self, p):
+        """Returns ``(lp, dlp)``, the log-prior of ``p`` and its
+        gradient with respect to each parameter.  Outside the prior
+        bounds, ``lp`` is ``-inf`` and the gradient zero.  Requires
+        natural coordinates."""
+
+        if self._sampling_coordinates:
+            raise ValueError('gradients are not available in sampling coordinates')
+
+        p = params.Parameters(p, npl=self._npl, nobs=self._nobs, nterms=self._nterms, reduced=self._reduced)
+        grad = params.Parameters(np.zeros(p.shape[-1]), npl=self._npl, nobs=self._nobs, nterms=self._nterms, reduced=self._reduced)
+
+        lp = self(p)
+        if lp == float('-inf'):
+            return lp, grad
+
+        # Jeffreys scale priors: d(-log x)/dx = -1/x
+        grad.sigma0 = -1.0/p.sigma0
+        grad.sigma = -1.0/p.sigma
+        grad.tau = -1.0/p.tau
+        if not self._reduced:
+            grad.K = -1.0/p.K
+        grad.n = -1.0/p.n
 
         # Thermal prior on e
-        for e in p.e:
-            pr += np.sum(np.log(e))
+        grad.e = 1.0/p.e
 
-        # Uniform prior on omega
+        terms = []
+        for t in p.terms:
+            dt = np.zeros_like(t)
+            dt[:,0:2] = -1.0/t[:,0:2]
+            terms.append(dt)
+        grad.terms = terms
 
-        return pr
+        return lp, grad
 
 class LogLikelihood(object):
     """Log likelihood."""
-    def __init__(self, ts, rvs):
-        self._ts = ts
-        self._rvs = rvs
+    def __init__(self, ts, rvs, method=None, nterms=0, marginalize=None, counts=None, scatters=None, tolerance=1e-10, nthreads=1, kepler_maxiter=None, kepler_tolerance=1e-8, kepler_precision=None, warm_start=0, sampling_coordinates=False):
+        """Initialize with the observation times and radial velocities
+        of each observatory.
+
+        :param ts: List of arrays of observation times, one for each
+          observatory.
+
+        :param rvs: List of arrays of radial velocities, one for each
+          observatory.
+
+        :param method: How to evaluate the correlated noise
+          likelihood.  ``'kalman'`` uses an O(N) Kalman filter
+          recursion for the exponential kernel; ``'celerite'`` uses
+          the O(N J^2) semiseparable solver, which also handles
+          additional noise terms; ``'dense'`` builds and factors the
+          full covariance matrix, and is kept as a reference
+          implementation; ``'seasons'`` factors the full covariance
+          season by season, treating it as block diagonal wherever the
+          noise correlation across a gap in the observations is below
+          ``tolerance`` (see
+          :meth:`CovarianceWorkspace.season_whiten`).  The default is
+          ``'kalman'`` if there are no additional noise terms, and
+          ``'celerite'`` otherwise; without the compiled :mod:`noise`
+          module, which the ``'kalman'`` and ``'celerite'`` methods
+          need, it is ``'dense'``.
+
+        :param nterms: The number of additional noise terms for each
+          observatory (see :class:`parameters.Parameters`).
+
+        :param marginalize: If not ``None``, the likelihood is a
+          function of reduced parameters (see
+          :class:`parameters.Parameters`), and the linear parameters
+          ``V`` and ``K`` are eliminated with a generalized least
+          squares solve against the noise covariance.  ``'profile'``
+          gives the likelihood maximized over the linear parameters;
+          ``'marginal'`` gives the likelihood integrated over them
+          under an (improper) flat prior.
+
+        :param counts: If not ``None``, the data have been compressed
+          by :func:`compress_observations`, and this is the list of
+          the number of observations averaged into each data point,
+          one array per observatory.
+
+        :param scatters: With ``counts``, the list of the
+          within-group sums of squared deviations from
+          :func:`compress_observations`.
+
+        :param tolerance: The correlation across a gap below which
+          the ``'seasons'`` method treats the seasons on either side
+          as independent.
+
+        :param nthreads: The number of threads the ``'seasons'``
+          method uses to factor the seasons of each observatory.
+
+        :param kepler_maxiter: If not ``None``, Kepler's equation is
+          solved with at most this many iterations (see
+          :func:`kepler.rv_residuals_bounded`), and solutions that
+          miss ``kepler_tolerance`` are counted in
+          :attr:`kepler_failures`.  By default the solver iterates
+          until converged.
+
+        :param kepler_tolerance: The tolerance of the bounded Kepler
+          solver.
+
+        :param kepler_precision: If not ``None``, the largest error
+          in the model velocity (in the units of ``rvs``) acceptable
+          from the tabulated Kepler solver of
+          :func:`kepler.rv_residuals_table`.  Evaluations use the table
+          whenever its error bound, ``KEPLER_TABLE_VELOCITY_ERROR``
+          times the largest ``K``, is within this precision.  The
+          table can also be requested per evaluation (see
+          :meth:`__call__`).
+
+        :param warm_start: If positive, the number of walkers for
+          which the eccentric anomalies of the last evaluation are
+          cached (see :class:`rv_model.AnomalyCache`).  Evaluations
+          that name a ``walker`` then warm-start the Kepler solver
+          from that walker's previous solution.
+
+        :param sampling_coordinates: If ``True``, parameters are
+          passed in the sampling coordinates of
+          :class:`parameters.Layout`, and converted to the natural
+          parameters before evaluation.
+
+        The data from each observatory are stored sorted in time."""
+
+        if marginalize not in (None, 'profile', 'marginal'):
+            raise ValueError('marginalize must be one of None, \'profile\' or \'marginal\'')
+
+        nterms = params.normalize_nterms(nterms, len(ts))
+
+        if method is None:
+            if noise is None:
+                method = 'dense'
+            elif sum(nterms) == 0:
+                method = 'kalman'
+            else:
+                method = 'celerite'
+
+        if method not in ('kalman', 'celerite', 'dense', 'seasons'):
+            raise ValueError('method must be one of \'kalman\', \'celerite\', \'dense\' or \'seasons\'')
+
+        if method == 'kalman' and sum(nterms) > 0:
+            raise ValueError('method \'kalman\' cannot handle additional noise terms')
+
+        if method in ('kalman', 'celerite') and noise is None:
+            raise ValueError('method \'%s\' needs the compiled noise module'%method)
+
+        if kepler_precision is not None and kp is None:
+            raise ValueError('kepler_precision needs the compiled kepler module')
+
+        if counts is None:
+            counts = [np.ones(t.shape[0]) for t in ts]
+            scatters = [np.zeros(t.shape[0]) for t in ts]
+
+        self._ts = []
+        self._rvs = []
+        self._counts = []
+        for t, rvobs, n in zip(ts, rvs, counts):
+            isort = np.argsort(t, kind='mergesort')
+            self._ts.append(np.ascontiguousarray(t[isort], dtype=np.float64))
+            self._rvs.append(np.ascontiguousarray(rvobs[isort], dtype=np.float64))
+            self._counts.append(np.ascontiguousarray(n[isort], dtype=np.float64))
+
+        # The times and velocities of all observatories, concatenated,
+        # so that the RV model is evaluated in a single pass; the
+        # residuals of each observatory are slices of one buffer.
+        self._allts = np.concatenate(self._ts)
+        self._allrvs = np.concatenate(self._rvs)
+        self._bounds = np.cumsum([0] + [t.shape[0] for t in self._ts])
+
+        # The likelihood of the deviations within each group of
+        # compressed observations depends only on sigma0, through the
+        # number of deviations, their total square, and the Jacobian
+        # of the compression.
+        self._ndeviations = np.array([np.sum(n - 1.0) for n in self._counts])
+        self._scatters = np.array([np.sum(sc) for sc in scatters])
+        self._halflogcounts = np.array([0.5*np.sum(np.log(n)) for n in self._counts])
+
+        self._method = method
+        self._nterms = nterms
+        self._marginalize = marginalize
+
+        self._tolerance = tolerance
+
+        self._kepler_maxiter = kepler_maxiter
+        self._kepler_tolerance = kepler_tolerance
+        self._kepler_failures = 0
+        self._kepler_precision = kepler_precision
+
+        if kepler_precision is not None:
+            # Build the table now, so that worker processes forked
+            # later share it.
+            kp.kepler_table()
+
+        if warm_start > 0:
+            self._anomaly_cache = rv.AnomalyCache(warm_start)
+        else:
+            self._anomaly_cache = None
+        self._kepler_iterations = 0
+
+        # Guards the Kepler counters, which several threads may update
+        # at once (run.py --backend threads).
+        self._kepler_lock = threading.Lock()
+
+        # The residual buffer of each thread, allocated on its first
+        # evaluation (see _fill_residuals).
+        self._buffers = threading.local()
+
+        self._workspaces = [CovarianceWorkspace(t, dense=(method in ('dense', 'seasons')), nterms=nt, counts=n, nthreads=nthreads) for t, nt, n in zip(self._ts, nterms, self._counts)]
+
+        # Dense workspaces for gradients with additional noise terms,
+        # built on first use.
+        self._gradient_workspaces = None
+
+        # The parameter layouts seen so far, by length of the
+        # parameter vector.
+        self._layouts = {}
+        self._sampling_coordinates = sampling_coordinates
+
+    def __getstate__(self):
+        # Locks and thread-local buffers cannot be pickled; worker
+        # processes get their own.
+        state = self.__dict__.copy()
+        del state['_kepler_lock']
+        del state['_buffers']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._kepler_lock = threading.Lock()
+        self._buffers = threading.local()
 
     @property
     def ts(self):
@@ -130,23 +916,489 @@ class LogLikelihood(object):
     def rvs(self):
         return self._rvs
 
-    def __call__(self, p):
+    @property
+    def method(self):
+        return self._method
+
+    @property
+    def thread_safe(self):
+        """Whether the likelihood may be called from several threads
+        at once.  The ``'kalman'`` and ``'celerite'`` methods run
+        without the GIL and share no buffers between threads; the
+        ``'dense'`` and ``'seasons'`` methods factor in place in the
+        buffers of their :class:`CovarianceWorkspace`."""
+        return self._method in ('kalman', 'celerite')
+
+    @property
+    def kepler_failures(self):
+        """The number of Kepler solutions that did not converge within
+        ``kepler_maxiter`` iterations, over all evaluations of this
+        object.  Evaluations in other processes (for example, the
+        workers of a multiprocessing pool) are not counted here."""
+        return self._kepler_failures
+
+    @property
+    def anomaly_cache(self):
+        """The :class:`rv_model.AnomalyCache` of warm-started
+        evaluations, or ``None``."""
+        return self._anomaly_cache
+
+    @property
+    def kepler_iterations(self):
+        """The number of Halley steps taken by the warm-started Kepler
+        solver, over all evaluations of this object that named a
+        ``walker``."""
+        return self._kepler_iterations
+
+    @property
+    def nterms(self):
+        return self._nterms
+
+    @property
+    def marginalize(self):
+        return self._marginalize
+
+    @property
+    def sampling_coordinates(self):
+        return self._sampling_coordinates
+
+    @property
+    def counts(self):
+        return self._counts
+
+    def _scatter_loglikelihood(self, sigma0s):
+        # The log-likelihood of the within-group deviations of
+        # compressed data, for sigma0s of shape (..., nobs).
+        if not np.any(self._ndeviations > 0):
+            return 0.0
+
+        s2 = sigma0s*sigma0s
+
+        return -np.sum(0.5*self._ndeviations*np.log(2.0*np.pi*s2) + 0.5*self._scatters/s2 + self._halflogcounts, axis=-1)
+
+    def parameters(self, p):
+        """Returns ``p`` viewed as :class:`parameters.Parameters` for
+        the observatories, noise terms, and (if marginalizing) reduced
+        layout of this likelihood.  With ``sampling_coordinates``,
+        returns instead the natural parameters at ``p``."""
+
         nobs=len(self.rvs)
-        npl=(p.shape[-1]-4*nobs)/5
+        reduced=self.marginalize is not None
+        npl=params.npl_from_ndim(p.shape[-1], nobs, self.nterms, reduced)
+
+        if self._sampling_coordinates:
+            return params.from_sampling(p, nobs=nobs, npl=npl, nterms=self.nterms, reduced=reduced)
+
+        return params.Parameters(p, nobs=nobs, npl=npl, nterms=self.nterms, reduced=reduced)
+
+    def _fields(self, p):
+        # The fields of p, as views of a contiguous float64 buffer
+        # through the layout for its length; cheaper than
+        # parameters(p) on the hot path.
+        p = np.ascontiguousarray(p, dtype=np.float64)
+        try:
+            layout = self._layouts[p.shape[-1]]
+        except KeyError:
+            layout = self._layouts[p.shape[-1]] = self.parameters(p).layout
+        if self._sampling_coordinates:
+            p = layout.to_natural(p)
+        return layout.fields(p)
+
+    def _fill_residuals(self, p, approximate=None, walker=None):
+        # Computes the residuals of all observatories in one pass over
+        # the concatenated times, and returns the per-observatory views.
+        # Each thread has its own buffer, so that several threads can
+        # evaluate the likelihood at once; the views are only valid
+        # until the thread's next call.
+        try:
+            allresidual = self._buffers.allresidual
+        except AttributeError:
+            allresidual = self._buffers.allresidual = np.empty(self._allts.shape[0])
 
-        p = params.Parameters(p, nobs=nobs, npl=npl)
+        if p.npl == 0:
+            allresidual[:] = self._allrvs
+        else:
+            if approximate is None:
+                approximate = self._kepler_precision is not None and kp.KEPLER_TABLE_VELOCITY_ERROR*np.max(p.K) <= self._kepler_precision
+
+            if walker is not None and self._anomaly_cache is not None and not approximate:
+                anomalies, warm = self._anomaly_cache.anomalies(walker, p.npl, self._allts.shape[0])
+                maxiter = 8 if self._kepler_maxiter is None else self._kepler_maxiter
+                niter, ncold, nfailed = rv.rv_residuals_warm(self._allts, self._allrvs, p, allresidual, anomalies, warm, self._kepler_tolerance, maxiter)
+            else:
+                niter = 0
+                nfailed = rv.rv_residuals(self._allts, self._allrvs, p, allresidual, self._kepler_tolerance, self._kepler_maxiter, approximate)
+
+            if niter > 0 or nfailed > 0:
+                with self._kepler_lock:
+                    self._kepler_iterations += niter
+                    self._kepler_failures += nfailed
+
+        residuals = [allresidual[i:j] for i, j in zip(self._bounds[:-1], self._bounds[1:])]
+        for residual, V in zip(residuals, p.V):
+            residual -= V
+
+        return residuals
+
+    def __call__(self, p, approximate=None, walker=None):
+        """Returns the log-likelihood of ``p``.
+
+        :param approximate: If ``True``, solve Kepler's equation with
+          the tabulated solver (see :func:`kepler.rv_residuals_table`);
+          if ``False``, with the exact one.  By default, the choice
+          follows ``kepler_precision``.  Ignored when
+          marginalizing.
+
+        :param walker: A hashable key naming the walker at ``p``; with
+          ``warm_start``, the Kepler solver starts from the solution
+          of that walker's previous evaluation."""
+
+        p = self._fields(p)
+
+        if self.marginalize is not None:
+            return self._linear_solve(p)[0]
 
         ll=0.0
 
-        for t, rvobs, V, sigma0, sigma, tau in zip(self.ts, self.rvs, p.V, p.sigma0, p.sigma, p.tau):
-            residual = self.residuals(t, rvobs, p)
+        residuals = self._fill_residuals(p, approximate, walker)
+
+        for t, residual, ws, sigma0, sigma, tau, terms in zip(self.ts, residuals, self._workspaces, p.sigma0, p.sigma, p.tau, p.terms):
+            if self.method == 'kalman':
+                ll += noise.ou_loglikelihood(t, residual, sigma0, sigma, tau, ws.counts)
+            elif self.method == 'celerite':
+                a,c,d = noise_coefficients(sigma, tau, terms)
+                ll += noise.celerite_loglikelihood(t, residual, sigma0, a, c, d, ws.counts)
+            elif self.method == 'seasons':
+                ll += ws.season_loglikelihood(residual, sigma0, sigma, tau, terms, self._tolerance)
+            else:
+                ll += ws.loglikelihood(residual, sigma0, sigma, tau, terms)
+
+        return ll + self._scatter_loglikelihood(p.sigma0)
 
-            cov=generate_covariance(t, sigma0, sigma, tau)
+    def factor(self, p):
+        """Returns a list of :class:`NoiseFactor`, one for each
+        observatory, for the noise parameters in ``p``.  Pass it to
+        :meth:`factored` to evaluate the likelihood of parameters that
+        differ from ``p`` only in ``V`` and the planet parameters."""
+
+        p = self._fields(p)
+
+        return [NoiseFactor(ws, self.method, sigma0, sigma, tau, terms) for ws, sigma0, sigma, tau, terms in zip(self._workspaces, p.sigma0, p.sigma, p.tau, p.terms)]
+
+    def factored(self, p, factors, approximate=None, walker=None):
+        """Returns the log-likelihood of ``p``, using the noise
+        factorization ``factors`` from :meth:`factor` in place of the
+        noise parameters of ``p``.  Costs one evaluation of the RV
+        model and one solve per observatory.  ``approximate`` and
+        ``walker`` are as for :meth:`__call__`."""
+
+        if self.marginalize is not None:
+            raise ValueError('cannot evaluate a factored likelihood when marginalizing')
+
+        p = self._fields(p)
+
+        ll=0.0
+
+        for residual, f in zip(self._fill_residuals(p, approximate, walker), factors):
+            ll += f.loglikelihood(residual)
+
+        return ll + self._scatter_loglikelihood(p.sigma0)
+
+    def empty_states(self):
+        """Returns a list, one per observatory, of empty filter states
+        for :meth:`update`."""
+
+        if self.method == 'kalman':
+            sizes = [3 for nt in self.nterms]
+        elif self.method == 'celerite':
+            sizes = [noise.celerite_state_size(nt+1) for nt in self.nterms]
+        else:
+            raise ValueError('filter states require the \'kalman\' or \'celerite\' method')
 
-            ll += correlated_gaussian_loglikelihood(residual, V*np.ones_like(residual), cov)
+        states = [np.zeros(n) for n in sizes]
+        for st in states:
+            st[0] = float('nan')
+
+        return states
+
+    def update(self, p, states, nold):
+        """Returns the log-likelihood of the data of each observatory
+        after its first ``nold[i]`` points (in time order), conditional
+        on those first points, continuing the noise filter from
+        ``states``, which are updated in place.  Starting from
+        :meth:`empty_states` with ``nold`` all zero gives the full
+        log-likelihood (less the within-group term of compressed data)
+        and the states at the end of the data.
+
+        The cost is proportional to the number of new points, so a
+        walker's likelihood can follow data that arrive after a run
+        without being recomputed from scratch.  Requires the
+        ``'kalman'`` or ``'celerite'`` method, and no
+        marginalization."""
+
+        if self.marginalize is not None:
+            raise ValueError('cannot update the likelihood when marginalizing')
+
+        p = self.parameters(p)
+
+        ll = 0.0
+
+        for t, rvobs, ws, st, n0, V, sigma0, sigma, tau, terms in zip(self.ts, self.rvs, self._workspaces, states, nold, p.V, p.sigma0, p.sigma, p.tau, p.terms):
+            if n0 == t.shape[0]:
+                continue
+
+            tnew = t[n0:]
+            residual = rvobs[n0:] - V
+            if p.npl > 0:
+                residual -= np.sum(rv.rv_model(tnew, p), axis=0)
+
+            if self.method == 'kalman':
+                ll += noise.ou_loglikelihood_update(tnew, residual, sigma0, sigma, tau, st, ws.counts[n0:])
+            elif self.method == 'celerite':
+                a,c,d = noise_coefficients(sigma, tau, terms)
+                ll += noise.celerite_loglikelihood_update(tnew, residual, sigma0, a, c, d, st, ws.counts[n0:])
+            else:
+                raise ValueError('filter states require the \'kalman\' or \'celerite\' method')
 
         return ll
 
+    def batch(self, ps):
+        """Returns the log-likelihood for each of the parameter
+        vectors in ``ps``, of shape ``(..., Ndim)``, as an array of
+        shape ``ps.shape[:-1]``.
+
+        The RV model is evaluated for all the samples at once, and the
+        noise likelihoods of all samples are computed in a single call
+        per observatory, so the interpreter overhead is paid once per
+        batch rather than once per sample."""
+
+        shape = ps.shape[:-1]
+        ps = self.parameters(np.reshape(ps, (-1, ps.shape[-1])))
+
+        if self.marginalize is not None:
+            return np.reshape(np.array([self._linear_solve(p)[0] for p in ps]), shape)
+
+        Vs = ps.V
+        sigma0s = ps.sigma0
+        sigmas = ps.sigma
+        taus = ps.tau
+        terms = ps.terms
+
+        lls = np.zeros(ps.shape[0])
+
+        for i, (t, rvobs, ws) in enumerate(zip(self.ts, self.rvs, self._workspaces)):
+            residuals = rvobs - rv.rv_model_ensemble(t, ps) - Vs[:,i:i+1]
+
+            if self.method == 'kalman':
+                lls += noise.ou_loglikelihood_ensemble(t, residuals, 
+                                                       np.ascontiguousarray(sigma0s[:,i]),
+                                                       np.ascontiguousarray(sigmas[:,i]),
+                                                       np.ascontiguousarray(taus[:,i]),
+                                                       ws.counts)
+            elif self.method == 'celerite':
+                a,c,d = noise_coefficients(sigmas[:,i], taus[:,i], terms[i])
+                lls += noise.celerite_loglikelihood_ensemble(t, residuals, np.ascontiguousarray(sigma0s[:,i]), a, c, d, ws.counts)
+            elif self.method == 'seasons':
+                for k in range(ps.shape[0]):
+                    lls[k] += ws.season_loglikelihood(residuals[k,:], sigma0s[k,i], sigmas[k,i], taus[k,i], terms[i][k], self._tolerance)
+            else:
+                for k in range(ps.shape[0]):
+                    lls[k] += ws.loglikelihood(residuals[k,:], sigma0s[k,i], sigmas[k,i], taus[k,i], terms[i][k])
+
+        lls += self._scatter_loglikelihood(sigma0s)
+
+        return np.reshape(lls, shape)
+
+    def _linear_solve(self, p):
+        # Returns (ll, beta, cho), the profile or marginal
+        # log-likelihood of the reduced parameters p, the generalized
+        # least-squares estimate of the linear parameters (V for each
+        # observatory, followed by K for each planet), and the
+        # Cholesky factor of their normal matrix (whose inverse is
+        # the covariance of the linear parameters).
+        nobs = p.nobs
+        nlin = nobs + p.npl
+
+        A = np.zeros((nlin, nlin))
+        b = np.zeros(nlin)
+        chi2 = 0.0
+        ll = 0.0
+
+        for i, (t, rvobs, ws, sigma0, sigma, tau, terms) in enumerate(zip(self.ts, self.rvs, self._workspaces, p.sigma0, p.sigma, p.tau, p.terms)):
+            # Columns: the data, the offset, the planet shapes
+            ys = np.zeros((t.shape[0], 2+p.npl))
+            ys[:,0] = rvobs
+            ys[:,1] = 1.0
+            if p.npl > 0:
+                ys[:,2:] = rv.rv_shapes(t, p).T
+
+            if self.method == 'dense':
+                zs, halflogdet = ws.whiten(ys, sigma0, sigma, tau, terms)
+            elif self.method == 'seasons':
+                zs, halflogdet = ws.season_whiten(ys, sigma0, sigma, tau, terms, self._tolerance)
+            else:
+                zs = np.zeros_like(ys)
+                a,c,d = noise_coefficients(sigma, tau, terms)
+                halflogdet = noise.celerite_whiten(t, ys, sigma0, a, c, d, zs, ws.counts)
+
+            if halflogdet == float('inf'):
+                return float('-inf'), None, None
+
+            ll -= 0.5*np.log(2.0*np.pi)*t.shape[0] + halflogdet
+
+            cols = [i] + range(nobs, nlin)
+            A[np.ix_(cols, cols)] += np.dot(zs[:,1:].T, zs[:,1:])
+            b[cols] += np.dot(zs[:,1:].T, zs[:,0])
+            chi2 += np.dot(zs[:,0], zs[:,0])
+
+        if not np.all(np.isfinite(A)):
+            return float('-inf'), None, None
+
+        try:
+            cho = sl.cho_factor(A, lower=True)
+        except sl.LinAlgError:
+            return float('-inf'), None, None
+
+        beta = sl.cho_solve(cho, b)
+
+        ll -= 0.5*(chi2 - np.dot(b, beta))
+        ll += self._scatter_loglikelihood(p.sigma0)
+
+        if self.marginalize == 'marginal':
+            ll += 0.5*np.log(2.0*np.pi)*nlin - np.sum(np.log(np.diag(cho[0])))
+
+        if np.isnan(ll):
+            return float('-inf'), None, None
+        else:
+            return ll, beta, cho
+
+    def full_parameters(self, ps, draw=False):
+        """Returns full parameters, including ``V`` and ``K``, from
+        the reduced parameters ``ps`` of shape ``(..., Ndim)``.
+
+        The linear parameters are set to their generalized
+        least-squares estimates given the remaining parameters, or, if
+        ``draw``, drawn from their conditional (Gaussian) posterior
+        under a flat prior.  Solutions with ``K < 0`` are folded to
+        ``(-K, omega + pi)``, which gives the same RV curve.  The result
+        is always in natural coordinates."""
+
+        ps = self.parameters(ps)
+        nobs = ps.nobs
+
+        shape = ps.shape[:-1]
+        flat = params.Parameters(np.reshape(ps, (-1, ps.shape[-1])), nobs=nobs, npl=ps.npl, nterms=ps.nterms, reduced=True)
+
+        betas = np.zeros((flat.shape[0], nobs + ps.npl))
+        for k, p in enumerate(flat):
+            ll, beta, cho = self._linear_solve(p)
+            if beta is None:
+                betas[k,:] = float('nan')
+                continue
+
+            if draw:
+                # If A = L L^T, then L^{-T} x has covariance A^{-1}
+                beta = beta + sl.solve_triangular(cho[0], nr.normal(size=beta.shape[0]), lower=True, trans='T')
+
+            betas[k,:] = beta
+
+        betas = np.reshape(betas, shape + (nobs+ps.npl,))
+
+        full = ps.to_full(betas[...,:nobs], betas[...,nobs:])
+
+        # The linear solution puts no sign limit on K, but -K with
+        # omega shifted by pi is the same curve (chi, the phase of
+        # periastron, is unchanged); fold negative solutions to K > 0,
+        # as the prior requires.
+        layout = full.layout
+        flip = full[..., layout.K] < 0
+        full[..., layout.omega] = np.where(flip, np.mod(full[..., layout.omega] + np.pi, 2.0*np.pi), full[..., layout.omega])
+        full[..., layout.K] = np.abs(full[..., layout.K])
+
+        return full
+
+    def gradient(self, p):
+        """Returns ``(ll, dll)``, the log-likelihood of the (full)
+        parameters ``p`` and its gradient with respect to each
+        parameter, as :class:`parameters.Parameters`.
+
+        The RV model is differentiated analytically through the
+        solution of Kepler's equation (see
+        :func:`rv_model.rv_model_gradient`).  For the ``'kalman'``
+        method the noise likelihood is differentiated through the
+        filter in O(N) time; otherwise the gradient comes from the
+        dense covariance (see
+        :meth:`CovarianceWorkspace.loglikelihood_gradient`).  If the
+        likelihood is ``-inf``, so is ``ll``, and the gradient is
+        zero."""
+
+        if self.marginalize is not None:
+            raise ValueError('gradients are not available when marginalizing')
+        if self._sampling_coordinates:
+            raise ValueError('gradients are not available in sampling coordinates')
+
+        p = self.parameters(p)
+        grad = params.Parameters(np.zeros(p.shape[-1]), nobs=p.nobs, npl=p.npl, nterms=p.nterms)
+
+        if self.method != 'celerite':
+            workspaces = self._workspaces
+        else:
+            if self._gradient_workspaces is None:
+                self._gradient_workspaces = [CovarianceWorkspace(t, dense=True, nterms=nt, counts=n) for t, nt, n in zip(self.ts, self.nterms, self.counts)]
+            workspaces = self._gradient_workspaces
+
+        dV = np.zeros(p.nobs)
+        dsigma0 = np.zeros(p.nobs)
+        dsigma = np.zeros(p.nobs)
+        dtau = np.zeros(p.nobs)
+        dplanets = np.zeros((p.npl, 5))
+        dterms = []
+
+        ll = 0.0
+
+        for i, (t, rvobs, ws, V, sigma0, sigma, tau, terms) in enumerate(zip(self.ts, self.rvs, workspaces, p.V, p.sigma0, p.sigma, p.tau, p.terms)):
+            residual = rvobs - V
+            if p.npl > 0:
+                rvs, drvs = rv.rv_model_gradient(t, p)
+                residual -= np.sum(rvs, axis=0)
+
+            if self.method == 'kalman':
+                dres = np.zeros(t.shape[0])
+                l, dsigma0[i], dsigma[i], dtau[i] = noise.ou_loglikelihood_gradient(t, residual, sigma0, sigma, tau, dres, ws.counts)
+                dterms.append(np.zeros((0, 3)))
+            else:
+                l, dres, dnoise, dts = ws.loglikelihood_gradient(residual, sigma0, sigma, tau, terms)
+                dsigma0[i], dsigma[i], dtau[i] = dnoise
+                dterms.append(dts)
+
+            if l == float('-inf'):
+                return l, params.Parameters(np.zeros(p.shape[-1]), nobs=p.nobs, npl=p.npl, nterms=p.nterms)
+
+            ll += l
+
+            # The residual is the data less the offset and the planets
+            dV[i] = -np.sum(dres)
+            if p.npl > 0:
+                dplanets -= np.dot(drvs, dres)
+
+        # The within-group deviations of compressed data
+        ll += self._scatter_loglikelihood(p.sigma0)
+        if np.any(self._ndeviations > 0):
+            dsigma0 += -self._ndeviations/p.sigma0 + self._scatters/p.sigma0**3
+
+        grad.V = dV
+        grad.sigma0 = dsigma0
+        grad.sigma = dsigma
+        grad.tau = dtau
+        grad.K = dplanets[:,0]
+        grad.n = dplanets[:,1]
+        grad.chi = dplanets[:,2]
+        grad.e = dplanets[:,3]
+        grad.omega = dplanets[:,4]
+        grad.terms = dterms
+
+        return ll, grad
+
     def residuals(self, ts, rvs, p):
         """Return the residuals for the rv model with parameters ``p``
         and the observations of radial velocitys ``rv`` at times
@@ -158,11 +1410,121 @@ class LogLikelihood(object):
             rvmodel = np.sum(rv.rv_model(ts,p), axis=0)
             return rvs - rvmodel
             
-def prior_bounds_from_data(npl, ts, rvs):
+class LogPosterior(object):
+    """The log-posterior, the sum of a :class:`LogLikelihood` and a
+    :class:`LogPrior`, with its gradient."""
+
+    def __init__(self, log_likelihood, log_prior):
+        self._log_likelihood = log_likelihood
+        self._log_prior = log_prior
+
+    @property
+    def log_likelihood(self):
+        return self._log_likelihood
+
+    @property
+    def log_prior(self):
+        return self._log_prior
+
+    def __call__(self, p):
+        lp = self.log_prior(p)
+        if lp == float('-inf'):
+            return lp
+
+        return lp + self.log_likelihood(p)
+
+    def gradient(self, p):
+        """Returns ``(lpost, dlpost)``, the log-posterior and its
+        gradient with respect to each parameter.  The likelihood is
+        not evaluated outside the prior, where ``lpost`` is ``-inf``
+        and the gradient zero."""
+
+        lp, dlp = self.log_prior.gradient(p)
+        if lp == float('-inf'):
+            return lp, dlp
+
+        ll, dll = self.log_likelihood.gradient(p)
+
+        return lp + ll, dlp + dll
+
+def compress_observations(ts, rvs, dt=0.0):
+    r"""Compresses groups of observations closer together in time than
+    ``dt`` into single points, shrinking the size of the noise
+    covariance before it is factored.
+
+    Returns ``(ts, rvs, counts, scatters)``, lists with one entry per
+    observatory of the mean time, mean velocity, number of
+    observations and sum of squared deviations from the mean velocity
+    of each group.  Pass the last two to :class:`LogLikelihood` along
+    with the compressed times and velocities.  Groups are formed from
+    the sorted times, starting a new group whenever an observation is
+    more than ``dt`` after the first observation of the current group.
+
+    For observations at coincident times (``dt = 0``) the compression
+    is exact.  The white noise is independent between observations, so
+    a group of :math:`m` observations with covariance :math:`\sigma_0^2
+    I + c 1 1^T` splits into its mean, with white noise variance
+    :math:`\sigma_0^2/m`, and :math:`m-1` deviations from the mean that
+    are independent of everything else, with variance
+    :math:`\sigma_0^2`.  :class:`LogLikelihood` adds the likelihood of
+    the deviations, which depends only on :math:`\sigma_0`.
+
+    For groups spanning a time :math:`\delta \leq dt` the compression
+    replaces each observation time by the group's mean time, which
+    changes each element of the correlated covariance by at most
+
+    .. math::
+
+      \sum_k a_k \left(c_k + \left| d_k \right| \right) \delta
+
+    in the notation of :func:`noise_coefficients` (for the exponential
+    term alone, :math:`\sigma^2 \delta / 2 \tau^2`), and the RV model
+    at each observation by at most :math:`\delta \max \left| dv/dt
+    \right|`, where for a planet :math:`\left| dv/dt \right| \leq K n
+    (1+e)^2/(1-e^2)^{3/2}`.  The relative error in the covariance is
+    therefore of order :math:`\delta/\tau_\mathrm{min}` (see
+    :func:`prior_bounds_from_data`), and ``dt`` should be chosen much
+    smaller than the shortest correlation time allowed by the
+    prior."""
+
+    tcs = []
+    rvcs = []
+    counts = []
+    scatters = []
+
+    for t, rv in zip(ts, rvs):
+        isort = np.argsort(t, kind='mergesort')
+        t = t[isort]
+        rv = rv[isort]
+
+        # Group labels
+        igroup = np.zeros(t.shape[0], dtype=int)
+        tstart = t[0]
+        for i in range(1, t.shape[0]):
+            if t[i] - tstart > dt:
+                igroup[i] = igroup[i-1] + 1
+                tstart = t[i]
+            else:
+                igroup[i] = igroup[i-1]
+
+        n = np.bincount(igroup).astype(np.float64)
+        tc = np.bincount(igroup, weights=t)/n
+        rvc = np.bincount(igroup, weights=rv)/n
+        scatter = np.bincount(igroup, weights=np.square(rv - rvc[igroup]))
+
+        tcs.append(tc)
+        rvcs.append(rvc)
+        counts.append(n)
+        scatters.append(scatter)
+
+    return tcs, rvcs, counts, scatters
+
+def prior_bounds_from_data(npl, ts, rvs, nterms=0):
     """Returns conservative prior bounds (pmin, pmax) given sampling
     times for each observatory."""
 
     nobs=len(ts)
+    nterms=params.normalize_nterms(nterms, nobs)
 
     dts=[np.diff(t) for t in ts]
     min_dt=reduce(min, [np.min(dt) for dt in dts])
@@ -174,8 +1536,8 @@ def prior_bounds_from_data(npl, ts, rvs):
 
     maxspread=reduce(max, [np.max(rv)-np.min(rv) for rv in rvs])
 
-    pmin=params.Parameters(nobs=nobs,npl=npl)
-    pmax=params.Parameters(nobs=nobs,npl=npl)
+    pmin=params.Parameters(nobs=nobs,npl=npl,nterms=nterms)
+    pmax=params.Parameters(nobs=nobs,npl=npl,nterms=nterms)
 
     Vmin=[]
     Vmax=[]
@@ -212,6 +1574,17 @@ def prior_bounds_from_data(npl, ts, rvs):
     pmin.sigma = np.array(sigmamin)
     pmax.sigma = np.array(sigmamax)
 
+    # Additional noise terms have the same amplitude and timescale
+    # bounds as the exponential term, and frequencies up to the
+    # sampling rate.
+    termsmin=[]
+    termsmax=[]
+    for nt, smin, smax, tmin, tmax in zip(nterms, sigmamin, sigmamax, taumin, taumax):
+        termsmin.append(np.tile(np.array([smin, tmin, 0.0]), (nt, 1)))
+        termsmax.append(np.tile(np.array([smax, tmax, 2.0*np.pi/min_dt]), (nt, 1)))
+    pmin.terms = termsmin
+    pmax.terms = termsmax
+
     if npl >= 1:
         pmin.n = 2.0*np.pi/(max_obst)
         pmax.n = 2.0*np.pi/(min_dt)
@@ -248,30 +1621,45 @@ def generate_initial_sample(pmin, pmax, ntemps, nwalkers):
 
     npl = pmin.npl
     nobs = pmin.nobs
+    nterms = pmin.nterms
 
     assert npl == pmax.npl, 'Number of planets must agree in prior bounds'
     assert nobs == pmax.nobs, 'Number of observations must agree in prior bounds'
+    assert nterms == pmax.nterms, 'Number of noise terms must agree in prior bounds'
 
     N = pmin.shape[-1]
 
-    samps=params.Parameters(arr=np.zeros((ntemps, nwalkers, N)), nobs=nobs, npl=npl)
+    samps=params.Parameters(arr=np.zeros((ntemps, nwalkers, N)), nobs=nobs, npl=npl, nterms=nterms, reduced=pmin.reduced)
 
     V=samps.V
     tau=samps.tau
     sigma=samps.sigma
     sigma0=samps.sigma0
     for i in range(nobs):
-        V[:,:,i] = nr.uniform(low=pmin.V[i], high=pmax.V[i], size=(ntemps, nwalkers))
+        if not pmin.reduced:
+            V[:,:,i] = nr.uniform(low=pmin.V[i], high=pmax.V[i], size=(ntemps, nwalkers))
         tau[:,:,i] = draw_logarithmic(low=pmin.tau[i], high=pmax.tau[i], size=(ntemps,nwalkers))
         sigma[:,:,i] = draw_logarithmic(low=pmin.sigma[i], high=pmax.sigma[i], size=(ntemps,nwalkers))
         sigma0[:,:,i] = draw_logarithmic(low=pmin.sigma[i], high=pmax.sigma[i], size=(ntemps, nwalkers))
-    samps.V=np.squeeze(V)
+    if not pmin.reduced:
+        samps.V=np.squeeze(V)
     samps.tau = np.squeeze(tau)
     samps.sigma = np.squeeze(sigma)
     samps.sigma0 = np.squeeze(sigma0)
 
+    terms=[]
+    for tmin, tmax in zip(pmin.terms, pmax.terms):
+        t=np.zeros((ntemps, nwalkers) + tmin.shape)
+        for j in range(tmin.shape[0]):
+            t[:,:,j,0] = draw_logarithmic(low=tmin[j,0], high=tmax[j,0], size=(ntemps, nwalkers))
+            t[:,:,j,1] = draw_logarithmic(low=tmin[j,1], high=tmax[j,1], size=(ntemps, nwalkers))
+            t[:,:,j,2] = nr.uniform(low=tmin[j,2], high=tmax[j,2], size=(ntemps, nwalkers))
+        terms.append(t)
+    samps.terms = terms
+
     if npl >= 1:
-        samps.K = np.squeeze(draw_logarithmic(low=pmin.K[0], high=pmax.K[0], size=(ntemps, nwalkers, npl)))
+        if not pmin.reduced:
+            samps.K = np.squeeze(draw_logarithmic(low=pmin.K[0], high=pmax.K[0], size=(ntemps, nwalkers, npl)))
 
         # Make sure that periods are increasing
         samps.n = np.squeeze(np.sort(draw_logarithmic(low=pmin.n, high=pmax.n, size=(ntemps,nwalkers,npl)))[:,:,::-1])
@@ -314,28 +1702,31 @@ def recenter_samples(ts, chains, logls, sigmafactor=0.1):
 
     return samples
 
-def posterior_data_mean_quantiles(ts, rvs, psamples):
+def posterior_data_mean_quantiles(ts, rvs, psamples, npl=None, nterms=0):
     """Returns the average of the quantiles of the data residuals over
     the posterior samples in psamples.  The quantiles over multiple
-    observatories are flattened into one array. """
+    observatories are flattened into one array.  The number of planets
+    ``npl`` is inferred from the size of the samples and the numbers
+    of additional noise terms ``nterms`` if not given."""
 
     Nobs = len(ts)
     Nsamples = psamples.shape[0]
 
-    Npl = (psamples.shape[-1] - 4*Nobs)/5
+    if npl is None:
+        npl = params.npl_from_ndim(psamples.shape[-1], Nobs, nterms)
 
-    psamples=params.Parameters(arr=psamples, npl=Npl, nobs=Nobs)
+    psamples=params.Parameters(arr=psamples, npl=npl, nobs=Nobs, nterms=nterms)
 
-    ll=LogLikelihood(ts, rvs)
+    ll=LogLikelihood(ts, rvs, nterms=nterms)
 
     qs=np.zeros(sum([len(t) for t in ts]))
 
     for psample in psamples:
         one_qs=[]
-        for t, rv, V, sigma0, tau, sigma in zip(ts, rvs, psample.V, psample.sigma0, psample.tau, psample.sigma):
+        for t, rv, V, sigma0, tau, sigma, terms in zip(ts, rvs, psample.V, psample.sigma0, psample.tau, psample.sigma, psample.terms):
             one_qs.append(correlated_gaussian_quantiles(ll.residuals(t, rv, psample),
                                                         V*np.ones_like(t), 
-                                                        generate_covariance(t, sigma0, sigma, tau)))
-        qs += np.array(one_qs).flatten()/Nsamples
+                                                        generate_covariance(t, sigma0, sigma, tau, terms)))
+        qs += np.concatenate(one_qs)/Nsamples
 
     return qs
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 from argparse import ArgumentParser
+import chain_io as cio
 import numpy as np
 import ptutils as pt
 
@@ -9,18 +10,21 @@ if __name__ == '__main__':
 
     parser.add_argument('--prefix', metavar='PRE', default='chain', help='prefix for chain files')
 
-    parser.add_argument('--ntemps', metavar='N', default=20, type=int, help='number of temperatures')
-    parser.add_argument('--nwalkers', metavar='N', default=100, type=int, help='number of ensemble walkers')
+    parser.add_argument('--nwalkers', metavar='N', default=None, type=int, help='number of ensemble walkers (only for text chains without an accept file)')
 
     parser.add_argument('--fburnin', metavar='F', default=0.1, type=float, help='fraction of samples to discard as burnin')
 
     args=parser.parse_args()
 
+    reader=cio.ChainReader(args.prefix, nwalkers=args.nwalkers)
+
+    if reader.marginalize is not None:
+        parser.error('the chain was sampled with --marginalize %s, whose prior on V and K is flat over all reals; its evidence is not comparable with that of full runs'%reader.marginalize)
+
     meanlogls=[]
-    for i in range(args.ntemps):
-        data=np.loadtxt('%s.%02d.txt.gz'%(args.prefix, i))
-        logls=np.reshape(data[:,0], (-1, args.nwalkers))
-        chain=np.reshape(data[:, 2:], (-1, args.nwalkers, data.shape[1]-2))
+    for i in range(reader.ntemps):
+        logls=np.array(reader.logl[:, i, :], dtype=np.float64)
+        chain=reader.params[:, i, ...]
 
         istart = int(args.fburnin*chain.shape[0] + 0.5)
 
@@ -33,7 +37,9 @@ if __name__ == '__main__':
 
     meanlogls = np.array(meanlogls)
 
-    inbetas=np.loadtxt('%s.betas.txt'%args.prefix)
+    inbetas=reader.betas
+    if inbetas is None:
+        parser.error('the chain does not record its temperatures')
     inbetas2 = inbetas[::2]
     betas = np.zeros(inbetas.shape[0] + 1)
     betas2 = np.zeros(inbetas2.shape[0] + 1)
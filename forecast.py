@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+
+from argparse import ArgumentParser
+import chain_io as cio
+from gzip import GzipFile
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import parameters as pr
+import re
+import rv_model as rv
+
+class CurveAccumulator(object):
+    """Running statistics of a stream of RV curves on a fixed time
+    grid: the mean and standard deviation at each grid point, and a
+    histogram from which quantiles are interpolated.  The memory used
+    is ``nbins`` counts per grid point, however many curves are
+    added.
+
+    The histogram range at each grid point is fixed by the first
+    curves added there, widened by half their spread on either side;
+    later values beyond it are counted in the end bins, and their
+    number returned by :meth:`add`.  Quantiles are accurate to about
+    the bin width."""
+
+    def __init__(self, ngrid, nbins=256):
+        self._ngrid = ngrid
+        self._nbins = nbins
+
+        self._n = 0
+        self._mean = np.zeros(ngrid)
+        self._m2 = np.zeros(ngrid)
+
+        self._lo = np.zeros(ngrid)
+        self._width = np.zeros(ngrid)
+        self._counts = np.zeros((ngrid, nbins), dtype=np.int32)
+
+    @property
+    def n(self):
+        """The number of curves added."""
+        return self._n
+
+    @property
+    def mean(self):
+        return self._mean
+
+    @property
+    def std(self):
+        return np.sqrt(self._m2/max(self._n - 1, 1))
+
+    def set_range(self, rvs, sl=slice(None)):
+        """Fixes the histogram range at the grid points ``sl`` from
+        the curves ``rvs``, of shape ``(Ncurves, Npoints)``."""
+
+        lo = np.min(rvs, axis=0)
+        hi = np.max(rvs, axis=0)
+        spread = np.maximum(hi - lo, 1e-8*np.maximum(np.abs(hi), 1.0))
+
+        self._lo[sl] = lo - 0.5*spread
+        self._width[sl] = 2.0*spread/self._nbins
+
+    def add(self, rvs, sl=slice(None)):
+        """Adds the curves ``rvs``, of shape ``(Ncurves, Npoints)``,
+        at the grid points ``sl``, and returns the number of values
+        that fell outside the histogram range.  The first call fixes
+        the range with :meth:`set_range`.  Calls for disjoint slices
+        may run concurrently, but :attr:`n` counts only the calls
+        covering the whole grid (see :meth:`count`)."""
+
+        if self._n == 0:
+            self.set_range(rvs, sl)
+
+        lo = self._lo[sl]
+        width = self._width[sl]
+        ncurves, npoints = rvs.shape
+
+        # Merge the batch mean and variance into the running values
+        # (Chan et al. 1979).
+        n = self._n
+        bmean = np.mean(rvs, axis=0)
+        bm2 = np.sum((rvs - bmean)**2, axis=0)
+        delta = bmean - self._mean[sl]
+        self._mean[sl] += delta*ncurves/(n + ncurves)
+        self._m2[sl] += bm2 + delta*delta*n*ncurves/(n + ncurves)
+
+        bins = np.floor((rvs - lo)/width).astype(np.int64)
+        nclipped = np.count_nonzero((bins < 0) | (bins >= self._nbins))
+        np.clip(bins, 0, self._nbins-1, out=bins)
+
+        bins += self._nbins*np.arange(npoints)
+        counts = np.bincount(bins.reshape(-1), minlength=npoints*self._nbins)
+        self._counts[sl] += counts.reshape((npoints, self._nbins)).astype(np.int32)
+
+        return nclipped
+
+    def count(self, ncurves):
+        """Records that ``ncurves`` curves have been added over the
+        whole grid, after the slices of a batch have been added with
+        :meth:`add`."""
+        self._n += ncurves
+
+    def quantiles(self, qs):
+        """Returns the quantiles ``qs`` of the curves at each grid
+        point, of shape ``(Nqs, Ngrid)``, interpolating linearly
+        within the histogram bins."""
+
+        cdf = np.cumsum(self._counts, axis=1)
+        total = cdf[:,-1]
+
+        igrid = np.arange(self._ngrid)
+
+        result = np.zeros((len(qs), self._ngrid))
+        for i, q in enumerate(qs):
+            target = q*total
+            ibin = np.minimum(np.sum(cdf < target[:,np.newaxis], axis=1), self._nbins-1)
+
+            below = np.where(ibin > 0, cdf[igrid, np.maximum(ibin-1, 0)], 0)
+            inbin = np.maximum(self._counts[igrid, ibin], 1)
+
+            result[i,:] = self._lo + self._width*(ibin + (target - below)/inbin)
+
+        return result
+
+def stream_chain(filename, batch=1000, nskip=0, thin=1):
+    """Returns an iterator over the samples of a chain written by
+    ``run.py`` as :class:`parameters.Parameters` of shape ``(Nbatch,
+    Ndim)``, at most ``batch`` at a time.  The first ``nskip`` samples
+    (walker positions) are discarded, and every ``thin``-th of the
+    rest kept.
+
+    ``filename`` is a binary chain file, whose lowest temperature is
+    read through its memory map, or a text chain file, which is read
+    ``batch`` lines at a time.  The numbers of observatories, planets
+    and noise terms come from the file.
+
+    Raises ``ValueError`` for the chain of ``run.py --marginalize
+    profile``, whose offsets and amplitudes are best fits rather than
+    posterior draws, and would give too narrow a forecast."""
+
+    if cio.is_chain_file(filename):
+        reader = cio.ChainReader(filename)
+        marginalize = reader.marginalize
+        samples = _stream_binary(reader, batch, nskip, thin)
+    else:
+        m = re.match(r'(.*)\.\d\d\.txt(\.gz)?$', filename)
+        marginalize = cio.read_text_marginalize(None if m is None else m.group(1))
+        samples = _stream_text(filename, batch, nskip, thin)
+
+    if marginalize == 'profile':
+        raise ValueError('%s holds best-fit offsets and amplitudes, not posterior draws (run.py --marginalize profile)'%filename)
+
+    return samples
+
+def _stream_binary(reader, batch, nskip, thin):
+    nwalkers = reader.nwalkers
+
+    rows = np.arange(nskip, reader.nsamples*nwalkers, thin)
+    for i in range(0, rows.shape[0], batch):
+        yield reader.parameters(samples=rows[i:i+batch] // nwalkers, temps=0, walkers=rows[i:i+batch] % nwalkers)
+
+def _stream_text(filename, batch, nskip, thin):
+    nobs, npl, nterms = cio.text_metadata(cio.read_text_header(filename))
+
+    if filename.endswith('.gz'):
+        inp = GzipFile(filename, 'r')
+    else:
+        inp = open(filename, 'r')
+
+    with inp:
+        lines = (l for l in inp if not l.startswith('#'))
+        lines = islice(lines, nskip, None, thin)
+
+        while True:
+            chunk = list(islice(lines, batch))
+            if len(chunk) == 0:
+                break
+
+            data = np.loadtxt(chunk, ndmin=2)
+            yield pr.Parameters(data[:,2:], nobs=nobs, npl=npl, nterms=nterms)
+
+def forecast(samples, ts, qs=(0.025, 0.16, 0.5, 0.84, 0.975), nbins=256, chunk=4096, nthreads=1):
+    """Returns ``(mean, std, quantiles, nsamples, nclipped)``, the
+    posterior mean, standard deviation and quantiles ``qs`` of the
+    planets' total RV at the times ``ts``, from the batches of
+    parameters in ``samples`` (for example from :func:`stream_chain`),
+    and the number of values outside the histogram range.  Only the
+    running statistics of a :class:`CurveAccumulator` are kept, so the
+    memory does not grow with the number of samples.
+
+    Each batch is evaluated on the grid in chunks of ``chunk`` times,
+    spread over ``nthreads`` threads; the compiled Kepler kernel
+    releases the GIL, so the threads run on separate cores."""
+
+    ts = np.ascontiguousarray(ts, dtype=np.float64)
+    ngrid = ts.shape[0]
+
+    acc = CurveAccumulator(ngrid, nbins=nbins)
+    slices = [slice(i, min(i+chunk, ngrid)) for i in range(0, ngrid, chunk)]
+    pool = ThreadPool(nthreads) if nthreads > 1 else None
+
+    nclipped = 0
+    for ps in samples:
+        def add_chunk(sl):
+            return acc.add(rv.rv_model_ensemble(ts[sl], ps, nthreads=1), sl)
+
+        if pool is None:
+            nclipped += sum(add_chunk(sl) for sl in slices)
+        else:
+            nclipped += sum(pool.map(add_chunk, slices))
+
+        acc.count(ps.shape[0])
+
+    if pool is not None:
+        pool.close()
+
+    return acc.mean, acc.std, acc.quantiles(qs), acc.n, nclipped
+
+if __name__ == '__main__':
+    parser=ArgumentParser()
+
+    parser.add_argument('--input', required=True, metavar='FILE', help='input chain file (binary, or text at one temperature)')
+    parser.add_argument('--output', required=True, metavar='FILE', help='output file of times, mean, standard deviation and quantiles')
+
+    parser.add_argument('--tmin', required=True, type=float, metavar='T', help='start of the time grid')
+    parser.add_argument('--tmax', required=True, type=float, metavar='T', help='end of the time grid')
+    parser.add_argument('--ngrid', default=10000, type=int, metavar='N', help='number of grid times')
+
+    parser.add_argument('--quantiles', default=[], type=float, action='append', metavar='Q', help='quantile to output (may be repeated; default 0.025 0.16 0.5 0.84 0.975)')
+    parser.add_argument('--nbins', default=256, type=int, metavar='N', help='histogram bins per grid time for the quantiles')
+
+    parser.add_argument('--nskip', default=0, type=int, metavar='N', help='number of initial samples to discard as burnin')
+    parser.add_argument('--thin', default=1, type=int, metavar='N', help='use every N-th sample')
+    parser.add_argument('--batch', default=1000, type=int, metavar='N', help='samples read at a time')
+    parser.add_argument('--chunk', default=4096, type=int, metavar='N', help='grid times evaluated at a time')
+    parser.add_argument('--nthreads', default=1, type=int, metavar='N', help='number of threads')
+
+    args=parser.parse_args()
+
+    qs = args.quantiles if len(args.quantiles) > 0 else [0.025, 0.16, 0.5, 0.84, 0.975]
+
+    ts = np.linspace(args.tmin, args.tmax, args.ngrid)
+
+    try:
+        samples = stream_chain(args.input, batch=args.batch, nskip=args.nskip, thin=args.thin)
+    except ValueError as err:
+        parser.error(str(err))
+
+    mean, std, quantiles, nsamples, nclipped = forecast(samples, ts, qs=qs, nbins=args.nbins, chunk=args.chunk, nthreads=args.nthreads)
+
+    print 'Forecast from %d posterior samples (%d values outside the histogram range)'%(nsamples, nclipped)
+
+    with open(args.output, 'w') as out:
+        out.write('# t mean std ' + ' '.join('q%g'%q for q in qs) + '\n')
+        np.savetxt(out, np.column_stack((ts, mean, std, quantiles.T)))
@@ -1,7 +1,10 @@
 import numpy as np
 cimport numpy as np
+cimport cython
+cimport openmp
+from cython.parallel cimport prange
 
-cdef extern from "math.h":
+cdef extern from "math.h" nogil:
   double sqrt(double x)
   double cos(double x)
   double sin(double x)
@@ -10,22 +13,29 @@ cdef extern from "math.h":
   double fabs(double x)
   double M_PI
   double atan(double x)
+  double NAN
+  double pow(double x, double y)
+  double INFINITY
 
-cdef double kepler_f(double M, double E, double e):
+cdef double kepler_f(double M, double E, double e) nogil:
   return E - e*sin(E) - M
 
-cdef double kepler_fp(double E, double e):
+cdef double kepler_fp(double E, double e) nogil:
   return 1.0 - e*cos(E)
 
-cdef double kepler_fpp(double E, double e):
+cdef double kepler_fpp(double E, double e) nogil:
   return e*sin(E)
 
-cdef double kepler_fppp(double E, double e):
+cdef double kepler_fppp(double E, double e) nogil:
   return e*cos(E)
 
-cdef double kepler_solve_ea(double n, double e, double t):
-  cdef double M, E, f, fp, fpp, fppp, d
+cdef double kepler_solve_ea(double n, double e, double t) nogil:
+  cdef double M, E, f, fp, fpp, fppp, d, disc
   
+  if not (e >= 0.0 and e < 1.0):
+      # No bound orbit; the iteration need not converge.
+      return NAN
+
   M = fmod(n*t, 2.0*M_PI)
 
   if M < M_PI:
@@ -47,7 +57,7 @@ cdef double kepler_solve_ea(double n, double e, double t):
 
   return E
 
-cdef double kepler_solve_ta(double n, double e, double t):
+cdef double kepler_solve_ta(double n, double e, double t) nogil:
   cdef double E, f
 
   E = kepler_solve_ea(n,e,t)
@@ -59,6 +69,207 @@ cdef double kepler_solve_ta(double n, double e, double t):
 
   return f
 
+cdef double kepler_starter(double M, double e) nogil:
+  # The starter of Markley (1995, CeMDA 63, 101) for 0 <= M <= pi,
+  # accurate to about 1e-4 everywhere, including e -> 1.
+  cdef double alpha, d, q, r, w
+
+  alpha = (3.0*M_PI*M_PI + 1.6*M_PI*(M_PI - M)/(1.0 + e))/(M_PI*M_PI - 6.0)
+  d = 3.0*(1.0 - e) + alpha*e
+  q = 2.0*alpha*d*(1.0 - e) - M*M
+  r = 3.0*alpha*d*(d - 1.0 + e)*M + M*M*M
+  w = pow(fabs(r) + sqrt(q*q*q + r*r), 2.0/3.0)
+
+  return (2.0*r*w/(w*w + w*q + q*q) + M)/d
+
+cdef double kepler_reduce(double n, double t, double *sgn) nogil:
+  # Returns |M| for the mean anomaly M = n*t reduced to [-pi, pi], and
+  # stores its sign in sgn; E and f have the same sign as M.
+  cdef double M
+
+  M = fmod(n*t, 2.0*M_PI)
+  if M > M_PI:
+      M -= 2.0*M_PI
+  elif M < -M_PI:
+      M += 2.0*M_PI
+
+  if M < 0.0:
+      sgn[0] = -1.0
+      return -M
+  else:
+      sgn[0] = 1.0
+      return M
+
+cdef int kepler_halley(double M, double e, double tol, int maxiter, double *E) nogil:
+  # Refines the solution E of Kepler's equation in place with at most
+  # maxiter Halley steps.  Returns the number of steps taken, or
+  # maxiter+1 if |E - e sin(E) - M| is still above tol.
+  cdef int i
+  cdef double sinE, f, fp
+
+  for i in range(maxiter):
+      sinE = sin(E[0])
+      f = E[0] - e*sinE - M
+      if fabs(f) <= tol:
+          return i
+      fp = 1.0 - e*cos(E[0])
+      E[0] -= f/(fp - 0.5*f*e*sinE/fp)
+
+  if fabs(E[0] - e*sin(E[0]) - M) <= tol:
+      return maxiter
+  else:
+      return maxiter+1
+
+cdef int kepler_ea_bounded(double M, double e, double tol, int maxiter, double *E) nogil:
+  # Solves Kepler's equation for 0 <= M <= pi from the Markley
+  # starter with at most maxiter Halley steps.  Returns 1 if |E - e
+  # sin(E) - M| <= tol, 0 otherwise.
+  E[0] = kepler_starter(M, e)
+
+  return kepler_halley(M, e, tol, maxiter, E) <= maxiter
+
+cdef void kepler_true_cs(double E, double e, double sgn, double *cosf, double *sinf) nogil:
+  # Stores cos(f) and sin(f) of the true anomaly for the eccentric
+  # anomaly sgn*E, without the atan/tan round trip.
+  kepler_true_from_cs(sgn*sin(E), cos(E), e, cosf, sinf)
+
+cdef void kepler_true_from_cs(double sinE, double cosE, double e, double *cosf, double *sinf) nogil:
+  # As kepler_true_cs, given the sine and cosine of E.
+  cdef double g
+
+  g = 1.0 - e*cosE
+  cosf[0] = (cosE - e)/g
+  sinf[0] = sqrt(1.0 - e*e)*sinE/g
+
+cdef int kepler_halley_warm(double M, double e, double tol, int maxiter,
+                            double *E, double *sinE, double *cosE) nogil:
+  # Refines a previous solution E of Kepler's equation, with its sine
+  # and cosine, in place with at most maxiter Halley steps.  The sine
+  # and cosine are advanced by the Taylor series of the angle
+  # addition formulae rather than evaluated, so no trigonometric
+  # functions are called.  Returns the number of steps taken, -1 if a
+  # step exceeds 0.01 radians (where the series would lose accuracy,
+  # and the previous solution is too far away to be of use), or
+  # maxiter+1 if the solution did not reach tol.
+  cdef int i, nsteps=maxiter+1
+  cdef double f, fp, d, d2, sd, cd, s, c
+
+  s = sinE[0]
+  c = cosE[0]
+
+  for i in range(maxiter+1):
+      f = E[0] - e*s - M
+
+      # M may have wrapped around since the previous solution
+      if f > M_PI:
+          E[0] -= 2.0*M_PI
+          f -= 2.0*M_PI
+      elif f < -M_PI:
+          E[0] += 2.0*M_PI
+          f += 2.0*M_PI
+
+      if fabs(f) <= tol:
+          nsteps = i
+          break
+
+      if i == maxiter:
+          break
+
+      fp = 1.0 - e*c
+      d = -f/(fp - 0.5*f*e*s/fp)
+      if fabs(d) > 0.01:
+          return -1
+
+      d2 = d*d
+      sd = d*(1.0 - d2/6.0*(1.0 - d2/20.0))
+      cd = 1.0 - d2/2.0*(1.0 - d2/12.0)
+      s, c = s*cd + c*sd, c*cd - s*sd
+      E[0] += d
+
+  sinE[0] = s
+  cosE[0] = c
+
+  return nsteps
+
+cdef int kepler_solve_bounded(double n, double e, double t, double tol, int maxiter,
+                              double *cosf, double *sinf) nogil:
+  # Solves Kepler's equation with at most maxiter Halley steps, and
+  # stores cos(f) and sin(f) of the true anomaly.  Returns 1 if the
+  # solution converged to tol, 0 otherwise.
+  cdef int converged
+  cdef double M, E, sgn
+
+  M = kepler_reduce(n, t, &sgn)
+  converged = kepler_ea_bounded(M, e, tol, maxiter, &E)
+  kepler_true_cs(E, e, sgn, cosf, sinf)
+
+  return converged
+
+# The table of E(M, e) for the approximate solver, on a regular grid
+# of M in [0, pi] and e in [0, KEPLER_TABLE_EMAX]; built on first use.
+KEPLER_TABLE_NM = 1024
+KEPLER_TABLE_NE = 128
+KEPLER_TABLE_EMAX = 0.9
+KEPLER_TABLE_ERROR = 2e-4
+KEPLER_TABLE_VELOCITY_ERROR = 5e-4
+
+_table_array = None
+cdef double[:, ::1] _table
+
+def kepler_table():
+  """Returns the table of eccentric anomalies used by
+  :func:`rv_residuals_table`, building it on the first call.  The
+  table has shape ``(KEPLER_TABLE_NE+1, KEPLER_TABLE_NM+1)``, with
+  ``E[j,i]`` the solution at ``e = j*KEPLER_TABLE_EMAX/KEPLER_TABLE_NE``
+  and ``M = i*pi/KEPLER_TABLE_NM``.  It takes about 1 MB, and is
+  read-only, so building it before worker processes are forked (as
+  :class:`correlated_likelihood.LogLikelihood` does) shares a single
+  copy between them."""
+  global _table_array, _table
+  cdef int i, j
+  cdef double E
+
+  if _table_array is None:
+      table = np.zeros((KEPLER_TABLE_NE+1, KEPLER_TABLE_NM+1))
+      for j in range(KEPLER_TABLE_NE+1):
+          for i in range(KEPLER_TABLE_NM+1):
+              kepler_ea_bounded(i*M_PI/KEPLER_TABLE_NM, j*KEPLER_TABLE_EMAX/KEPLER_TABLE_NE, 1e-15, 8, &E)
+              table[j,i] = E
+
+      _table = table
+      table.flags.writeable = False
+      _table_array = table
+
+  return _table_array
+
+cdef void kepler_solve_table(double n, double e, double t, double emax, int nM, int ne,
+                             double *cosf, double *sinf) nogil:
+  # Bilinear interpolation of E in the table, falling back on the
+  # bounded solver beyond its range of e.
+  cdef int i, j
+  cdef double M, E, sgn, x, y, fx, fy
+
+  M = kepler_reduce(n, t, &sgn)
+
+  if e > emax:
+      kepler_ea_bounded(M, e, 1e-8, 4, &E)
+  else:
+      x = M*nM/M_PI
+      i = <int>x
+      if i >= nM:
+          i = nM - 1
+      fx = x - i
+
+      y = e*ne/emax
+      j = <int>y
+      if j >= ne:
+          j = ne - 1
+      fy = y - j
+
+      E = (1.0 - fy)*((1.0 - fx)*_table[j,i] + fx*_table[j,i+1]) + fy*((1.0 - fx)*_table[j+1,i] + fx*_table[j+1,i+1])
+
+  kepler_true_cs(E, e, sgn, cosf, sinf)
+
 cpdef np.ndarray[np.float_t, ndim=2] rv_model(np.ndarray[np.float_t, ndim=1] ts, 
                                               np.ndarray[np.float_t, ndim=1] Ks,
                                               np.ndarray[np.float_t, ndim=1] es,
@@ -70,19 +281,282 @@ cpdef np.ndarray[np.float_t, ndim=2] rv_model(np.ndarray[np.float_t, ndim=1] ts,
   cdef double t, K, e, omega, chi, n, t0, f, ecw
   cdef np.ndarray[np.float_t, ndim=2] rvs = np.zeros((npl, nts))
 
-  for i in range(npl):
-      K=Ks[i]
-      e=es[i]
-      omega=omegas[i]
-      chi=chis[i]
-      n=ns[i]
-      t0 = -chi*2.0*M_PI/n
-      ecw=e*cos(omega)
+  with nogil:
+      for i in range(npl):
+          K=Ks[i]
+          e=es[i]
+          omega=omegas[i]
+          chi=chis[i]
+          n=ns[i]
+          t0 = -chi*2.0*M_PI/n
+          ecw=e*cos(omega)
 
-      for j in range(nts):
-          t = ts[j]
-          f = kepler_solve_ta(n, e, (t-t0))
+          for j in range(nts):
+              t = ts[j]
+              f = kepler_solve_ta(n, e, (t-t0))
 
-          rvs[i,j] = K*(cos(f + omega) + ecw)
+              rvs[i,j] = K*(cos(f + omega) + ecw)
 
   return rvs
+
+cpdef rv_model_gradient(np.ndarray[np.float_t, ndim=1] ts,
+                        np.ndarray[np.float_t, ndim=1] Ks,
+                        np.ndarray[np.float_t, ndim=1] es,
+                        np.ndarray[np.float_t, ndim=1] omegas,
+                        np.ndarray[np.float_t, ndim=1] chis,
+                        np.ndarray[np.float_t, ndim=1] ns):
+  r"""Returns ``(rvs, drvs)``, the radial velocities of
+  :func:`rv_model`, shape ``(Npl, Nts)``, and their derivatives with
+  respect to ``(K, n, chi, e, omega)`` of each planet, shape ``(Npl,
+  5, Nts)``.
+
+  The derivatives of the eccentric anomaly follow from differentiating
+  Kepler's equation, :math:`dE/dM = 1/(1 - e \cos E)` and :math:`dE/de
+  = \sin E/(1 - e \cos E)`, and those of the true anomaly from
+  :math:`\tan(f/2) = \sqrt{(1+e)/(1-e)} \tan(E/2)`."""
+  cdef int i, j
+  cdef int npl=Ks.shape[0], nts=ts.shape[0]
+  cdef double t, K, e, omega, chi, n, t0, E, f, g, s, sinE, dfdM, dfde, sinfw
+  cdef np.ndarray[np.float_t, ndim=2] rvs = np.zeros((npl, nts))
+  cdef np.ndarray[np.float_t, ndim=3] drvs = np.zeros((npl, 5, nts))
+
+  with nogil:
+      for i in range(npl):
+          K=Ks[i]
+          e=es[i]
+          omega=omegas[i]
+          chi=chis[i]
+          n=ns[i]
+          t0 = -chi*2.0*M_PI/n
+          s = sqrt(1.0 - e*e)
+
+          for j in range(nts):
+              t = ts[j]
+              E = kepler_solve_ea(n, e, (t-t0))
+              f = 2.0*atan(sqrt((1.0+e)/(1.0-e))*tan(E/2.0))
+
+              sinE = sin(E)
+              g = 1.0 - e*cos(E)
+
+              dfdM = s/(g*g)
+              dfde = sinE/g*(s/g + 1.0/s)
+
+              sinfw = sin(f + omega)
+
+              rvs[i,j] = K*(cos(f + omega) + e*cos(omega))
+
+              drvs[i,0,j] = cos(f + omega) + e*cos(omega)
+              drvs[i,1,j] = -K*sinfw*dfdM*t
+              drvs[i,2,j] = -K*sinfw*dfdM*2.0*M_PI
+              drvs[i,3,j] = -K*sinfw*dfde + K*cos(omega)
+              drvs[i,4,j] = -K*(sinfw + e*sin(omega))
+
+  return rvs, drvs
+
+cpdef rv_residuals(double[:] ts, double[:] rvs,
+                   double[:] Ks, double[:] es, double[:] omegas, double[:] chis, double[:] ns,
+                   double[:] out):
+  """Stores in ``out`` the residuals ``rvs`` less the total radial
+  velocity of all the planets at times ``ts``.
+
+  The planet sum is accumulated directly into ``out``, without the
+  ``(Npl, Nts)`` array of :func:`rv_model`, so the times of several
+  observatories can be concatenated and evaluated in a single call."""
+  cdef int i, j
+  cdef int npl=Ks.shape[0], nts=ts.shape[0]
+  cdef double K, e, omega, n, t0, f, ecw
+
+  with nogil:
+      for j in range(nts):
+          out[j] = rvs[j]
+
+      for i in range(npl):
+          K=Ks[i]
+          e=es[i]
+          omega=omegas[i]
+          n=ns[i]
+          t0 = -chis[i]*2.0*M_PI/n
+          ecw=e*cos(omega)
+
+          for j in range(nts):
+              f = kepler_solve_ta(n, e, (ts[j]-t0))
+              out[j] -= K*(cos(f + omega) + ecw)
+
+cpdef int rv_residuals_bounded(double[:] ts, double[:] rvs,
+                               double[:] Ks, double[:] es, double[:] omegas, double[:] chis, double[:] ns,
+                               double[:] out, double tol=1e-8, int maxiter=4):
+  r"""As :func:`rv_residuals`, but with a solver that is guaranteed to
+  finish: Kepler's equation is started from the cubic approximation
+  of Markley (1995, CeMDA 63, 101) and refined with at most
+  ``maxiter`` Halley steps, stopping once :math:`|E - e \sin E - M|
+  \leq` ``tol``.  The true anomaly enters only through :math:`\cos
+  f` and :math:`\sin f`, computed from :math:`E` without the
+  :math:`\tan`/:math:`\arctan` round trip.
+
+  From this starter two Halley steps reach ``tol = 1e-12`` for all
+  ``e < 1`` tested (up to ``e = 0.99999``), so the default
+  ``maxiter`` leaves a wide margin.  Returns the number of solutions that did
+  not reach ``tol``; their (still bounded) values are used as is."""
+  cdef int i, j, nfailed=0
+  cdef int npl=Ks.shape[0], nts=ts.shape[0]
+  cdef double K, e, n, t0, cosw, sinw, ecw, cosf, sinf
+
+  with nogil:
+      for j in range(nts):
+          out[j] = rvs[j]
+
+      for i in range(npl):
+          K=Ks[i]
+          e=es[i]
+          n=ns[i]
+          t0 = -chis[i]*2.0*M_PI/n
+          cosw=cos(omegas[i])
+          sinw=sin(omegas[i])
+          ecw=e*cosw
+
+          for j in range(nts):
+              if not kepler_solve_bounded(n, e, (ts[j]-t0), tol, maxiter, &cosf, &sinf):
+                  nfailed += 1
+              out[j] -= K*(cosf*cosw - sinf*sinw + ecw)
+
+  return nfailed
+
+cpdef rv_residuals_table(double[:] ts, double[:] rvs,
+                         double[:] Ks, double[:] es, double[:] omegas, double[:] chis, double[:] ns,
+                         double[:] out):
+  """As :func:`rv_residuals`, but with an approximate solver that
+  interpolates the eccentric anomaly bilinearly in :func:`kepler_table`
+  instead of iterating.  For ``e <= KEPLER_TABLE_EMAX`` the error in
+  the eccentric anomaly is below ``KEPLER_TABLE_ERROR`` (2e-4) radians,
+  and the error in the velocity of each planet below
+  ``KEPLER_TABLE_VELOCITY_ERROR`` (5e-4) times its ``K``; more eccentric orbits fall back on the bounded solver of
+  :func:`rv_residuals_bounded`."""
+  cdef int i, j
+  cdef int npl=Ks.shape[0], nts=ts.shape[0]
+  cdef int nM=KEPLER_TABLE_NM, ne=KEPLER_TABLE_NE
+  cdef double emax=KEPLER_TABLE_EMAX
+  cdef double K, e, n, t0, cosw, sinw, ecw, cosf, sinf
+
+  kepler_table()
+
+  with nogil:
+      for j in range(nts):
+          out[j] = rvs[j]
+
+      for i in range(npl):
+          K=Ks[i]
+          e=es[i]
+          n=ns[i]
+          t0 = -chis[i]*2.0*M_PI/n
+          cosw=cos(omegas[i])
+          sinw=sin(omegas[i])
+          ecw=e*cosw
+
+          for j in range(nts):
+              kepler_solve_table(n, e, (ts[j]-t0), emax, nM, ne, &cosf, &sinf)
+              out[j] -= K*(cosf*cosw - sinf*sinw + ecw)
+
+cpdef rv_residuals_warm(double[:] ts, double[:] rvs,
+                        double[:] Ks, double[:] es, double[:] omegas, double[:] chis, double[:] ns,
+                        double[:] out, double[:,:,:] Es, int warm, double tol=1e-8, int maxiter=8):
+  r"""As :func:`rv_residuals_bounded`, but warm-started from a
+  previous solution.  ``Es``, of shape ``(3, Npl, Nts)``, holds the
+  eccentric anomalies of the previous solution and their sines and
+  cosines; if ``warm`` is false, it is ignored.  It is overwritten
+  with the new solution.
+
+  From a previous solution :math:`E_0` with :math:`\Delta M = M -
+  (E_0 - e \sin E_0)` small, the Halley steps are short enough that
+  :math:`\sin E` and :math:`\cos E` can be advanced by the angle
+  addition formulae with the Taylor series of the step, and the
+  solve calls no trigonometric functions at all.  Where a step would
+  exceed 0.01 radians the parameters have moved too far, and the
+  solver starts cold from the Markley starter instead.
+
+  Returns ``(niter, ncold, nfailed)``: the total number of Halley
+  steps, the number of cold starts, and the number of solutions that
+  did not reach ``tol``."""
+  cdef int i, j, it
+  cdef int npl=Ks.shape[0], nts=ts.shape[0]
+  cdef long niter=0, ncold=0, nfailed=0
+  cdef double K, e, n, t0, cosw, sinw, ecw, cosf, sinf, M, sgn, E, sinE, cosE
+
+  with nogil:
+      for j in range(nts):
+          out[j] = rvs[j]
+
+      for i in range(npl):
+          K=Ks[i]
+          e=es[i]
+          n=ns[i]
+          t0 = -chis[i]*2.0*M_PI/n
+          cosw=cos(omegas[i])
+          sinw=sin(omegas[i])
+          ecw=e*cosw
+
+          for j in range(nts):
+              M = kepler_reduce(n, ts[j]-t0, &sgn)
+
+              it = -1
+              if warm:
+                  E = Es[0,i,j]
+                  sinE = Es[1,i,j]
+                  cosE = Es[2,i,j]
+                  it = kepler_halley_warm(sgn*M, e, tol, maxiter, &E, &sinE, &cosE)
+
+              if it < 0:
+                  ncold += 1
+                  E = kepler_starter(M, e)
+                  it = kepler_halley(M, e, tol, maxiter, &E)
+                  E = sgn*E
+                  sinE = sin(E)
+                  cosE = cos(E)
+
+              if it > maxiter:
+                  nfailed += 1
+                  it = maxiter
+              niter += it
+
+              Es[0,i,j] = E
+              Es[1,i,j] = sinE
+              Es[2,i,j] = cosE
+
+              kepler_true_from_cs(sinE, cosE, e, &cosf, &sinf)
+              out[j] -= K*(cosf*cosw - sinf*sinw + ecw)
+
+  return niter, ncold, nfailed
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def rv_model_samples(double[:] ts, double[:,:] Ks, double[:,:] es, double[:,:] omegas,
+                     double[:,:] chis, double[:,:] ns, int nthreads=0):
+  """Returns the total radial velocity (summed over planets) at times
+  ``ts`` for each of ``Nsamples`` parameter sets, given as arrays of
+  shape ``(Nsamples, Npl)``.  The returned array has shape
+  ``(Nsamples, Nts)``.
+
+  The samples are distributed over ``nthreads`` OpenMP threads (by
+  default, all available cores) with the GIL released."""
+  cdef int i, j, k
+  cdef int nsamples=Ks.shape[0], npl=Ks.shape[1], nts=ts.shape[0]
+  cdef double K, e, omega, n, t0, f, ecw
+  cdef np.ndarray[np.float_t, ndim=2] rvs_arr = np.zeros((nsamples, nts))
+  cdef double[:,:] rvs = rvs_arr
+
+  if nthreads <= 0:
+      nthreads = openmp.omp_get_max_threads()
+
+  for k in prange(nsamples, nogil=True, schedule='guided', num_threads=nthreads):
+      for i in range(npl):
+          K=Ks[k,i]
+          e=es[k,i]
+          omega=omegas[k,i]
+          n=ns[k,i]
+          t0 = -chis[k,i]*2.0*M_PI/n
+          ecw=e*cos(omega)
+
+          for j in range(nts):
+              f = kepler_solve_ta(n, e, (ts[j]-t0))
+              rvs[k,j] += K*(cos(f + omega) + ecw)
+
+  return rvs_arr
@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+
+from argparse import ArgumentParser
+import correlated_likelihood as cl
+import numpy as np
+import numpy.random as nr
+import parameters as pr
+import scipy.optimize as so
+import scipy.signal as ss
+import sys
+
+def map_fit(log_posterior, p0, pmin, pmax, maxiter=1000):
+    """Returns ``(p, lpost, converged)``, the maximum a-posteriori
+    parameters found by L-BFGS-B starting from ``p0``, the
+    log-posterior there, and whether L-BFGS-B reported convergence.
+
+    The search uses the analytic gradient of
+    :meth:`correlated_likelihood.LogPosterior.gradient`, in the
+    sampling coordinates of :class:`parameters.Layout`, where the
+    posterior is much better conditioned than in the natural
+    parameters: the scale parameters and the period, which span
+    several orders of magnitude within the prior bounds ``pmin`` and
+    ``pmax``, enter through their logarithms, and ``e`` and ``omega``
+    through :math:`(h, k) = \\sqrt{e} (\\cos \\omega, \\sin
+    \\omega)`, so that ``omega`` wraps and does not stall the search at
+    small ``e``.  ``chi`` is left unbounded, evaluated modulo 1, and
+    wrapped after the fit.
+
+    The objective is finite everywhere in the search box, since
+    L-BFGS-B cannot search through infinite values: ``(h, k)`` is
+    clamped radially so that ``e`` stays between ``1e-12``, where the
+    thermal prior and the angle ``omega`` are singular, and the
+    smaller of ``pmax.e`` and ``1 - 1e-6``, where the Kepler solution
+    is; and the planets are evaluated in order of period, so that
+    their labels never leave the prior.
+
+    The maximum is that of the posterior density over the sampling
+    coordinates, which includes :meth:`parameters.Layout.log_jacobian`,
+    and ``lpost`` is that density.  The density over the natural
+    parameters has no useful maximum: the Jeffreys :math:`1/x` priors
+    grow without bound towards the lower bounds of the scale
+    parameters wherever the likelihood stays finite there (for
+    example as the correlated noise amplitude goes to zero), so an
+    optimizer of it ends pinned at those bounds.  The Jacobian cancels
+    the Jeffreys terms, leaving a flat prior in the logarithms.
+
+    :param log_posterior: A :class:`correlated_likelihood.LogPosterior`
+      over the natural parameters.
+
+    :param p0: The starting parameters.
+
+    :param pmin: Lower bounds on the parameters (see
+      :func:`correlated_likelihood.prior_bounds_from_data`).
+
+    :param pmax: Upper bounds on the parameters.
+
+    :param maxiter: The maximum number of L-BFGS-B iterations."""
+
+    layout = pmin.layout
+    idx = np.arange(layout.ndim)
+
+    scales = [idx[layout.sigma0], idx[layout.sigma], idx[layout.tau], idx[layout.K]]
+    scales += [np.reshape(idx[sl], (-1, 3))[:,0:2] for sl in layout.terms]
+    iscales = np.concatenate([np.reshape(sc, -1) for sc in scales])
+    imotion = idx[layout.n]
+    ichi = idx[layout.chi]
+    ie = idx[layout.e]
+    iomega = idx[layout.omega]
+    iplanets = np.array([idx[sl] for sl in (layout.K, layout.n, layout.chi, layout.e, layout.omega) if len(idx[sl]) > 0]).T
+
+    emin = 1e-12
+    emax = np.minimum(np.asarray(pmax)[ie], 1.0 - 1e-6)
+
+    def clamp(u):
+        # Returns u with each (h, k) clamped radially to emin <= e <=
+        # emax, and h^2 + k^2 before clamping.
+        u = u.copy()
+        r2 = u[ie]**2 + u[iomega]**2
+        e = np.clip(r2, emin, emax)
+        scale = np.sqrt(e/np.where(r2 > 0.0, r2, 1.0))
+        u[ie] = np.where(r2 > 0.0, u[ie]*scale, np.sqrt(emin))
+        u[iomega] = u[iomega]*scale
+        return u, r2
+
+    def to_natural(u):
+        # Returns the natural parameters of u, with the planets in
+        # order of period, and the permutation perm of the entries of
+        # u that puts them in that order.
+        u, r2 = clamp(u)
+        u[ichi] = np.mod(u[ichi], 1.0)
+
+        perm = idx.copy()
+        if layout.npl > 1:
+            perm[iplanets] = iplanets[np.argsort(u[imotion], kind='mergesort')]
+        u = u[perm]
+
+        p = pr.Parameters(layout.to_natural(u), nobs=pmin.nobs, npl=pmin.npl, nterms=pmin.nterms, reduced=pmin.reduced)
+        return p, perm
+
+    # The bounds on the scales and mean motions become bounds on their
+    # logarithms (the latter in the opposite order); e and omega
+    # become coordinates in the disk e <= emax.
+    ulo = layout.to_sampling(pmin)
+    uhi = layout.to_sampling(pmax)
+    ulo[imotion], uhi[imotion] = uhi[imotion], ulo[imotion]
+    ulo[ie] = ulo[iomega] = -np.sqrt(emax)
+    uhi[ie] = uhi[iomega] = np.sqrt(emax)
+    bounds = [(l, h) for l, h in zip(ulo, uhi)]
+    for i in ichi:
+        bounds[i] = (None, None)
+
+    # Returned where the likelihood itself fails; large enough to make
+    # the line search back off, small enough that its interpolation
+    # does not overflow.
+    fbad = 1e100
+
+    def neglogpost(u):
+        p, perm = to_natural(u)
+
+        lpost, grad = log_posterior.gradient(p)
+
+        if lpost == float('-inf'):
+            return fbad, np.zeros_like(u)
+
+        # The chain rule through x = exp(u) for the scales, n = 2 pi
+        # exp(-u) for the mean motions, and e = h^2 + k^2, omega =
+        # atan2(k, h) for (h, k) in the e and omega slots.  Where (h,
+        # k) is clamped, e does not change with the radius.
+        dp = np.array(grad)
+        du = np.zeros_like(u)
+        du[perm] = dp
+        pp = np.zeros_like(u)
+        pp[perm] = p
+
+        du[iscales] = du[iscales]*pp[iscales]
+        du[imotion] = -du[imotion]*pp[imotion]
+
+        h = u[ie]
+        k = u[iomega]
+        r2 = h*h + k*k
+        free = (r2 > emin) & (r2 < emax)
+        de = du[ie].copy()
+        domega = du[iomega].copy()
+        du[ie] = np.where(free, 2.0*h*de, 0.0) - k/np.maximum(r2, emin)*domega
+        du[iomega] = np.where(free, 2.0*k*de, 0.0) + h/np.maximum(r2, emin)*domega
+
+        # The log-Jacobian adds u for each scale, and -u for each
+        # log(P).
+        du[iscales] += 1.0
+        du[imotion] -= 1.0
+        lpost += layout.log_jacobian(u)
+
+        return -lpost, -du
+
+    lo = np.array(pmin)
+    hi = np.array(pmax)
+    lo[ie] = np.maximum(lo[ie], emin)
+    hi[ie] = emax
+    u0 = layout.to_sampling(np.clip(np.asarray(p0), lo, hi))
+
+    u, nlpost, info = so.fmin_l_bfgs_b(neglogpost, u0, bounds=bounds, maxiter=maxiter)
+
+    return to_natural(u)[0], -nlpost, info['warnflag'] == 0
+
+def periodogram_peaks(ts, rvs, nmin, nmax, npeaks=10):
+    """Returns the mean motions of the ``npeaks`` highest peaks,
+    between ``nmin`` and ``nmax``, of the Lomb-Scargle periodogram of
+    the velocities ``rvs`` observed at the times ``ts`` (lists with one
+    array per observatory), less the mean velocity of each
+    observatory.  The frequency grid resolves a fifth of the width of
+    a peak over the span of the observations."""
+
+    allts = np.concatenate(ts)
+    allrvs = np.concatenate([rv - np.mean(rv) for rv in rvs])
+
+    dn = 2.0*np.pi/(5.0*(np.max(allts) - np.min(allts)))
+    ns = np.arange(nmin, nmax, dn)
+
+    power = ss.lombscargle(allts, allrvs, ns)
+
+    ipeaks = np.nonzero((power[1:-1] > power[:-2]) & (power[1:-1] > power[2:]))[0] + 1
+    ipeaks = ipeaks[np.argsort(power[ipeaks])[::-1][:npeaks]]
+
+    return ns[ipeaks]
+
+def seed_planet(p0, ipl, n, ts, rvs, pmin, pmax):
+    """Sets planet ``ipl`` of the parameter array ``p0`` in place to
+    the circular orbit with mean motion ``n`` that best fits the
+    velocities ``rvs`` at times ``ts`` (one array per observatory) by
+    linear least squares, with the offsets ``V`` at the mean of each
+    observatory and the white and correlated noise amplitudes at the
+    scatter about the fit, all within the bounds ``pmin`` and
+    ``pmax``.  The eccentricity is set to 0.1, not 0, so that ``omega``
+    and ``chi`` are not degenerate at the start."""
+
+    layout = pmin.layout
+    idx = np.arange(layout.ndim)
+
+    allts = np.concatenate(ts)
+    allrvs = np.concatenate([rv - np.mean(rv) for rv in rvs])
+
+    A = np.column_stack((np.cos(n*allts), np.sin(n*allts)))
+    (a, b), _, _, _ = np.linalg.lstsq(A, allrvs, rcond=-1)
+
+    # rv = K cos(n t + 2 pi chi + omega) for a circular orbit.
+    omega = p0[idx[layout.omega][ipl]]
+    p0[idx[layout.n][ipl]] = n
+    p0[idx[layout.e][ipl]] = 0.1
+    p0[idx[layout.chi][ipl]] = np.mod((-np.arctan2(b, a) - omega)/(2.0*np.pi), 1.0)
+    if not layout.reduced:
+        p0[idx[layout.K][ipl]] = np.sqrt(a*a + b*b)
+        p0[layout.V] = [np.mean(rv) for rv in rvs]
+
+    scatter = np.std(allrvs - np.dot(A, [a, b]))
+    p0[layout.sigma0] = scatter
+    p0[layout.sigma] = scatter
+
+    np.clip(p0, pmin, pmax, out=p0)
+
+def multistart_map_fit(log_posterior, pmin, pmax, nstarts=10, maxiter=1000):
+    """Returns ``(p, lpost, nfailed)`` for the best of :func:`map_fit`
+    started from ``nstarts`` points drawn from the prior (see
+    :func:`correlated_likelihood.generate_initial_sample`), and the
+    number of starts that did not converge.  These are skipped unless
+    none converges, when ``nfailed`` is ``nstarts``.
+
+    Each local search stays close to its starting period, and the
+    basin of each mode in period is narrow, so random periods rarely
+    find the best one.  Half the starts therefore put one planet on a
+    circular orbit at a peak of the periodogram of the data (see
+    :func:`periodogram_peaks` and :func:`seed_planet`), in turn from
+    the highest."""
+
+    p0s = np.array(cl.generate_initial_sample(pmin, pmax, 1, nstarts)[0])
+
+    layout = pmin.layout
+    if layout.npl > 0:
+        ll = log_posterior.log_likelihood
+        peaks = periodogram_peaks(ll.ts, ll.rvs, np.min(pmin.n), np.max(pmax.n), npeaks=(nstarts+1)//2)
+
+        for i, n in enumerate(peaks):
+            seed_planet(p0s[2*i], nr.randint(layout.npl), n, ll.ts, ll.rvs, pmin, pmax)
+
+        # Keep the planets in order of increasing period.
+        idx = np.arange(layout.ndim)
+        order = np.argsort(-p0s[:, layout.n], axis=1)
+        for sl in (layout.K, layout.n, layout.chi, layout.e, layout.omega):
+            if len(idx[sl]) > 0:
+                p0s[:, sl] = np.take_along_axis(p0s[:, sl], order, axis=1)
+
+    best = None
+    nfailed = 0
+    for p0 in p0s:
+        p0 = pr.Parameters(p0, nobs=pmin.nobs, npl=pmin.npl, nterms=pmin.nterms, reduced=pmin.reduced)
+        p, lpost, converged = map_fit(log_posterior, p0, pmin, pmax, maxiter=maxiter)
+        if not converged:
+            nfailed += 1
+
+        # A converged fit beats any that did not converge.
+        if best is None or (converged, lpost) > (best[2], best[1]):
+            best = (p, lpost, converged)
+
+    return best[0], best[1], nfailed
+
+if __name__ == '__main__':
+    parser=ArgumentParser()
+
+    parser.add_argument('--rvs', metavar='FILE', required=True, default=[], action='append', help='file of times and RV\'s')
+    parser.add_argument('--nplanets', metavar='N', type=int, default=1, help='number of planets')
+    parser.add_argument('--nterms', metavar='N', type=int, default=[], action='append', help='number of additional correlated noise terms (once for all observatories, or once per observatory)')
+    parser.add_argument('--nstarts', metavar='N', type=int, default=10, help='number of starting points (half drawn from the prior, half seeded from periodogram peaks)')
+    parser.add_argument('--init', metavar='FILE', help='file storing a single starting point (instead of random starts)')
+    parser.add_argument('--maxiter', metavar='N', type=int, default=1000, help='maximum iterations per optimization')
+    parser.add_argument('--output', metavar='FILE', default='map.txt', help='output file for the MAP parameters')
+
+    args=parser.parse_args()
+
+    ts=[]
+    rvs=[]
+    for f in args.rvs:
+        data=np.loadtxt(f)
+        ts.append(data[:,0])
+        rvs.append(data[:,1])
+
+    if len(args.nterms) == 0:
+        nterms = 0
+    elif len(args.nterms) == 1:
+        nterms = args.nterms[0]
+    elif len(args.nterms) == len(ts):
+        nterms = args.nterms
+    else:
+        parser.error('--nterms must be given once, or once for each --rvs')
+
+    pmin,pmax=cl.prior_bounds_from_data(args.nplanets, ts, rvs, nterms=nterms)
+
+    log_posterior=cl.LogPosterior(cl.LogLikelihood(ts, rvs, nterms=nterms),
+                                  cl.LogPrior(pmin=pmin, pmax=pmax, npl=args.nplanets, nobs=len(ts), nterms=nterms))
+
+    if args.init is not None:
+        p0=pr.Parameters(np.loadtxt(args.init), nobs=len(ts), npl=args.nplanets, nterms=nterms)
+        p, lpost, converged=map_fit(log_posterior, p0, pmin, pmax, maxiter=args.maxiter)
+        if not converged:
+            sys.stderr.write('warning: the fit did not converge in %d iterations\n'%args.maxiter)
+    else:
+        p, lpost, nfailed=multistart_map_fit(log_posterior, pmin, pmax, nstarts=args.nstarts, maxiter=args.maxiter)
+        if nfailed == args.nstarts:
+            sys.stderr.write('warning: no fit converged in %d iterations\n'%args.maxiter)
+        elif nfailed > 0:
+            sys.stderr.write('warning: %d of %d fits did not converge, and were skipped\n'%(nfailed, args.nstarts))
+
+    print 'MAP log(posterior) in sampling coordinates = ', lpost
+
+    with open(args.output, 'w') as out:
+        out.write(p.header)
+        np.savetxt(out, np.reshape(p, (1, -1)))
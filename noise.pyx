@@ -0,0 +1,781 @@
+# cython: cdivision=True
+
+import numpy as np
+cimport numpy as np
+
+cdef extern from "math.h" nogil:
+  double exp(double x)
+  double cos(double x)
+  double sin(double x)
+  double sqrt(double x)
+  double log(double x)
+  double fabs(double x)
+  double M_PI
+  double INFINITY
+
+cdef double ou_filter(double[:] ts, double[:] rs, double[:] counts, double sigma0, double sigma, double tau) nogil:
+  cdef int i, nts=ts.shape[0]
+  cdef double v, s2, m, P, Pp, S, a, d, ll
+
+  v = sigma*sigma/(2.0*tau)
+  s2 = sigma0*sigma0
+
+  m = 0.0
+  P = v
+  ll = 0.0
+
+  for i in range(nts):
+      if i == 0:
+          Pp = v
+      else:
+          a = exp(-fabs(ts[i] - ts[i-1])/tau)
+          m = a*m
+          Pp = v + a*a*(P - v)
+
+      S = Pp + s2/counts[i]
+      if not S > 0.0:
+          # Not positive-definite
+          return -INFINITY
+      d = rs[i] - m
+
+      ll -= 0.5*(log(2.0*M_PI*S) + d*d/S)
+
+      m += Pp/S*d
+      P = Pp*(s2/counts[i])/S
+
+  return ll
+
+cpdef double ou_loglikelihood(np.ndarray[np.float_t, ndim=1] ts,
+                              np.ndarray[np.float_t, ndim=1] rs,
+                              double sigma0, double sigma, double tau,
+                              double[:] counts=None):
+  r"""Returns the log-likelihood of the residuals ``rs`` observed at
+  the (sorted) times ``ts`` under the exponential autocovariance with
+  white noise
+
+  .. math::
+
+    \left\langle x_i x_j \right\rangle = \sigma_0^2 \delta_{ij} + \frac{\sigma^2}{2\tau} \exp\left[ -\frac{\left| t_i - t_j\right|}{\tau} \right]
+
+  The correlated component is an Ornstein-Uhlenbeck process, which is
+  Markov, so the likelihood can be accumulated with a scalar Kalman
+  filter in O(N) time and O(1) memory.  Returns ``-inf`` if the
+  covariance is not positive-definite.
+
+  If given, ``counts`` gives the number of observations averaged into
+  each residual (see :func:`correlated_likelihood.compress_observations`),
+  dividing the white noise variance at that time.
+
+  The filter runs without the GIL."""
+  cdef double[:] tsv = ts, rsv = rs
+  cdef double ll
+
+  if counts is None:
+      counts = np.ones(ts.shape[0])
+
+  with nogil:
+      ll = ou_filter(tsv, rsv, counts, sigma0, sigma, tau)
+
+  return ll
+
+cpdef np.ndarray[np.float_t, ndim=1] ou_loglikelihood_ensemble(double[:] ts,
+                                                               double[:,:] rs,
+                                                               double[:] sigma0s,
+                                                               double[:] sigmas,
+                                                               double[:] taus,
+                                                               double[:] counts=None):
+  """Returns the log-likelihoods of :func:`ou_loglikelihood` for
+  each row of residuals ``rs``, shape ``(Nsamples, Nts)``, with the
+  corresponding noise parameters."""
+  cdef int k, nsamp=rs.shape[0]
+  cdef np.ndarray[np.float_t, ndim=1] lls = np.zeros(nsamp)
+
+  if counts is None:
+      counts = np.ones(ts.shape[0])
+
+  with nogil:
+      for k in range(nsamp):
+          lls[k] = ou_filter(ts, rs[k,:], counts, sigma0s[k], sigmas[k], taus[k])
+
+  return lls
+
+cdef int celerite_columns(double[:] c, double[:] d, double[:] cs) nogil:
+  # Fills cs with the decay rate for each column of the semiseparable
+  # representation and returns the number of columns.  Terms with d =
+  # 0 are real and need only one column; the others need two.
+  cdef int j, J=0
+
+  for j in range(c.shape[0]):
+      cs[J] = c[j]
+      J += 1
+      if d[j] != 0.0:
+          cs[J] = c[j]
+          J += 1
+
+  return J
+
+cdef double celerite_filter(double[:] ts, double[:] rs, double[:] counts, double sigma0,
+                            double[:] a, double[:] c, double[:] d,
+                            double[:,:] S, double[:] W, double[:] f, double[:] phi,
+                            double[:] U, double[:] V, double[:] SU, double[:] cs) nogil:
+  cdef int i, j, k, l, nts=ts.shape[0], nterms=a.shape[0], J
+  cdef double A, D, Dprev, z, zprev, dt, ll
+
+  J = celerite_columns(c, d, cs)
+
+  A = 0.0
+  for j in range(nterms):
+      A += a[j]
+
+  for k in range(J):
+      f[k] = 0.0
+      W[k] = 0.0
+      for l in range(J):
+          S[k,l] = 0.0
+
+  Dprev = 0.0
+  zprev = 0.0
+  ll = 0.0
+
+  for i in range(nts):
+      k = 0
+      for j in range(nterms):
+          if d[j] == 0.0:
+              U[k] = a[j]
+              V[k] = 1.0
+              k += 1
+          else:
+              U[k] = a[j]*cos(d[j]*ts[i])
+              U[k+1] = a[j]*sin(d[j]*ts[i])
+              V[k] = cos(d[j]*ts[i])
+              V[k+1] = sin(d[j]*ts[i])
+              k += 2
+
+      if i > 0:
+          dt = ts[i] - ts[i-1]
+          for k in range(J):
+              phi[k] = exp(-cs[k]*dt)
+
+          for k in range(J):
+              for l in range(J):
+                  S[k,l] = phi[k]*phi[l]*(S[k,l] + Dprev*W[k]*W[l])
+              f[k] = phi[k]*(f[k] + W[k]*zprev)
+
+      D = A + sigma0*sigma0/counts[i]
+      z = rs[i]
+      for k in range(J):
+          SU[k] = 0.0
+          for l in range(J):
+              SU[k] += S[k,l]*U[l]
+          D -= U[k]*SU[k]
+          z -= U[k]*f[k]
+
+      if not D > 0.0:
+          # Not positive-definite
+          return -INFINITY
+
+      for k in range(J):
+          W[k] = (V[k] - SU[k])/D
+
+      ll -= 0.5*(log(2.0*M_PI*D) + z*z/D)
+
+      Dprev = D
+      zprev = z
+
+  return ll
+
+cpdef double celerite_loglikelihood(np.ndarray[np.float_t, ndim=1] ts,
+                                    np.ndarray[np.float_t, ndim=1] rs,
+                                    double sigma0,
+                                    np.ndarray[np.float_t, ndim=1] a,
+                                    np.ndarray[np.float_t, ndim=1] c,
+                                    np.ndarray[np.float_t, ndim=1] d,
+                                    double[:] counts=None):
+  r"""Returns the log-likelihood of the residuals ``rs`` observed at
+  the (sorted) times ``ts`` under white noise of amplitude ``sigma0``
+  plus a sum of damped oscillation terms
+
+  .. math::
+
+    \left\langle x_i x_j \right\rangle = \sigma_0^2 \delta_{ij} + \sum_k a_k \exp\left[ -c_k \left| t_i - t_j\right| \right] \cos\left( d_k \left| t_i - t_j \right| \right)
+
+  The covariance is semiseparable, and is factored with the
+  recursion of Foreman-Mackey et al. (2017, AJ 154, 220) in O(N J^2)
+  time, where J is the number of terms (terms with ``d = 0`` count
+  once, the others twice).  Returns ``-inf`` if the covariance is not
+  positive-definite.  ``counts`` is as for :func:`ou_loglikelihood`.
+  The recursion runs without the GIL."""
+  cdef int J = a.shape[0] + np.count_nonzero(d)
+  cdef double[:] tsv = ts, rsv = rs, av = a, cv = c, dv = d
+  cdef double[:,:] S = np.zeros((J,J))
+  cdef double[:] W = np.zeros(J), f = np.zeros(J), phi = np.zeros(J)
+  cdef double[:] U = np.zeros(J), V = np.zeros(J), SU = np.zeros(J), cs = np.zeros(J)
+  cdef double ll
+
+  if counts is None:
+      counts = np.ones(ts.shape[0])
+
+  with nogil:
+      ll = celerite_filter(tsv, rsv, counts, sigma0, av, cv, dv,
+                           S, W, f, phi, U, V, SU, cs)
+
+  return ll
+
+cpdef np.ndarray[np.float_t, ndim=1] celerite_loglikelihood_ensemble(double[:] ts,
+                                                                     double[:,:] rs,
+                                                                     double[:] sigma0s,
+                                                                     double[:,:] a,
+                                                                     double[:,:] c,
+                                                                     double[:,:] d,
+                                                                     double[:] counts=None):
+  """Returns the log-likelihoods of :func:`celerite_loglikelihood`
+  for each row of residuals ``rs``, shape ``(Nsamples, Nts)``, with
+  the corresponding noise parameters; ``a``, ``c`` and ``d`` have
+  shape ``(Nsamples, Nterms)``."""
+  cdef int k, nsamp=rs.shape[0], J=2*a.shape[1]
+  cdef np.ndarray[np.float_t, ndim=1] lls = np.zeros(nsamp)
+  cdef double[:,:] S = np.zeros((J,J))
+  cdef double[:] W = np.zeros(J), f = np.zeros(J), phi = np.zeros(J)
+  cdef double[:] U = np.zeros(J), V = np.zeros(J), SU = np.zeros(J), cs = np.zeros(J)
+
+  if counts is None:
+      counts = np.ones(ts.shape[0])
+
+  with nogil:
+      for k in range(nsamp):
+          lls[k] = celerite_filter(ts, rs[k,:], counts, sigma0s[k], a[k,:], c[k,:], d[k,:],
+                                   S, W, f, phi, U, V, SU, cs)
+
+  return lls
+
+cpdef double celerite_whiten(np.ndarray[np.float_t, ndim=1] ts,
+                             np.ndarray[np.float_t, ndim=2] ys,
+                             double sigma0,
+                             np.ndarray[np.float_t, ndim=1] a,
+                             np.ndarray[np.float_t, ndim=1] c,
+                             np.ndarray[np.float_t, ndim=1] d,
+                             np.ndarray[np.float_t, ndim=2] out,
+                             double[:] counts=None):
+  """Whitens the columns of ``ys``, shape ``(Nts, M)``, against the
+  covariance of :func:`celerite_loglikelihood`, storing the result in
+  ``out``.  That is, writing the covariance as :math:`C = L L^T`,
+  ``out`` becomes :math:`L^{-1} y`.
+
+  Returns the half log-determinant of the covariance, or ``inf`` if
+  the covariance is not positive-definite.  ``counts`` is as for
+  :func:`ou_loglikelihood`."""
+  cdef int i, j, k, l, m, nts=ts.shape[0], ncol=ys.shape[1], nterms=a.shape[0], J
+  cdef double A, D, Dprev, sqrtD, dt, halflogdet
+  cdef np.ndarray[np.float_t, ndim=2] S, f
+  cdef np.ndarray[np.float_t, ndim=1] W, phi, U, V, SU, cs, z, zprev
+
+  J = a.shape[0] + np.count_nonzero(d)
+
+  if counts is None:
+      counts = np.ones(nts)
+
+  S = np.zeros((J,J))
+  f = np.zeros((J,ncol))
+  W = np.zeros(J)
+  phi = np.zeros(J)
+  U = np.zeros(J)
+  V = np.zeros(J)
+  SU = np.zeros(J)
+  cs = np.zeros(J)
+  z = np.zeros(ncol)
+  zprev = np.zeros(ncol)
+
+  J = celerite_columns(c, d, cs)
+
+  A = 0.0
+  for j in range(nterms):
+      A += a[j]
+
+  Dprev = 0.0
+  halflogdet = 0.0
+
+  for i in range(nts):
+      k = 0
+      for j in range(nterms):
+          if d[j] == 0.0:
+              U[k] = a[j]
+              V[k] = 1.0
+              k += 1
+          else:
+              U[k] = a[j]*cos(d[j]*ts[i])
+              U[k+1] = a[j]*sin(d[j]*ts[i])
+              V[k] = cos(d[j]*ts[i])
+              V[k+1] = sin(d[j]*ts[i])
+              k += 2
+
+      if i > 0:
+          dt = ts[i] - ts[i-1]
+          for k in range(J):
+              phi[k] = exp(-cs[k]*dt)
+
+          for k in range(J):
+              for l in range(J):
+                  S[k,l] = phi[k]*phi[l]*(S[k,l] + Dprev*W[k]*W[l])
+              for m in range(ncol):
+                  f[k,m] = phi[k]*(f[k,m] + W[k]*zprev[m])
+
+      D = A + sigma0*sigma0/counts[i]
+      for m in range(ncol):
+          z[m] = ys[i,m]
+      for k in range(J):
+          SU[k] = 0.0
+          for l in range(J):
+              SU[k] += S[k,l]*U[l]
+          D -= U[k]*SU[k]
+          for m in range(ncol):
+              z[m] -= U[k]*f[k,m]
+
+      if not D > 0.0:
+          # Not positive-definite
+          return INFINITY
+
+      for k in range(J):
+          W[k] = (V[k] - SU[k])/D
+
+      sqrtD = sqrt(D)
+      for m in range(ncol):
+          out[i,m] = z[m]/sqrtD
+          zprev[m] = z[m]
+
+      halflogdet += log(sqrtD)
+      Dprev = D
+
+  return halflogdet
+
+cpdef double ou_factor(double[:] ts, double sigma0, double sigma, double tau,
+                       double[:] phi, double[:] gain, double[:] S, double[:] counts=None):
+  """Runs the Kalman filter of :func:`ou_loglikelihood` without any
+  data, storing the quantities that do not depend on the residuals: the
+  propagation factor ``phi``, the gain ``gain`` and the innovation
+  variance ``S`` at each time.  Together they are an implicit
+  factorization of the covariance, which :func:`ou_solve` applies to
+  residuals in O(N) time without any transcendental functions.
+
+  Returns the part of the log-likelihood that does not depend on the
+  residuals, or ``-inf`` if the covariance is not positive-definite.
+  ``counts`` is as for :func:`ou_loglikelihood`."""
+  cdef int i, nts=ts.shape[0]
+  cdef double v, s2, P, Pp, ll
+
+  if counts is None:
+      counts = np.ones(nts)
+
+  v = sigma*sigma/(2.0*tau)
+  s2 = sigma0*sigma0
+
+  P = v
+  ll = 0.0
+
+  for i in range(nts):
+      if i == 0:
+          phi[i] = 0.0
+          Pp = v
+      else:
+          phi[i] = exp(-fabs(ts[i] - ts[i-1])/tau)
+          Pp = v + phi[i]*phi[i]*(P - v)
+
+      S[i] = Pp + s2/counts[i]
+      if not S[i] > 0.0:
+          # Not positive-definite
+          return -INFINITY
+
+      gain[i] = Pp/S[i]
+      P = Pp*(s2/counts[i])/S[i]
+
+      ll -= 0.5*log(2.0*M_PI*S[i])
+
+  return ll
+
+cpdef double ou_solve(double[:] phi, double[:] gain, double[:] S, double[:] rs):
+  """Returns the residual-dependent part of the log-likelihood of
+  ``rs`` given the factorization from :func:`ou_factor`."""
+  cdef int i, nts=rs.shape[0]
+  cdef double m, d, ll
+
+  m = 0.0
+  ll = 0.0
+
+  for i in range(nts):
+      m = phi[i]*m
+      d = rs[i] - m
+      ll -= 0.5*d*d/S[i]
+      m += gain[i]*d
+
+  return ll
+
+cpdef double celerite_factor(double[:] ts, double sigma0,
+                             double[:] a, double[:] c, double[:] d,
+                             double[:,:] U, double[:,:] W, double[:,:] phi, double[:] D,
+                             double[:] counts=None):
+  """Runs the recursion of :func:`celerite_loglikelihood` without any
+  data, storing the quantities that do not depend on the residuals:
+  ``U``, ``W`` and ``phi``, of shape ``(Nts, J)``, and ``D``, of
+  shape ``(Nts,)``, where J is the number of columns of the
+  semiseparable representation.  :func:`celerite_solve` applies the
+  factorization to residuals in O(N J) time.
+
+  Returns the part of the log-likelihood that does not depend on the
+  residuals, or ``-inf`` if the covariance is not positive-definite.
+  ``counts`` is as for :func:`ou_loglikelihood`."""
+  cdef int i, j, k, l, nts=ts.shape[0], nterms=a.shape[0], J
+  cdef double A, Dprev, dt, SU, ll
+  cdef double[:] cs = np.zeros(U.shape[1]), V = np.zeros(U.shape[1])
+  cdef double[:,:] S = np.zeros((U.shape[1], U.shape[1]))
+
+  if counts is None:
+      counts = np.ones(nts)
+
+  J = celerite_columns(c, d, cs)
+
+  A = 0.0
+  for j in range(nterms):
+      A += a[j]
+
+  Dprev = 0.0
+  ll = 0.0
+
+  for i in range(nts):
+      k = 0
+      for j in range(nterms):
+          if d[j] == 0.0:
+              U[i,k] = a[j]
+              V[k] = 1.0
+              k += 1
+          else:
+              U[i,k] = a[j]*cos(d[j]*ts[i])
+              U[i,k+1] = a[j]*sin(d[j]*ts[i])
+              V[k] = cos(d[j]*ts[i])
+              V[k+1] = sin(d[j]*ts[i])
+              k += 2
+
+      if i == 0:
+          for k in range(J):
+              phi[i,k] = 0.0
+      else:
+          dt = ts[i] - ts[i-1]
+          for k in range(J):
+              phi[i,k] = exp(-cs[k]*dt)
+
+          for k in range(J):
+              for l in range(J):
+                  S[k,l] = phi[i,k]*phi[i,l]*(S[k,l] + Dprev*W[i-1,k]*W[i-1,l])
+
+      D[i] = A + sigma0*sigma0/counts[i]
+      for k in range(J):
+          SU = 0.0
+          for l in range(J):
+              SU += S[k,l]*U[i,l]
+          D[i] -= U[i,k]*SU
+          W[i,k] = V[k] - SU
+
+      if not D[i] > 0.0:
+          # Not positive-definite
+          return -INFINITY
+
+      for k in range(J):
+          W[i,k] /= D[i]
+
+      ll -= 0.5*log(2.0*M_PI*D[i])
+
+      Dprev = D[i]
+
+  return ll
+
+cpdef double celerite_solve(double[:,:] U, double[:,:] W, double[:,:] phi, double[:] D,
+                            double[:] rs, double[:] f):
+  """Returns the residual-dependent part of the log-likelihood of
+  ``rs`` given the factorization from :func:`celerite_factor`.  The
+  array ``f``, of length J, is scratch space."""
+  cdef int i, k, nts=rs.shape[0], J=U.shape[1]
+  cdef double z, zprev, ll
+
+  for k in range(J):
+      f[k] = 0.0
+
+  zprev = 0.0
+  ll = 0.0
+
+  for i in range(nts):
+      z = rs[i]
+      if i > 0:
+          for k in range(J):
+              f[k] = phi[i,k]*(f[k] + W[i-1,k]*zprev)
+              z -= U[i,k]*f[k]
+
+      ll -= 0.5*z*z/D[i]
+
+      zprev = z
+
+  return ll
+
+cpdef double ou_loglikelihood_update(double[:] ts, double[:] rs,
+                                     double sigma0, double sigma, double tau,
+                                     double[:] state, double[:] counts=None):
+  """Continues the Kalman filter of :func:`ou_loglikelihood` over the
+  residuals ``rs`` at times ``ts``, which must follow all the times
+  already processed, and returns the log-likelihood of the new
+  residuals conditional on the old ones.
+
+  ``state``, of length 3, holds the time, mean and variance of the
+  filter after the last processed point, and is updated in place.  A
+  state whose time is ``nan`` is empty: the filter starts afresh, and
+  the return value is the full log-likelihood of ``rs``.  Returns
+  ``-inf`` if the covariance is not positive-definite."""
+  cdef int i, nts=ts.shape[0]
+  cdef double v, s2, tlast, m, P, Pp, S, a, d, ll
+
+  if counts is None:
+      counts = np.ones(nts)
+
+  v = sigma*sigma/(2.0*tau)
+  s2 = sigma0*sigma0
+
+  tlast = state[0]
+  m = state[1]
+  P = state[2]
+  ll = 0.0
+
+  for i in range(nts):
+      if tlast != tlast:
+          m = 0.0
+          Pp = v
+      else:
+          a = exp(-fabs(ts[i] - tlast)/tau)
+          m = a*m
+          Pp = v + a*a*(P - v)
+
+      S = Pp + s2/counts[i]
+      if not S > 0.0:
+          # Not positive-definite
+          return -INFINITY
+      d = rs[i] - m
+
+      ll -= 0.5*(log(2.0*M_PI*S) + d*d/S)
+
+      m += Pp/S*d
+      P = Pp*(s2/counts[i])/S
+      tlast = ts[i]
+
+  state[0] = tlast
+  state[1] = m
+  state[2] = P
+
+  return ll
+
+def celerite_state_size(int nterms):
+  """Returns the length of the state array for
+  :func:`celerite_loglikelihood_update` with ``nterms`` terms."""
+  return 3 + 4*nterms + 4*nterms*nterms
+
+cpdef double celerite_loglikelihood_update(double[:] ts, double[:] rs, double sigma0,
+                                           double[:] a, double[:] c, double[:] d,
+                                           double[:] state, double[:] counts=None):
+  """Continues the recursion of :func:`celerite_loglikelihood` over the
+  residuals ``rs`` at times ``ts``, which must follow all the times
+  already processed, and returns the log-likelihood of the new
+  residuals conditional on the old ones.
+
+  ``state``, of length :func:`celerite_state_size`, holds the
+  recursion after the last processed point, and is updated in place.
+  A state whose first element (the time of the last point) is ``nan``
+  is empty, and the return value is then the full log-likelihood of
+  ``rs``.  Returns ``-inf`` if the covariance is not
+  positive-definite."""
+  cdef int i, j, k, l, nts=ts.shape[0], nterms=a.shape[0], J, Jmax=2*a.shape[0]
+  cdef double A, D, tlast, Dprev, zprev, z, dt, ll
+  cdef double[:] W, f, phi, U, V, SU, cs
+  cdef double[:,:] S
+
+  if counts is None:
+      counts = np.ones(nts)
+
+  # Layout: tlast, Dprev, zprev, W, f, S (row-major), with room for
+  # Jmax columns.
+  W = state[3:3+Jmax]
+  f = state[3+Jmax:3+2*Jmax]
+  S = np.reshape(state[3+2*Jmax:3+2*Jmax+Jmax*Jmax], (Jmax, Jmax))
+
+  phi = np.zeros(Jmax)
+  U = np.zeros(Jmax)
+  V = np.zeros(Jmax)
+  SU = np.zeros(Jmax)
+  cs = np.zeros(Jmax)
+
+  J = celerite_columns(c, d, cs)
+
+  A = 0.0
+  for j in range(nterms):
+      A += a[j]
+
+  tlast = state[0]
+  Dprev = state[1]
+  zprev = state[2]
+  ll = 0.0
+
+  if tlast != tlast:
+      for k in range(J):
+          f[k] = 0.0
+          W[k] = 0.0
+          for l in range(J):
+              S[k,l] = 0.0
+
+  for i in range(nts):
+      k = 0
+      for j in range(nterms):
+          if d[j] == 0.0:
+              U[k] = a[j]
+              V[k] = 1.0
+              k += 1
+          else:
+              U[k] = a[j]*cos(d[j]*ts[i])
+              U[k+1] = a[j]*sin(d[j]*ts[i])
+              V[k] = cos(d[j]*ts[i])
+              V[k+1] = sin(d[j]*ts[i])
+              k += 2
+
+      if tlast == tlast:
+          dt = ts[i] - tlast
+          for k in range(J):
+              phi[k] = exp(-cs[k]*dt)
+
+          for k in range(J):
+              for l in range(J):
+                  S[k,l] = phi[k]*phi[l]*(S[k,l] + Dprev*W[k]*W[l])
+              f[k] = phi[k]*(f[k] + W[k]*zprev)
+
+      D = A + sigma0*sigma0/counts[i]
+      z = rs[i]
+      for k in range(J):
+          SU[k] = 0.0
+          for l in range(J):
+              SU[k] += S[k,l]*U[l]
+          D -= U[k]*SU[k]
+          z -= U[k]*f[k]
+
+      if not D > 0.0:
+          # Not positive-definite
+          return -INFINITY
+
+      for k in range(J):
+          W[k] = (V[k] - SU[k])/D
+
+      ll -= 0.5*(log(2.0*M_PI*D) + z*z/D)
+
+      Dprev = D
+      zprev = z
+      tlast = ts[i]
+
+  state[0] = tlast
+  state[1] = Dprev
+  state[2] = zprev
+
+  return ll
+
+cpdef ou_loglikelihood_gradient(double[:] ts, double[:] rs,
+                                double sigma0, double sigma, double tau,
+                                double[:] drs, double[:] counts=None):
+  """Returns ``(ll, dsigma0, dsigma, dtau)``, the log-likelihood of
+  :func:`ou_loglikelihood` and its derivatives with respect to the
+  noise parameters, and stores its gradient with respect to the
+  residuals in ``drs``.
+
+  The noise-parameter derivatives are propagated forward through the
+  Kalman filter alongside it, and the residual gradient is accumulated
+  by a backward pass over the filter, so the cost is O(N).  If the
+  covariance is not positive-definite, ``ll`` is ``-inf`` and the
+  derivatives are zero."""
+  cdef int i, k, nts=ts.shape[0]
+  cdef double v, s2, m, P, Pp, S, a, d, K, ll
+  cdef double dv[3]
+  cdef double ds2[3]
+  cdef double dm[3]
+  cdef double dP[3]
+  cdef double dPp[3]
+  cdef double dS[3]
+  cdef double dK[3]
+  cdef double da[3]
+  cdef double dd, dll[3]
+  cdef double mbar, mplusbar, dbar
+  cdef double[:] phis = np.zeros(nts), gains = np.zeros(nts), Ss = np.zeros(nts), ds = np.zeros(nts)
+
+  if counts is None:
+      counts = np.ones(nts)
+
+  v = sigma*sigma/(2.0*tau)
+  dv[0] = 0.0
+  dv[1] = sigma/tau
+  dv[2] = -v/tau
+
+  m = 0.0
+  P = v
+  ll = 0.0
+  for k in range(3):
+      dm[k] = 0.0
+      dP[k] = dv[k]
+      dll[k] = 0.0
+      da[k] = 0.0
+
+  for i in range(nts):
+      s2 = sigma0*sigma0/counts[i]
+      ds2[0] = 2.0*sigma0/counts[i]
+      ds2[1] = 0.0
+      ds2[2] = 0.0
+
+      if i == 0:
+          a = 0.0
+          Pp = v
+          for k in range(3):
+              dPp[k] = dv[k]
+      else:
+          a = exp(-fabs(ts[i] - ts[i-1])/tau)
+          da[2] = a*fabs(ts[i] - ts[i-1])/(tau*tau)
+          for k in range(3):
+              dm[k] = da[k]*m + a*dm[k]
+              dPp[k] = dv[k] + 2.0*a*da[k]*(P - v) + a*a*(dP[k] - dv[k])
+          m = a*m
+          Pp = v + a*a*(P - v)
+
+      S = Pp + s2
+      if not S > 0.0:
+          # Not positive-definite
+          for i in range(nts):
+              drs[i] = 0.0
+          return -INFINITY, 0.0, 0.0, 0.0
+      d = rs[i] - m
+      K = Pp/S
+
+      ll -= 0.5*(log(2.0*M_PI*S) + d*d/S)
+
+      for k in range(3):
+          dS[k] = dPp[k] + ds2[k]
+          dd = -dm[k]
+          dll[k] -= 0.5*(dS[k]/S + 2.0*d*dd/S - d*d*dS[k]/(S*S))
+          dK[k] = dPp[k]/S - Pp*dS[k]/(S*S)
+          dm[k] = dm[k] + dK[k]*d + K*dd
+          dP[k] = (dPp[k]*s2 + Pp*ds2[k])/S - Pp*s2*dS[k]/(S*S)
+
+      phis[i] = a
+      gains[i] = K
+      Ss[i] = S
+      ds[i] = d
+
+      m += K*d
+      P = Pp*s2/S
+
+  # Backward pass for the residual gradient
+  mbar = 0.0
+  for i in range(nts-1, -1, -1):
+      if i == nts-1:
+          mplusbar = 0.0
+      else:
+          mplusbar = phis[i+1]*mbar
+      dbar = -ds[i]/Ss[i] + gains[i]*mplusbar
+      drs[i] = dbar
+      mbar = mplusbar - dbar
+
+  return ll, dll[0], dll[1], dll[2]
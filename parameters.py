@@ -4,8 +4,8 @@ class Parameters(np.ndarray):
     """Parameters for radial velocity fitting for a single telescope
     observing a single planet."""
 
-    def __new__(subclass, arr=None, nobs=1, npl=1, 
-                V=None, sigma0=None, sigma=None, tau=None, K=None, n=None, chi=None, e=None, omega=None):
+    def __new__(subclass, arr=None, nobs=1, npl=1, nterms=0, reduced=False,
+                V=None, sigma0=None, sigma=None, tau=None, K=None, n=None, chi=None, e=None, omega=None, terms=None):
         r"""Create a parameter object out of the given array (or a
         fresh array, if none given), with nobs observatories and npl
         planets.
@@ -16,6 +16,15 @@ class Parameters(np.ndarray):
 
         :param npl: The number of planets in the parameters.
 
+        :param nterms: The number of additional correlated noise
+          terms for each observatory, either a single number for all
+          observatories or a sequence with one entry per observatory.
+
+        :param reduced: If ``True``, the parameters omit the
+          parameters ``V`` and ``K``, which enter the model linearly
+          and can be marginalized analytically; each observatory then
+          has 3 parameters and each planet 4.
+
         :param V: The amplitude of the velocity offset in each
           observatory.
 
@@ -42,18 +51,36 @@ class Parameters(np.ndarray):
 
         :param e: The eccentricity.
 
-        :param omega: The argument of periapse."""
+        :param omega: The argument of periapse.
+
+        :param terms: The additional noise terms; a list with one
+          entry for each observatory of shape ``(..., nterms, 3)``,
+          giving ``(sigma, tau, nu)`` for each term.  Each term adds
+          a damped oscillation to the noise correlation function:
+
+          ..math ::
+
+            \left\langle v_i v_j \right\rangle = \frac{\sigma^2}{2\tau} \exp\left[ -\frac{\left| t_i - t_j \right|}{\tau} \right] \cos\left( \nu \left| t_i - t_j \right| \right)
+
+          A term with ``nu = 0`` is another exponential term."""
         assert nobs >= 1, 'must have at least one observatory'
         assert npl >= 0, 'must have nonnegative number of planets'
-        assert arr is None or arr.shape[-1] == 4*nobs+5*npl, 'final array dimensions must match 4*nobs + 5*npl'
+
+        nterms = normalize_nterms(nterms, nobs)
+        
+        N = ndim(nobs, npl, nterms, reduced)
+
+        assert arr is None or arr.shape[-1] == N, 'final array dimensions must match 4*nobs + 5*npl + 3*sum(nterms) (3*nobs + 4*npl + 3*sum(nterms) if reduced)'
 
         if arr is None:
-            arr = np.zeros(nobs*4+npl*5)
+            arr = np.zeros(N)
         
         obj = np.asarray(arr).view(subclass)
 
         obj._nobs = nobs
         obj._npl = npl
+        obj._nterms = nterms
+        obj._reduced = reduced
 
         if V is not None:
             obj.V = V
@@ -82,6 +109,9 @@ class Parameters(np.ndarray):
         if omega is not None:
             obj.omega = omega
 
+        if terms is not None:
+            obj.terms = terms
+
         return obj
 
     def __array_finalize__(self, other):
@@ -90,6 +120,8 @@ class Parameters(np.ndarray):
         else:
             self._nobs = getattr(other, 'nobs', 1)
             self._npl = getattr(other, 'npl', 1)
+            self._nterms = getattr(other, 'nterms', (0,)*self._nobs)
+            self._reduced = getattr(other, 'reduced', False)
 
     @property
     def header(self):
@@ -102,14 +134,23 @@ class Parameters(np.ndarray):
             for i in range(self.nobs):
                 header += 'V%d sigma0%d sigma%d tau%d '%(i,i,i,i)
 
-        if self.npl == 0:
-            header = header[:-1] + '\n'
-        elif self.npl == 1:
-            header += 'K n chi e omega\n'
-        else:
+        if self.npl == 1:
+            header += 'K n chi e omega '
+        elif self.npl > 1:
             for i in range(self.npl):
                 header += 'K%d n%d chi%d e%d omega%d '%(i,i,i,i,i)
-            header = header[:-1] + '\n'
+
+        if self.reduced:
+            header = ' '.join([h for h in header.split(' ') if not (h.startswith('V') or h.startswith('K'))])
+
+        for i, nt in enumerate(self.nterms):
+            for j in range(1, nt+1):
+                if self.nobs == 1:
+                    header += 'sigma_%d tau_%d nu_%d '%(j,j,j)
+                else:
+                    header += 'sigma%d_%d tau%d_%d nu%d_%d '%(i,j,i,j,i,j)
+
+        header = header[:-1] + '\n'
         
         return header
 
@@ -147,134 +188,175 @@ class Parameters(np.ndarray):
                 header.append(r'e_{%d}'%i)
                 header.append(r'\omega_{%d}'%i)
 
+        if self.reduced:
+            header = [h for h in header if not (h.startswith('V') or h.startswith('K'))]
+
+        for i, nt in enumerate(self.nterms):
+            for j in range(1, nt+1):
+                if self.nobs == 1:
+                    header.append(r'\sigma_{%d}'%j)
+                    header.append(r'\tau_{%d}'%j)
+                    header.append(r'\nu_{%d}'%j)
+                else:
+                    header.append(r'\sigma_{%d,%d}'%(i,j))
+                    header.append(r'\tau_{%d,%d}'%(i,j))
+                    header.append(r'\nu_{%d,%d}'%(i,j))
+
         return header
 
     @property
     def V(self):
-        """The velocity offset of the observatory or observatories."""
-        return np.array(self[...,0:4*self.nobs:4])
+        """The velocity offset of the observatory or observatories.
+        Empty for reduced parameters."""
+        if self.reduced:
+            return np.zeros(self.shape[:-1] + (0,))
+        return np.array(self[...,self._obs_slice(0)])
 
     @V.setter
     def V(self, vs):
-        if self.nobs == 1:
-            self[..., 0] = vs
-        else:
-            self[...,0:4*self.nobs:4] = vs
+        if self.reduced:
+            raise AttributeError('reduced parameters have no V')
+        self._set_field(self._obs_slice(0), self.nobs, vs)
        
     @property
     def sigma0(self):
         """The white noise magnitude."""
-        return np.array(self[...,1:4*self.nobs:4])
+        return np.array(self[...,self._obs_slice(1)])
 
     @sigma0.setter
     def sigma0(self, s0):
-        if self.nobs == 1:
-            self[...,1]=s0
-        else:
-            self[...,1:4*self.nobs:4] = s0
+        self._set_field(self._obs_slice(1), self.nobs, s0)
 
     @property
     def sigma(self):
         """The variance at zero lag of the telescope errors."""
-        return np.array(self[...,2:4*self.nobs:4])
+        return np.array(self[...,self._obs_slice(2)])
 
     @sigma.setter
     def sigma(self, s0):
-        if self.nobs == 1:
-            self[...,2]=s0
-        else:
-            self[...,2:4*self.nobs:4] = s0
+        self._set_field(self._obs_slice(2), self.nobs, s0)
         
     @property
     def tau(self):
         """The exponential decay timescale for correlations in
         telescope errors."""
-        return np.array(self[...,3:4*self.nobs:4])
+        return np.array(self[...,self._obs_slice(3)])
 
     @tau.setter
     def tau(self, t):
-        if self.nobs == 1:
-            self[...,3] = t
-        else:        
-            self[...,3:4*self.nobs:4] = t
+        self._set_field(self._obs_slice(3), self.nobs, t)
         
     @property
     def K(self):
-        """The amplitude of the radial velocity."""
-        return np.array(self[...,4*self.nobs::5])
+        """The amplitude of the radial velocity.  Empty for reduced
+        parameters."""
+        if self.reduced:
+            return np.zeros(self.shape[:-1] + (0,))
+        return np.array(self[...,self._planet_slice(0)])
         
     @K.setter
     def K(self, k):
-        if self.npl == 1:
-            self[...,4*self.nobs] = k
-        else:
-            self[...,4*self.nobs::5] = k
+        if self.reduced:
+            raise AttributeError('reduced parameters have no K')
+        self._set_field(self._planet_slice(0), self.npl, k)
 
     @property
     def n(self):
         """Mean motion (2*pi/P)."""
-        return np.array(self[...,4*self.nobs+1::5])
+        return np.array(self[...,self._planet_slice(1)])
 
     @n.setter
     def n(self, nn):
-        if self.npl == 1:
-            self[..., 4*self.nobs+1] = nn
-        else:
-            self[...,4*self.nobs+1::5] = nn
+        self._set_field(self._planet_slice(1), self.npl, nn)
         
     @property
     def chi(self):
         """The fraction of an orbit completed at t = 0."""
-        return np.array(self[...,4*self.nobs+2::5])
+        return np.array(self[...,self._planet_slice(2)])
 
     @chi.setter
     def chi(self, c):
-        if self.npl == 1:
-            self[...,4*self.nobs+2] = c
-        else:
-            self[...,4*self.nobs+2::5] = c
+        self._set_field(self._planet_slice(2), self.npl, c)
         
     @property
     def e(self):
         """The orbital eccentricity."""
-        return np.array(self[...,4*self.nobs+3::5])
+        return np.array(self[...,self._planet_slice(3)])
 
     @e.setter
     def e(self, ee):
-        if self.npl == 1:
-            self[...,4*self.nobs+3]=ee
-        else:
-            self[...,4*self.nobs+3::5]=ee
+        self._set_field(self._planet_slice(3), self.npl, ee)
         
     @property
     def omega(self):
         """The longitude of perastron."""
-        return np.array(self[...,4*self.nobs+4::5])
+        return np.array(self[...,self._planet_slice(4)])
         
     @omega.setter
     def omega(self, o):
-        if self.npl == 1:
-            self[...,4*self.nobs+4] = o
-        else:
-            self[...,4*self.nobs+4::5]=o
+        self._set_field(self._planet_slice(4), self.npl, o)
+
+    @property
+    def terms(self):
+        """A list with one entry per observatory of the additional
+        noise terms, each of shape ``(..., nterms, 3)`` giving
+        ``(sigma, tau, nu)`` for each term."""
+        terms=[]
+        istart=self._iterms
+        for nt in self.nterms:
+            shape=self.shape[:-1] + (nt, 3)
+            terms.append(np.reshape(np.array(self[...,istart:istart+3*nt]), shape))
+            istart += 3*nt
+        return terms
+
+    @terms.setter
+    def terms(self, ts):
+        istart=self._iterms
+        for nt, t in zip(self.nterms, ts):
+            t=np.asarray(t)
+            self[...,istart:istart+3*nt] = np.reshape(t, t.shape[:-2] + (3*nt,))
+            istart += 3*nt
 
     @property
     def obs(self):
-        """Returns an (N,4) array of observatory parameters."""
-        return np.reshape(self[:4*self.nobs], (-1, 4))
+        """Returns an (N,4) array of observatory parameters ((N,3) if
+        reduced)."""
+        return np.reshape(self[:self._iplanets], (-1, self._obs_stride))
 
     @obs.setter
     def obs(self, o):
-        self[:4*self.nobs] = o
+        self[:self._iplanets] = o
 
     @property
     def planets(self):
-        """Returns an (N,5) array of planet parameters."""
-        return np.reshape(self[4*self.nobs:], (-1, 5))
+        """Returns an (N,5) array of planet parameters ((N,4) if
+        reduced)."""
+        return np.reshape(self[self._iplanets:self._iterms], (-1, self._planet_stride))
 
     @planets.setter
     def planets(self, p):
-        self[4*self.nobs:] = p
+        self[self._iplanets:self._iterms] = p
+
+    @property
+    def noise_mask(self):
+        """A boolean array over the parameters selecting the
+        observatory parameters (``V`` and the noise parameters) and
+        the additional noise terms, as opposed to the planet
+        parameters."""
+        mask = np.ones(self.shape[-1], dtype=bool)
+        mask[self._iplanets:self._iterms] = False
+        return mask
+
+    @property
+    def layout(self):
+        """The :class:`Layout` of these parameters."""
+        return layout(self.nobs, self.npl, self.nterms, self.reduced)
+
+    def to_sampling(self):
+        """Returns a plain array of the sampling coordinates of these
+        parameters (see :class:`Layout`); :func:`from_sampling`
+        inverts it."""
+        return self.layout.to_sampling(self)
 
     @property
     def nobs(self):
@@ -284,6 +366,292 @@ class Parameters(np.ndarray):
     def npl(self):
         return self._npl
 
+    @property
+    def nterms(self):
+        """Tuple of the number of additional noise terms for each
+        observatory."""
+        return self._nterms
+
+    @property
+    def reduced(self):
+        """Whether these are reduced parameters, from which the
+        linear parameters ``V`` and ``K`` have been removed (see
+        :meth:`LogLikelihood.marginalize
+        <correlated_likelihood.LogLikelihood>`)."""
+        return self._reduced
+
+    def to_reduced(self):
+        """Returns a copy of these parameters with ``V`` and ``K``
+        removed."""
+        if self.reduced:
+            return self.copy()
+
+        r = Parameters(np.zeros(self.shape[:-1] + (ndim(self.nobs, self.npl, self.nterms, reduced=True),)),
+                       nobs=self.nobs, npl=self.npl, nterms=self.nterms, reduced=True)
+        for i in range(1, 4):
+            r[..., r._obs_slice(i)] = self[..., self._obs_slice(i)]
+        for i in range(1, 5):
+            r[..., r._planet_slice(i)] = self[..., self._planet_slice(i)]
+        r[..., r._iterms:] = self[..., self._iterms:]
+
+        return r
+
+    def to_full(self, V, K):
+        """Returns a copy of these (reduced) parameters with the
+        linear parameters ``V``, shape ``(..., nobs)``, and ``K``,
+        shape ``(..., npl)``, filled in."""
+        if not self.reduced:
+            raise ValueError('parameters are not reduced')
+
+        p = Parameters(np.zeros(self.shape[:-1] + (ndim(self.nobs, self.npl, self.nterms),)),
+                       nobs=self.nobs, npl=self.npl, nterms=self.nterms)
+        p[..., p._obs_slice(0)] = V
+        for i in range(1, 4):
+            p[..., p._obs_slice(i)] = self[..., self._obs_slice(i)]
+        p[..., p._planet_slice(0)] = K
+        for i in range(1, 5):
+            p[..., p._planet_slice(i)] = self[..., self._planet_slice(i)]
+        p[..., p._iterms:] = self[..., self._iterms:]
+
+        return p
+
+    @property
+    def _obs_stride(self):
+        if self._reduced:
+            return 3
+        else:
+            return 4
+
+    @property
+    def _planet_stride(self):
+        if self._reduced:
+            return 4
+        else:
+            return 5
+
+    @property
+    def _iplanets(self):
+        # Index of the first planet parameter
+        return self._obs_stride*self.nobs
+
+    @property
+    def _iterms(self):
+        # Index of the first additional noise term parameter
+        return self._iplanets + self._planet_stride*self.npl
+
+    def _obs_slice(self, i):
+        # Slice selecting field i = (V, sigma0, sigma, tau) of all
+        # observatories
+        if self._reduced:
+            i -= 1
+        return slice(i, self._iplanets, self._obs_stride)
+
+    def _planet_slice(self, i):
+        # Slice selecting field i = (K, n, chi, e, omega) of all
+        # planets
+        if self._reduced:
+            i -= 1
+        return slice(self._iplanets + i, self._iterms, self._planet_stride)
+
+    def _set_field(self, sl, nfield, value):
+        if nfield == 1:
+            self[..., sl.start] = value
+        else:
+            self[..., sl] = value
+
     @property
     def P(self):
         return 2.0*np.pi/self.n
+
+def normalize_nterms(nterms, nobs):
+    """Returns a tuple giving the number of additional noise terms for
+    each of ``nobs`` observatories, from either a single number for
+    all observatories or a sequence with one entry per observatory."""
+    if np.isscalar(nterms):
+        return (int(nterms),)*nobs
+    else:
+        nterms=tuple(int(nt) for nt in nterms)
+        assert len(nterms) == nobs, 'must give number of noise terms for each observatory'
+        return nterms
+
+def ndim(nobs, npl, nterms=0, reduced=False):
+    """Returns the number of parameters for ``nobs`` observatories,
+    ``npl`` planets, and ``nterms`` additional noise terms (omitting
+    ``V`` and ``K`` if ``reduced``)."""
+    if reduced:
+        return 3*nobs+4*npl+3*sum(normalize_nterms(nterms, nobs))
+    else:
+        return 4*nobs+5*npl+3*sum(normalize_nterms(nterms, nobs))
+
+def npl_from_ndim(ndim, nobs, nterms=0, reduced=False):
+    """Returns the number of planets in a parameter vector of length
+    ``ndim`` with ``nobs`` observatories and ``nterms`` additional
+    noise terms (omitting ``V`` and ``K`` if ``reduced``)."""
+    if reduced:
+        return (ndim-3*nobs-3*sum(normalize_nterms(nterms, nobs)))//4
+    else:
+        return (ndim-4*nobs-3*sum(normalize_nterms(nterms, nobs)))//5
+
+class Layout(object):
+    r"""The positions of the fields in parameter vectors with ``nobs``
+    observatories, ``npl`` planets and ``nterms`` additional noise
+    terms (see :class:`Parameters`), computed once.
+
+    :meth:`fields` splits a vector into plain views of its fields,
+    without the per-access overhead of the :class:`Parameters`
+    properties.  The likelihood and prior read parameters this way;
+    :class:`Parameters` remains the interface for everything else.
+    Obtain layouts from :func:`layout`, which caches them.
+
+    :meth:`to_sampling` and :meth:`to_natural` convert between the
+    natural parameters and sampling coordinates, in which posteriors
+    are closer to Gaussian and samplers mix faster.  Each field keeps
+    its position, but
+
+    * the noise scales ``sigma0``, ``sigma`` and ``tau``, the
+      amplitude ``K``, and the amplitude and timescale of each
+      additional noise term are replaced by their logarithms;
+
+    * the mean motion ``n`` is replaced by :math:`\log P`;
+
+    * ``e`` and ``omega`` are replaced by :math:`\sqrt{e} \cos
+      \omega` and :math:`\sqrt{e} \sin \omega`, so that
+      :math:`\omega` is no longer a poorly-constrained coordinate at
+      small :math:`e`.
+
+    Densities over the natural parameters become densities over the
+    sampling coordinates after adding :meth:`log_jacobian`."""
+
+    def __init__(self, nobs=1, npl=1, nterms=0, reduced=False):
+        self.nobs = nobs
+        self.npl = npl
+        self.nterms = normalize_nterms(nterms, nobs)
+        self.reduced = reduced
+        self.ndim = ndim(nobs, npl, self.nterms, reduced)
+
+        p = Parameters(np.zeros(self.ndim), nobs=nobs, npl=npl, nterms=self.nterms, reduced=reduced)
+
+        empty = slice(0, 0)
+        self.V = empty if reduced else p._obs_slice(0)
+        self.sigma0 = p._obs_slice(1)
+        self.sigma = p._obs_slice(2)
+        self.tau = p._obs_slice(3)
+        self.K = empty if reduced else p._planet_slice(0)
+        self.n = p._planet_slice(1)
+        self.chi = p._planet_slice(2)
+        self.e = p._planet_slice(3)
+        self.omega = p._planet_slice(4)
+
+        self.terms = []
+        istart = p._iterms
+        for nt in self.nterms:
+            self.terms.append(slice(istart, istart+3*nt))
+            istart += 3*nt
+
+        # Indices of the scale parameters, which have logarithmic
+        # sampling coordinates
+        idx = np.arange(self.ndim)
+        scales = [idx[self.sigma0], idx[self.sigma], idx[self.tau], idx[self.K]]
+        scales += [np.reshape(idx[sl], (-1, 3))[:,0:2] for sl in self.terms]
+        self._iscales = np.concatenate([np.reshape(sc, -1) for sc in scales])
+
+    def fields(self, p):
+        """Returns the :class:`Fields` of the single parameter vector
+        ``p``, which should be a contiguous ``float64`` array (see
+        :func:`numpy.ascontiguousarray`)."""
+        return Fields(self, p)
+
+    def to_sampling(self, p):
+        """Returns the sampling coordinates of the natural parameters
+        ``p``, of shape ``(..., ndim)``, as a new array."""
+
+        p = np.asarray(p)
+        u = np.array(p, dtype=np.float64)
+
+        u[..., self._iscales] = np.log(p[..., self._iscales])
+        u[..., self.n] = np.log(2.0*np.pi/p[..., self.n])
+
+        sqrte = np.sqrt(p[..., self.e])
+        u[..., self.e] = sqrte*np.cos(p[..., self.omega])
+        u[..., self.omega] = sqrte*np.sin(p[..., self.omega])
+
+        return u
+
+    def to_natural(self, u):
+        r"""Returns the natural parameters at the sampling coordinates
+        ``u``, of shape ``(..., ndim)``, as a new array, with
+        ``omega`` in :math:`[0, 2\pi)`."""
+
+        u = np.asarray(u)
+        p = np.array(u, dtype=np.float64)
+
+        p[..., self._iscales] = np.exp(u[..., self._iscales])
+        p[..., self.n] = 2.0*np.pi*np.exp(-u[..., self.n])
+
+        h = u[..., self.e]
+        k = u[..., self.omega]
+        p[..., self.e] = h*h + k*k
+        p[..., self.omega] = np.mod(np.arctan2(k, h), 2.0*np.pi)
+
+        return p
+
+    def log_jacobian(self, u):
+        r"""Returns the log of the Jacobian determinant
+        :math:`\left| \partial p/\partial u \right|` of the natural
+        parameters with respect to the sampling coordinates ``u``, of
+        shape ``(..., ndim)``, as an array of shape ``u.shape[:-1]``.
+
+        Each scale :math:`x = e^u` contributes :math:`\log x = u`, each
+        mean motion :math:`n = 2\pi/P` contributes :math:`\log n`,
+        and each planet's :math:`(e, \omega)` a constant :math:`\log
+        2`, the area of the map from :math:`\sqrt{e} (\cos \omega,
+        \sin \omega)`."""
+
+        u = np.asarray(u)
+
+        return (np.sum(u[..., self._iscales], axis=-1)
+                + np.sum(np.log(2.0*np.pi) - u[..., self.n], axis=-1)
+                + self.npl*np.log(2.0))
+
+class Fields(object):
+    """Views of the fields of a parameter vector, as arrays over the
+    observatories (``V``, ``sigma0``, ``sigma``, ``tau``), the planets
+    (``K``, ``n``, ``chi``, ``e``, ``omega``), and a list of the
+    ``(nterms, 3)`` additional noise terms of each observatory.  See
+    :meth:`Layout.fields`."""
+
+    __slots__ = ('nobs', 'npl', 'V', 'sigma0', 'sigma', 'tau', 'K', 'n', 'chi', 'e', 'omega', 'terms')
+
+    def __init__(self, layout, p):
+        self.nobs = layout.nobs
+        self.npl = layout.npl
+
+        self.V = p[layout.V]
+        self.sigma0 = p[layout.sigma0]
+        self.sigma = p[layout.sigma]
+        self.tau = p[layout.tau]
+        self.K = p[layout.K]
+        self.n = p[layout.n]
+        self.chi = p[layout.chi]
+        self.e = p[layout.e]
+        self.omega = p[layout.omega]
+        self.terms = [np.reshape(p[sl], (-1, 3)) for sl in layout.terms]
+
+_layouts = {}
+
+def layout(nobs=1, npl=1, nterms=0, reduced=False):
+    """Returns the :class:`Layout` of parameters with ``nobs``
+    observatories, ``npl`` planets and ``nterms`` additional noise
+    terms, building it on first use."""
+
+    key = (nobs, npl, normalize_nterms(nterms, nobs), reduced)
+    try:
+        return _layouts[key]
+    except KeyError:
+        _layouts[key] = Layout(*key)
+        return _layouts[key]
+
+def from_sampling(u, nobs=1, npl=1, nterms=0, reduced=False):
+    """Returns the :class:`Parameters` at the sampling coordinates
+    ``u`` (see :class:`Layout`)."""
+    return Parameters(layout(nobs, npl, nterms, reduced).to_natural(u), nobs=nobs, npl=npl, nterms=nterms, reduced=reduced)
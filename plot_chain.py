@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 from argparse import ArgumentParser
+import chain_io as cio
 import matplotlib.pyplot as pp
 import numpy as np
 import os
@@ -61,7 +62,7 @@ def do_plot(ichain, name, tname, true, outdir, mmin=None, mmax=None, periodic=Fa
 if __name__ == '__main__':
     parser=ArgumentParser()
 
-    parser.add_argument('--input', metavar='FILE', required=True, help='input chain')
+    parser.add_argument('--input', metavar='FILE', required=True, help='input chain (binary chain file, text chain file or prefix of either)')
     parser.add_argument('--outdir', metavar='DIR', default=None, help='output directory')
     parser.add_argument('--trueparams', metavar='FILE', default=None, help='true parameters')
 
@@ -69,25 +70,17 @@ if __name__ == '__main__':
 
     parser.add_argument('--fburnin', metavar='F', default=0.1, type=float, help='fixed fraction of samples to discard as burnin')
 
-    parser.add_argument('--nwalkers', metavar='N', default=100, type=int, help='number of ensemble walkers')
-
-    parser.add_argument('--npl', metavar='N', default=1, type=int, help='number of planets')
-    parser.add_argument('--nobs', metavar='N', default=1, type=int, help='number of observatories')
+    parser.add_argument('--nwalkers', metavar='N', default=None, type=int, help='number of ensemble walkers (only for text chains without an accept file)')
 
     args=parser.parse_args()
 
-    pts=np.loadtxt(args.input)
-
-    # (Nsamples, Ntemps, Nwalkers, Ndim)
-    pts=np.reshape(pts, (-1, args.nwalkers, pts.shape[-1]))
-
-    logls=pts[..., 0]
-    chain=pr.Parameters(pts[..., 2:], npl=args.npl, nobs=args.nobs)
+    reader=cio.ChainReader(args.input, nwalkers=args.nwalkers)
 
-    istart=int(args.fburnin*chain.shape[0] + 0.5)
+    # (Nsamples, Nwalkers, Ndim) at the lowest temperature
+    istart=int(args.fburnin*reader.nsamples + 0.5)
 
-    logls=logls[istart:, :]
-    chain=chain[istart:, ...]
+    logls=np.array(reader.logl[istart:, 0, :], dtype=np.float64)
+    chain=reader.parameters(samples=slice(istart, None), temps=0)
 
     chain,logls = pu.burned_in_samples(chain, logls)
     
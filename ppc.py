@@ -2,6 +2,7 @@
 
 import acor
 from argparse import ArgumentParser
+import chain_io as cio
 import correlated_likelihood as cl
 import numpy as np
 import scipy.stats as ss
@@ -9,14 +10,13 @@ import scipy.stats as ss
 if __name__ == '__main__':
     parser=ArgumentParser()
 
-    parser.add_argument('--input', required=True, metavar='FILE', help='input chain file')
+    parser.add_argument('--input', required=True, metavar='FILE', help='input chain (binary chain file, text chain file or prefix of either)')
     parser.add_argument('--rvs', required=True, metavar='FILE', default=[], action='append',
                         help='radial velocity file(s)')
 
     parser.add_argument('--output', required=True, metavar='FILE', help='output quantile file')
 
-    parser.add_argument('--npl', default=1, type=int, metavar='N', help='number of planets')
-    parser.add_argument('--nwalkers', default=100, type=int, metavar='N', help='number of walkers')
+    parser.add_argument('--nwalkers', default=None, type=int, metavar='N', help='number of walkers (only for text chains without an accept file)')
     parser.add_argument('--fburnin', default=0.1, type=float, metavar='N', help='fraction of samples to discard as burnin')
 
     args=parser.parse_args()
@@ -28,11 +28,13 @@ if __name__ == '__main__':
         ts.append(data[:,0])
         rvs.append(data[:,1])
 
-    params=np.loadtxt(args.input)
-    params=params[:,2:]
-    params=np.reshape(params, (-1, args.nwalkers, params.shape[-1]))
+    reader=cio.ChainReader(args.input, nwalkers=args.nwalkers)
+    if reader.nobs != len(ts):
+        parser.error('the chain must have one observatory per --rvs file')
+    if reader.marginalize == 'profile':
+        parser.error('the chain holds best-fit offsets and amplitudes, not posterior draws (run.py --marginalize profile)')
 
-    params=params[int(args.fburnin*params.shape[0]+0.5):, ...]
+    params=reader.parameters(samples=slice(int(args.fburnin*reader.nsamples+0.5), None), temps=0)
 
     taumax=float('-inf')
     for k in range(params.shape[-1]):
@@ -44,9 +46,9 @@ if __name__ == '__main__':
 
     print 'Averaging ', params.shape[0]*params.shape[1], ' posterior quantiles'
 
-    params=np.reshape(params, (-1, params.shape[-1]))
+    params=np.reshape(np.asarray(params), (-1, params.shape[-1]))
 
-    qs=cl.posterior_data_mean_quantiles(ts, rvs, params)
+    qs=cl.posterior_data_mean_quantiles(ts, rvs, params, npl=reader.npl, nterms=reader.nterms)
 
     D,p = ss.kstest(qs, lambda x: x)
 
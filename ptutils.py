@@ -1,6 +1,260 @@
 import acor
 import numpy as np
 
+class WalkerKeys(object):
+    """Names the walkers whose points an :class:`emcee.PTSampler`
+    passes to its pool, by ``(temperature, index)`` as
+    :class:`blocked_sampler.BlockedPTSampler` does, so that a
+    likelihood constructed with ``warm_start`` can reuse the
+    eccentric anomalies of each walker's previous evaluation.
+
+    The sampler evaluates its initial ensemble in one call, ordered by
+    temperature and then walker, and after that alternate halves of
+    the walkers (the even, then the odd indices at each temperature),
+    also ordered by temperature.  The keys follow that order.  After a
+    temperature swap a key names a different walker; its stale
+    solution then only costs a cold start of the solver."""
+
+    def __init__(self, ntemps, nwalkers):
+        self._ntemps = ntemps
+        self._nwalkers = nwalkers
+        self._parity = 0
+
+    def __call__(self, npts):
+        """Returns the keys of the ``npts`` points of the sampler's
+        next call to ``map``."""
+
+        if npts == self._ntemps*self._nwalkers:
+            self._parity = 0
+            return [divmod(i, self._nwalkers) for i in range(npts)]
+        elif npts == self._ntemps*(self._nwalkers//2):
+            half = self._nwalkers//2
+            parity = self._parity
+            self._parity = 1 - parity
+            return [(i // half, 2*(i % half) + parity) for i in range(npts)]
+        else:
+            raise ValueError('expected %d or %d points, not %d'%(self._ntemps*self._nwalkers, self._ntemps*(self._nwalkers//2), npts))
+
+class _WalkerLikelihood(object):
+    # Evaluates the likelihood at a (point, walker) pair, for mapping
+    # over a pool.
+    def __init__(self, log_likelihood):
+        self._log_likelihood = log_likelihood
+
+    def __call__(self, args):
+        p, walker = args
+        return self._log_likelihood(p, walker=walker)
+
+class EnsemblePool(object):
+    """A stand-in for a multiprocessing pool that lets a
+    :class:`emcee.PTSampler` evaluate all of its walkers in one batched
+    call to :meth:`LogPrior.batch` and :meth:`LogLikelihood.batch`
+    instead of one Python call per walker.
+
+    Pass as ``PTSampler(..., pool=EnsemblePool(log_likelihood,
+    log_prior))``."""
+
+    def __init__(self, log_likelihood, log_prior):
+        self._log_likelihood = log_likelihood
+        self._log_prior = log_prior
+
+    @property
+    def log_likelihood(self):
+        return self._log_likelihood
+
+    @property
+    def log_prior(self):
+        return self._log_prior
+
+    def map(self, fn, pts):
+        """Returns a list of ``(logl, logp)`` for each of the points
+        in ``pts``.  The function ``fn`` (the sampler's per-walker
+        likelihood-prior wrapper) is ignored in favour of the batched
+        evaluations."""
+
+        pts = np.asarray(pts)
+
+        logps = self.log_prior.batch(pts)
+
+        # Like the sampler's wrapper, report logl = logp = -inf for
+        # points outside the prior, without evaluating the likelihood
+        # there.
+        logls = np.zeros(logps.shape[0]) + float('-inf')
+        inprior = logps > float('-inf')
+        if np.any(inprior):
+            with np.errstate(all='ignore'):
+                logls[inprior] = self.log_likelihood.batch(pts[inprior,:])
+
+        return zip(logls, logps)
+
+class PriorPool(object):
+    """A wrapper around a pool (or, by default, the builtin ``map``)
+    that evaluates the prior of all of a :class:`emcee.PTSampler`'s
+    proposals in one call to :meth:`LogPrior.batch`, and the
+    likelihood of only the points inside the prior.  Early in a run
+    many proposals fall outside the prior bounds or break the period
+    ordering; these cost neither a likelihood evaluation nor a trip to
+    a worker process.
+
+    With ``walker_keys`` (a :class:`WalkerKeys`), each likelihood
+    evaluation names its walker, for the ``warm_start`` cache of the
+    likelihood.  The cache is neither shared between processes nor
+    locked against concurrent threads, so ``pool`` should then be
+    ``None``.
+
+    Pass as ``PTSampler(..., pool=PriorPool(log_likelihood, log_prior,
+    pool))``."""
+
+    def __init__(self, log_likelihood, log_prior, pool=None, walker_keys=None):
+        self._log_likelihood = log_likelihood
+        self._log_prior = log_prior
+        self._pool = pool
+        self._walker_keys = walker_keys
+
+    @property
+    def log_likelihood(self):
+        return self._log_likelihood
+
+    @property
+    def log_prior(self):
+        return self._log_prior
+
+    @property
+    def pool(self):
+        return self._pool
+
+    def map(self, fn, pts):
+        """Returns a list of ``(logl, logp)`` for each of the points
+        in ``pts``.  The function ``fn`` (the sampler's per-walker
+        likelihood-prior wrapper) is ignored: the batched prior is
+        used as it is, and the likelihood alone is mapped over the
+        points inside the prior."""
+
+        pts = np.asarray(pts)
+
+        logps = self.log_prior.batch(pts)
+        inprior = np.nonzero(logps > float('-inf'))[0]
+
+        # Like the sampler's wrapper, report logl = logp = -inf for
+        # points outside the prior.
+        logls = np.zeros(pts.shape[0]) + float('-inf')
+
+        if self._walker_keys is not None:
+            keys = self._walker_keys(pts.shape[0])
+            fn = _WalkerLikelihood(self.log_likelihood)
+            args = [(pts[i,:], keys[i]) for i in inprior]
+        else:
+            fn = self.log_likelihood
+            args = pts[inprior,:]
+
+        if inprior.shape[0] > 0:
+            if self._pool is None:
+                logls[inprior] = map(fn, args)
+            else:
+                logls[inprior] = self._pool.map(fn, args)
+
+        return zip(logls, logps)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+
+class TemperedPool(object):
+    """A stand-in for a multiprocessing pool that lets a
+    :class:`emcee.PTSampler` solve Kepler's equation approximately,
+    with the tabulated solver of :func:`kepler.rv_residuals_table`, at
+    its hotter temperatures, where the tempered posterior is too broad
+    to notice the error.
+
+    Temperature swaps carry a walker's log-likelihood with it, so a
+    tabulated value can reach the colder temperatures, where the exact
+    one is needed.  The pool remembers the tabulated values it
+    returned; call :meth:`exact` on the state the sampler yields after
+    each step to replace them there.
+
+    Pass as ``PTSampler(..., betas=betas, pool=TemperedPool(log_likelihood,
+    log_prior, betas, beta_table))``."""
+
+    def __init__(self, log_likelihood, log_prior, betas, beta_table, walker_keys=None):
+        """:param log_likelihood: A
+          :class:`correlated_likelihood.LogLikelihood`.
+
+        :param log_prior: The log-prior.
+
+        :param betas: The inverse temperatures of the sampler.
+
+        :param beta_table: Temperatures with inverse temperature below
+          this use the tabulated solver; the others follow the
+          likelihood's own choice.
+
+        :param walker_keys: A :class:`WalkerKeys` naming the walker of
+          each exact evaluation, for the ``warm_start`` cache of the
+          likelihood."""
+
+        self._log_likelihood = log_likelihood
+        self._log_prior = log_prior
+        self._betas = np.asarray(betas)
+        self._beta_table = beta_table
+        self._walker_keys = walker_keys
+
+        # The tabulated log-likelihoods returned, still held by some
+        # walker.  A swap or relabeling moves a walker's value
+        # unchanged, so the value identifies it.
+        self._approximate = set()
+
+    def map(self, fn, pts):
+        """Returns a list of ``(logl, logp)`` for each of the points
+        in ``pts``, which the sampler passes ordered by temperature
+        (an equal number at each).  The function ``fn`` is ignored."""
+
+        pts = np.asarray(pts)
+        nper = pts.shape[0] // self._betas.shape[0]
+
+        logps = self._log_prior.batch(pts)
+
+        keys = [None]*pts.shape[0] if self._walker_keys is None else self._walker_keys(pts.shape[0])
+
+        results = []
+        for i, (p, logp) in enumerate(zip(pts, logps)):
+            if logp == float('-inf'):
+                results.append((logp, logp))
+            elif self._betas[i // nper] < self._beta_table:
+                logl = self._log_likelihood(p, approximate=True)
+                self._approximate.add(logl)
+                results.append((logl, logp))
+            else:
+                results.append((self._log_likelihood(p, walker=keys[i]), logp))
+
+        return results
+
+    def exact(self, pts, logls, lnprobs):
+        """Re-evaluates, with the exact solver, the log-likelihood of
+        every walker at a temperature with inverse temperature at
+        least ``beta_table`` that holds a tabulated value, updating
+        ``logls`` and ``lnprobs`` (the sampler's state, of shape
+        ``(ntemps, nwalkers)``) in place.  Returns the number of
+        walkers re-evaluated."""
+
+        nexact = 0
+        for k, beta in enumerate(self._betas):
+            if beta < self._beta_table:
+                continue
+
+            for j in range(logls.shape[1]):
+                if logls[k,j] in self._approximate:
+                    logl = self._log_likelihood(pts[k,j,:], approximate=False, walker=(k, j))
+                    if logl == logls[k,j]:
+                        # The table was exact here.
+                        self._approximate.discard(logl)
+                    lnprobs[k,j] += beta*(logl - logls[k,j])
+                    logls[k,j] = logl
+                    nexact += 1
+
+        # Forget the values no walker holds any more.
+        self._approximate.intersection_update(logls.flat)
+
+        return nexact
+
 def exponential_beta_ladder(ntemps):
     """Returns an array of betas (:math:`\\beta = 1/T`) exponentially
     distributed with a spacing factor of :math:`\\sqrt{2}`.
@@ -25,6 +279,84 @@ def thermodynamic_log_evidence(logls, betas):
 
     return -np.sum(mean_logls*np.diff(betas))
 
+def resample_ensemble(log_weights):
+    """Returns the indices of a systematic resampling of an ensemble
+    with the given (unnormalized) log-weights, and the effective
+    sample size of the weights.
+
+    :param log_weights: The log-weight of each walker, of shape
+      ``(Nwalkers,)``.
+
+    :return: ``(indices, ess)``, the walkers to copy into each slot of
+      the resampled ensemble, and :math:`(\\sum w)^2/\\sum w^2`."""
+
+    nwalkers = log_weights.shape[0]
+
+    ws = np.exp(log_weights - np.max(log_weights))
+    ws /= np.sum(ws)
+
+    ess = 1.0/np.sum(ws*ws)
+
+    us = (np.arange(nwalkers) + np.random.uniform())/nwalkers
+    indices = np.searchsorted(np.cumsum(ws), us)
+
+    return np.minimum(indices, nwalkers-1), ess
+
+def rejuvenate_ensemble(pts, logls, beta, log_likelihood, log_prior, cov, jitter=0.1, nsteps=5):
+    """Spreads out an ensemble that :func:`resample_ensemble` has
+    filled with copies of fewer walkers.  Each copy of a walker after
+    the first is displaced by a Gaussian jitter of covariance
+    ``jitter**2*cov`` (kept only if it stays inside the prior), and
+    then every walker takes ``nsteps`` Metropolis-Hastings steps
+    targeting the posterior at inverse temperature ``beta``, with
+    Gaussian proposals of covariance ``2.38**2/Ndim*cov``.
+
+    :param pts: The resampled walkers, of shape ``(Nwalkers, Ndim)``.
+
+    :param logls: Their log-likelihoods, of shape ``(Nwalkers,)``.
+
+    :param cov: The covariance of the ensemble before resampling, of
+      shape ``(Ndim, Ndim)``, which still has full rank.
+
+    :return: ``(pts, logls, logps)``, the new walkers, their
+      log-likelihoods and their log-priors."""
+
+    pts = np.array(pts)
+    logls = np.array(logls)
+    nwalkers, ndim = pts.shape
+
+    def evaluate(qs):
+        logps = log_prior.batch(qs)
+        logls = np.zeros(qs.shape[0]) + float('-inf')
+        for i in np.nonzero(logps > float('-inf'))[0]:
+            logls[i] = log_likelihood(qs[i,:])
+        return logls, logps
+
+    copies = np.array([i for i in range(nwalkers) if np.any(np.all(pts[:i,:] == pts[i,:], axis=1))], dtype=int)
+    if copies.shape[0] > 0:
+        qs = pts[copies,:] + jitter*np.random.multivariate_normal(np.zeros(ndim), cov, size=copies.shape[0])
+        qlogls, qlogps = evaluate(qs)
+        inside = qlogps > float('-inf')
+        pts[copies[inside],:] = qs[inside,:]
+        logls[copies[inside]] = qlogls[inside]
+
+    logps = log_prior.batch(pts)
+
+    scale = 2.38/np.sqrt(ndim)
+    for i in range(nsteps):
+        qs = pts + scale*np.random.multivariate_normal(np.zeros(ndim), cov, size=nwalkers)
+        qlogls, qlogps = evaluate(qs)
+
+        with np.errstate(invalid='ignore'):
+            lnratio = beta*(qlogls - logls) + qlogps - logps
+        accept = np.log(np.random.uniform(size=nwalkers)) < lnratio
+
+        pts[accept,:] = qs[accept,:]
+        logls[accept] = qlogls[accept]
+        logps[accept] = qlogps[accept]
+
+    return pts, logls, logps
+
 def burned_in_samples(pts, logls):
     """Automatic burn-in criterion.  
 
@@ -2,12 +2,17 @@
 
 import acor
 from argparse import ArgumentParser
+from blocked_sampler import BlockedPTSampler
+import chain_io as cio
 import correlated_likelihood as cl
 from gzip import GzipFile
+from multiprocessing.pool import Pool, ThreadPool
 import numpy as np
 import os
-from parameters import Parameters
-from emcee.ptsampler import PTSampler
+from parameters import Parameters, normalize_nterms
+from emcee.ptsampler import PTSampler, default_beta_ladder
+import ptutils as pt
+import rv_model as rv
 import tempfile
 import sys
 
@@ -22,13 +27,64 @@ def load_data(files):
 
     return ts,rvs
 
+def save_state(prefix, log_likelihood, pts, logls, lnprobs):
+    """Saves the final ensemble of a run to ``<prefix>.state.npz``
+    together with the noise filter state of each walker at the end of
+    the data, so that a later ``--update`` can follow new data
+    without recomputing the likelihood from scratch."""
+    ntemps, nwalkers = logls.shape
+
+    states=[np.zeros((ntemps, nwalkers, st.shape[0])) for st in log_likelihood.empty_states()]
+    for k in range(ntemps):
+        for j in range(nwalkers):
+            sts=log_likelihood.empty_states()
+            log_likelihood.update(pts[k,j,:], sts, [0]*len(sts))
+            for st, s in zip(states, sts):
+                st[k,j,:] = s
+
+    # The state holds the natural parameters, whatever coordinates the
+    # sampler moved in.
+    arrays=dict(('state%02d'%i, st) for i, st in enumerate(states))
+    np.savez('%s.state.npz'%prefix, pts=np.asarray(log_likelihood.parameters(pts)), logls=logls, lnprobs=lnprobs,
+             ndata=np.array([t.shape[0] for t in log_likelihood.ts]),
+             tlast=np.array([t[-1] for t in log_likelihood.ts]),
+             **arrays)
+
+def canonicalize_walkers(log_prior, log_likelihood, pts):
+    """Replaces the walker positions ``pts`` in place by their
+    canonical forms under the wrapping prior ``log_prior`` (see
+    :meth:`correlated_likelihood.LogPrior.canonical`), so that the
+    ensemble stays within one period of ``chi`` and ``omega`` and one
+    labeling of the planets.  The samplers continue from the array
+    they yield, so this changes their state.  Walkers that move are
+    evicted from the likelihood's anomaly cache."""
+
+    canon = log_prior.canonical(pts)
+    moved = np.any(canon != pts, axis=-1)
+    pts[...] = canon
+
+    cache = log_likelihood.anomaly_cache
+    if cache is not None:
+        for k, j in zip(*np.nonzero(moved)):
+            cache.evict((k, j))
+
 if __name__ == '__main__':
     parser=ArgumentParser()
 
-    parser.add_argument('--prefix', metavar='PRE', default='chain', help='output prefix (files will be <prefix>.NN.txt.gz)')
+    parser.add_argument('--prefix', metavar='PRE', default='chain', help='output prefix (the chain will be <prefix>.chain, or <prefix>.NN.txt.gz with --chain-format text)')
+    parser.add_argument('--chain-format', choices=['binary', 'text'], default='binary', help='write the chain as a binary file (see chain_io.py, which also exports it to text), or as gzipped text')
+    parser.add_argument('--float32', action='store_true', help='store the binary chain in single precision')
 
     parser.add_argument('--nthreads', metavar='N', type=int, default=1, help='number of parallel threads')
+    parser.add_argument('--backend', choices=['processes', 'threads'], default='processes', help='run the --nthreads workers as processes (copying the data to each) or as threads sharing it')
+    parser.add_argument('--rv-backend', choices=rv.backends(), default=None, help='RV model backend (default: cython if the kepler extension is built, otherwise the fastest on this host by a short benchmark)')
+    parser.add_argument('--batch', action='store_true', help='evaluate the whole ensemble in one batched call per step')
+    parser.add_argument('--blocked', action='store_true', help='alternate updates of the observatory and planet parameters, reusing the noise factorization for the latter')
+    parser.add_argument('--marginalize', choices=['profile', 'marginal'], default=None, help='eliminate the linear parameters V and K analytically, sampling only the remaining parameters; the prior on V and K is then flat over all reals rather than the full prior, so the evidence is not comparable with that of full runs')
+    parser.add_argument('--sampling-coordinates', action='store_true', help='sample sqrt(e)cos(omega), sqrt(e)sin(omega), log(P) and the logs of K and the noise scales; the chains still store the usual parameters')
+    parser.add_argument('--wrap', action='store_true', help='treat chi and omega as periodic and relabel planets in order of period, instead of rejecting proposals outside their ranges or out of order')
     parser.add_argument('--nplanets', metavar='N', type=int, default=1, help='number of planets')
+    parser.add_argument('--nterms', metavar='N', type=int, default=[], action='append', help='number of additional correlated noise terms (once for all observatories, or once per observatory)')
     parser.add_argument('--nthin', metavar='N', type=int, default=10, help='iterations between output')
     parser.add_argument('--nensembles', metavar='N', type=int, default=100, help='number of ensembles to output')
 
@@ -38,42 +94,110 @@ if __name__ == '__main__':
     parser.add_argument('--nwalkers', metavar='N', type=int, default=100, help='number of walkers')
 
     parser.add_argument('--rvs', metavar='FILE', required=True, default=[], action='append', help='file of times and RV\'s')
+    parser.add_argument('--seasons', metavar='TOL', type=float, default=None, help='factor the noise covariance season by season, splitting at gaps with correlation below TOL')
+    parser.add_argument('--season-threads', metavar='N', type=int, default=1, help='number of threads factoring seasons in parallel')
+    parser.add_argument('--kepler-maxiter', metavar='N', type=int, default=None, help='solve Kepler\'s equation with at most N iterations, reporting solutions that do not converge')
+    parser.add_argument('--kepler-tol', metavar='TOL', type=float, default=1e-8, help='tolerance of the --kepler-maxiter solver')
+    parser.add_argument('--kepler-precision', metavar='DV', type=float, default=None, help='solve Kepler\'s equation from a table whenever its velocity error is below DV')
+    parser.add_argument('--kepler-table-beta', metavar='BETA', type=float, default=None, help='solve Kepler\'s equation from a table at temperatures with inverse temperature below BETA')
+    parser.add_argument('--warm-start', action='store_true', help='start the Kepler solver of each walker from its previous solution (not with --batch, --nthreads or --marginalize)')
+    parser.add_argument('--compress', metavar='DT', type=float, default=None, help='combine observations closer together than DT (0 for coincident times only)')
 
     parser.add_argument('--restart', action='store_true', help='restart an old run')
+    parser.add_argument('--update', metavar='PRE', default=None, help='continue the old run with prefix PRE with observations appended to the --rvs files, reweighting its final ensemble by the new data; the new run is written to a different --prefix, leaving the old one in place')
+    parser.add_argument('--rejuvenate', metavar='N', type=int, default=5, help='Metropolis-Hastings steps spreading out each temperature\'s ensemble after --update resamples it')
     parser.add_argument('--init', metavar='FILE', help='file storing initial point')
     parser.add_argument('--delta', metavar='DPARAM', type=float, default=1e-3, help='fractional width about initial point')
 
     args=parser.parse_args()
 
+    if args.batch and args.nthreads > 1:
+        parser.error('--batch cannot be combined with --nthreads')
+
+    if args.blocked and (args.batch or args.nthreads > 1 or args.marginalize is not None):
+        parser.error('--blocked cannot be combined with --batch, --nthreads or --marginalize')
+
+    if args.kepler_maxiter is not None and (args.batch or args.marginalize is not None):
+        parser.error('--kepler-maxiter cannot be combined with --batch or --marginalize')
+
+    if args.kepler_precision is not None and (args.batch or args.marginalize is not None):
+        parser.error('--kepler-precision cannot be combined with --batch or --marginalize')
+
+    if args.kepler_table_beta is not None and (args.batch or args.blocked or args.nthreads > 1 or args.marginalize is not None):
+        parser.error('--kepler-table-beta cannot be combined with --batch, --blocked, --nthreads or --marginalize')
+
+    if args.warm_start and (args.batch or args.nthreads > 1 or args.marginalize is not None):
+        parser.error('--warm-start cannot be combined with --batch, --nthreads or --marginalize')
+
+    if args.update is not None and (args.restart or args.compress is not None or args.marginalize is not None or args.seasons is not None):
+        parser.error('--update cannot be combined with --restart, --compress, --marginalize or --seasons')
+
+    if args.update is not None:
+        if os.path.abspath(args.update) == os.path.abspath(args.prefix):
+            parser.error('--update needs a --prefix different from that of the run it updates')
+        for name in ('%s.chain', '%s.00.txt.gz', '%s.state.npz', '%s.betas.txt'):
+            if os.path.exists(name%args.prefix):
+                parser.error('%s exists; refusing to overwrite it with the updated run'%(name%args.prefix))
+
     ts, rvs=load_data(args.rvs)
 
-    pmin,pmax=cl.prior_bounds_from_data(args.nplanets, ts, rvs)
+    if args.compress is not None:
+        ts, rvs, counts, scatters=cl.compress_observations(ts, rvs, args.compress)
+    else:
+        counts, scatters=None, None
+
+    if len(args.nterms) == 0:
+        nterms = 0
+    elif len(args.nterms) == 1:
+        nterms = args.nterms[0]
+    elif len(args.nterms) == len(ts):
+        nterms = args.nterms
+    else:
+        parser.error('--nterms must be given once, or once for each --rvs')
+
+    pmin,pmax=cl.prior_bounds_from_data(args.nplanets, ts, rvs, nterms=nterms)
+
+    if args.compress is not None and args.compress > 0.1*np.min(pmin.tau):
+        sys.stderr.write('warning: compression time %g is not much shorter than the shortest allowed tau %g\n'%(args.compress, np.min(pmin.tau)))
+
+    if args.marginalize is not None:
+        pmin,pmax=pmin.to_reduced(),pmax.to_reduced()
     
-    ndim = 5*args.nplanets + 4*len(ts)
+    ndim = pmin.shape[-1]
 
     # If re-starting a run, burnin = nthin, so that output continues
     # to be evenly-spaced
     if args.restart:
         args.nburnin = args.nthin - 1
 
-    if args.restart:
-        pts=[]
-        logls=[]
-        lnprobs=[]
+    if args.update is not None:
+        state=np.load('%s.state.npz'%args.update)
+        pts=state['pts']
+        logls=state['logls']
+        lnprobs=state['lnprobs']
+    elif args.restart:
+        reader=cio.ChainReader(args.prefix, nwalkers=args.nwalkers, format=args.chain_format)
+        if ((reader.ntemps, reader.nwalkers, reader.nobs, reader.npl, tuple(reader.nterms), reader.marginalize) !=
+            (args.ntemps, args.nwalkers, len(args.rvs), args.nplanets, normalize_nterms(nterms, len(args.rvs)), args.marginalize)):
+            parser.error('the chain to restart has %d temperatures of %d walkers, %d observatories, %d planets, noise terms %s and --marginalize %s'%(reader.ntemps, reader.nwalkers, reader.nobs, reader.npl, list(reader.nterms), reader.marginalize))
 
-        for i in range(args.ntemps):
-            data=np.loadtxt('%s.%02d.txt.gz'%(args.prefix, i))
-            pts.append(data[-args.nwalkers:, 2:])
-            logls.append(data[-args.nwalkers:,0])
-            lnprobs.append(data[-args.nwalkers:,1]+logls[-1])
-
-        pts=np.array(pts)
-        logls=np.array(logls)
-        lnprobs=np.array(lnprobs)
+        # The final ensemble at every temperature
+        pts=np.array(reader.params[-1], dtype=np.float64)
+        logls=np.array(reader.logl[-1], dtype=np.float64)
+        logps=np.array(reader.logp[-1], dtype=np.float64)
+
+        # Chains always store the full parameters
+        if args.marginalize is not None:
+            pts=Parameters(pts, npl=args.nplanets, nobs=len(args.rvs), nterms=nterms).to_reduced()
+
+        # The chain stores the log-prior; the sampler tracks the
+        # tempered posterior log(prior) + beta*log(L).
+        restart_betas=reader.betas if reader.betas is not None else default_beta_ladder(pts.shape[-1], ntemps=args.ntemps)
+        lnprobs=logps+restart_betas[:,np.newaxis]*logls
     elif args.init is not None:
         p0=Parameters(np.loadtxt(args.init))
-        if len(ts) > 1 or args.nplanets > 1:
-            raise NotImplementedError('cannot init from more than one observatory and one planet')
+        if len(ts) > 1 or args.nplanets > 1 or len(args.nterms) > 0 or args.marginalize is not None:
+            parser.error('--init cannot be combined with more than one --rvs, --nplanets above 1, --nterms or --marginalize')
         pts=Parameters(np.zeros((args.ntemps, args.nwalkers, ndim)))
         pts.V = np.random.normal(p0.V, p0.sigma0*args.delta, size=pts.V.shape[0:2])
         pts.sigma0 = np.random.lognormal(np.log(p0.sigma0), args.delta, size=pts.sigma0.shape[0:2])
@@ -86,52 +210,196 @@ if __name__ == '__main__':
         pts.omega = np.random.normal(p0.omega, args.delta, size=pts.omega.shape[0:2])
         logls=None
         lnprobs=None
-
-        header = pts.header[0] + ' logl logp' + pts.header[1:]
-        for i in range(args.ntemps):
-            with GzipFile('%s.%02d.txt.gz'%(args.prefix, i), 'w') as out:
-                out.write(header)
     else:
         pts=cl.generate_initial_sample(pmin, pmax, args.ntemps, args.nwalkers)
         logls=None
         lnprobs=None
-        p=Parameters(npl=args.nplanets, nobs=len(args.rvs))
-        header = p.header[0] + ' logl logp' + p.header[1:]
-        for i in range(args.ntemps):
-            with GzipFile('%s.%02d.txt.gz'%(args.prefix, i), 'w') as out:
-                out.write(header)
 
-    log_likelihood=cl.LogLikelihood(ts, rvs)
-    log_prior=cl.LogPrior(pmin=pmin, pmax=pmax, npl=args.nplanets, nobs=len(args.rvs))
+    if args.sampling_coordinates:
+        # The sampler moves in the sampling coordinates of
+        # parameters.Layout; chains and states store the natural
+        # parameters.
+        pts=pmin.layout.to_sampling(pts)
+        if args.restart:
+            lnprobs=lnprobs+pmin.layout.log_jacobian(pts)
+
+    # Choose the RV model backend once, here, rather than in each
+    # worker process.
+    rv_backend=rv.set_backend(args.rv_backend)
+    print 'RV model backend: %s'%rv_backend
+
+    kwargs=dict(nterms=nterms, marginalize=args.marginalize, counts=counts, scatters=scatters, kepler_maxiter=args.kepler_maxiter, kepler_tolerance=args.kepler_tol, kepler_precision=args.kepler_precision, warm_start=(args.ntemps*args.nwalkers if args.warm_start else 0), sampling_coordinates=args.sampling_coordinates)
+    if args.seasons is not None:
+        kwargs.update(method='seasons', tolerance=args.seasons, nthreads=args.season_threads)
+    log_likelihood=cl.LogLikelihood(ts, rvs, **kwargs)
+    log_prior=cl.LogPrior(pmin=pmin, pmax=pmax, npl=args.nplanets, nobs=len(args.rvs), nterms=nterms, reduced=(args.marginalize is not None), sampling_coordinates=args.sampling_coordinates, wrap=args.wrap)
+
+    if args.update is not None:
+        # Only the new points need to be filtered, after which each
+        # temperature's ensemble is resampled with weights L_new^beta.
+        nold=state['ndata']
+        for t, n0, tlast in zip(log_likelihood.ts, nold, state['tlast']):
+            if t.shape[0] < n0 or t[n0-1] != tlast:
+                parser.error('observations of the previous run must be unchanged, with new ones appended after them')
+
+        betas=np.loadtxt('%s.betas.txt'%args.update, ndmin=1)
+        if betas.shape[0] != args.ntemps or pts.shape[0:2] != (args.ntemps, args.nwalkers):
+            parser.error('the run to update has %d temperatures of %d walkers'%(pts.shape[0], pts.shape[1]))
+        states=[state['state%02d'%i] for i in range(len(nold))]
+        dlogls=np.zeros(logls.shape)
+        for k in range(args.ntemps):
+            for j in range(args.nwalkers):
+                sts=[st[k,j,:] for st in states]
+                dlogls[k,j]=log_likelihood.update(pts[k,j,:], sts, nold)
+
+        resampled=[pt.resample_ensemble(betas[k]*dlogls[k,:]) for k in range(args.ntemps)]
+        ess=min(e for isel, e in resampled)
+        print 'Effective ensemble size after reweighting: %.1f of %d'%(resampled[0][1], args.nwalkers)
+
+        if ess < max(ndim, args.nwalkers/4.0):
+            # Too few walkers carry the weight to spread out again;
+            # start afresh from the prior.
+            print 'Effective ensemble size %.1f is too small; starting a new run'%ess
+            args.update=None
+            pts=cl.generate_initial_sample(pmin, pmax, args.ntemps, args.nwalkers)
+            if args.sampling_coordinates:
+                pts=pmin.layout.to_sampling(pts)
+            logls=None
+            lnprobs=None
+        else:
+            # Resampling leaves copies of the heavier walkers; jitter
+            # them apart, and let a few Metropolis-Hastings steps
+            # restore each tempered posterior.
+            for k, (isel, e) in enumerate(resampled):
+                cov=np.cov(pts[k,...], rowvar=0)
+                pts[k,...], logls[k,:], logps=pt.rejuvenate_ensemble(pts[k,isel,:], logls[k,isel]+dlogls[k,isel], betas[k], log_likelihood, log_prior, cov, nsteps=args.rejuvenate)
+                lnprobs[k,:]=betas[k]*logls[k,:]+logps
 
-    sampler=PTSampler(args.ntemps, args.nwalkers, pts.shape[-1], log_likelihood, log_prior, threads=args.nthreads)
+    # An updated run keeps the ladder its ensemble was reweighted with
+    if args.update is None:
+        betas=default_beta_ladder(pts.shape[-1], ntemps=args.ntemps)
+
+    # Name the walker of each evaluation for the warm-start cache
+    walker_keys=(pt.WalkerKeys(args.ntemps, args.nwalkers) if args.warm_start and not args.blocked else None)
+
+    if args.batch:
+        pool=pt.EnsemblePool(log_likelihood, log_prior)
+    elif args.kepler_table_beta is not None:
+        pool=pt.TemperedPool(log_likelihood, log_prior, betas, args.kepler_table_beta, walker_keys=walker_keys)
+    elif args.nthreads > 1 and args.backend == 'threads':
+        if not log_likelihood.thread_safe:
+            parser.error('--backend threads needs the kalman or celerite method (got %s)' % log_likelihood.method)
+        pool=pt.PriorPool(log_likelihood, log_prior, ThreadPool(args.nthreads))
+    elif args.nthreads > 1:
+        pool=pt.PriorPool(log_likelihood, log_prior, Pool(args.nthreads, initializer=rv.set_backend, initargs=(rv_backend,)))
+    else:
+        pool=pt.PriorPool(log_likelihood, log_prior, walker_keys=walker_keys)
+
+    if args.blocked:
+        sampler=BlockedPTSampler(args.ntemps, args.nwalkers, pts.shape[-1], log_likelihood, log_prior, pmin.noise_mask, betas=betas)
+    else:
+        sampler=PTSampler(args.ntemps, args.nwalkers, pts.shape[-1], log_likelihood, log_prior, threads=args.nthreads, pool=pool, betas=betas)
 
     print 'max(log(P)) med(log(P)) min(log(P)) <afrac> <tswap>'
     sys.stdout.flush()
 
     np.savetxt('%s.betas.txt'%args.prefix, np.reshape(sampler.betas, (1, -1)))
 
-    for pts, lnprobs, logls in sampler.sample(pts, iterations=args.nburnin):
-        pass
+    # A restarted run continues the chain of the old one.  An updated
+    # run starts a new chain under its own prefix, since its samples
+    # are conditioned on different data from those of the old one.
+    if args.chain_format == 'binary':
+        chain_out=cio.ChainWriter('%s.chain'%args.prefix, args.ntemps, args.nwalkers, len(args.rvs), args.nplanets, nterms=nterms, betas=sampler.betas,
+                                  dtype=(np.float32 if args.float32 else np.float64), mode=('a' if args.restart else 'w'),
+                                  marginalize=args.marginalize)
+    elif not args.restart:
+        p=Parameters(npl=args.nplanets, nobs=len(args.rvs), nterms=nterms)
+        header = p.header[0] + ' logl logp' + p.header[1:]
+        for i in range(args.ntemps):
+            with GzipFile('%s.%02d.txt.gz'%(args.prefix, i), 'w') as out:
+                out.write(header)
+
+        for name in ('accept', 'aswaps'):
+            if os.path.exists('%s.%s.txt.gz'%(args.prefix, name)):
+                os.remove('%s.%s.txt.gz'%(args.prefix, name))
+
+        # Marks the chain as sampled under the reduced prior
+        if args.marginalize is not None:
+            with open('%s.marginalize.txt'%args.prefix, 'w') as out:
+                out.write(args.marginalize + '\n')
+        elif os.path.exists('%s.marginalize.txt'%args.prefix):
+            os.remove('%s.marginalize.txt'%args.prefix)
+
+    if args.update is not None and not args.blocked:
+        burnin=sampler.sample(pts, lnprob0=lnprobs, lnlike0=logls, iterations=args.nburnin)
+    else:
+        burnin=sampler.sample(pts, iterations=args.nburnin)
+
+    for pts, lnprobs, logls in burnin:
+        if args.kepler_table_beta is not None:
+            pool.exact(pts, logls, lnprobs)
+        if args.wrap:
+            canonicalize_walkers(log_prior, log_likelihood, pts)
 
     sampler.reset()
 
     for i, (pts, lnprobs, logls) in enumerate(sampler.sample(pts, iterations=args.nthin*args.nensembles, thin=args.nthin)):
+        # Walkers swapped into the colder temperatures bring the
+        # tabulated log-likelihoods of the hotter ones.
+        if args.kepler_table_beta is not None:
+            pool.exact(pts, logls, lnprobs)
+        if args.wrap:
+            canonicalize_walkers(log_prior, log_likelihood, pts)
+
         if i % args.nthin == 0:
-            for j in range(args.ntemps):
-                with GzipFile('%s.%02d.txt.gz'%(args.prefix, j), 'a') as out:
-                    np.savetxt(out, np.column_stack((logls[j,...], lnprobs[j,...]-logls[j,...], pts[j,...])))
+            # When marginalizing, fill in the linear parameters: with
+            # a draw from their conditional posterior for the
+            # marginal likelihood, or their best fit for the profile
+            # likelihood.
+            if args.marginalize is not None:
+                outpts = log_likelihood.full_parameters(pts, draw=(args.marginalize == 'marginal'))
+            else:
+                outpts = log_likelihood.parameters(pts)
 
-            with GzipFile('%s.accept.txt.gz'%args.prefix, 'a') as out:
-                np.savetxt(out, np.reshape(np.mean(sampler.acceptance_fraction, axis=1), (1, -1)))
+            # The prior is written as a density over the natural
+            # parameters, without the beta*log(L) of the tempered
+            # posterior.
+            logps = lnprobs - sampler.betas[:,np.newaxis]*logls
+            if args.sampling_coordinates:
+                logps = logps - pmin.layout.log_jacobian(pts)
+
+            if args.chain_format == 'binary':
+                chain_out.append(logls, logps, outpts, np.mean(sampler.acceptance_fraction, axis=1), sampler.tswap_acceptance_fraction)
+            else:
+                for j in range(args.ntemps):
+                    with GzipFile('%s.%02d.txt.gz'%(args.prefix, j), 'a') as out:
+                        np.savetxt(out, np.column_stack((logls[j,...], logps[j,...], outpts[j,...])))
+
+                with GzipFile('%s.accept.txt.gz'%args.prefix, 'a') as out:
+                    np.savetxt(out, np.reshape(np.mean(sampler.acceptance_fraction, axis=1), (1, -1)))
+
+                with GzipFile('%s.aswaps.txt.gz'%args.prefix, 'a') as out:
+                    np.savetxt(out, np.reshape(sampler.tswap_acceptance_fraction, (1, -1)))
 
-            with GzipFile('%s.aswaps.txt.gz'%args.prefix, 'a') as out:
-                np.savetxt(out, np.reshape(sampler.tswap_acceptance_fraction, (1, -1)))
-                
             print '%11.1f %11.1f %11.1f %7.2f %7.2f'%(np.amax(lnprobs[0,:]), np.median(lnprobs[0,:]), np.min(lnprobs[0,:]), np.mean(sampler.acceptance_fraction[0, :]), sampler.tswap_acceptance_fraction[0])
             sys.stdout.flush()
 
+    if args.chain_format == 'binary':
+        chain_out.close()
+
     print 'Run completed.'
+
+    if args.wrap:
+        print 'Evaluations saved from rejection by wrapping and relabeling: %d'%log_prior.nwrapped
+
+    if args.kepler_maxiter is not None:
+        if args.nthreads == 1 or args.backend == 'threads':
+            print 'Kepler solutions not converged to %g: %d'%(args.kepler_tol, log_likelihood.kepler_failures)
+        else:
+            print 'Kepler solutions not converged are counted in the worker processes, and not reported.'
+
+    if log_likelihood.method in ('kalman', 'celerite') and args.marginalize is None and args.compress is None:
+        save_state(args.prefix, log_likelihood, pts, logls, lnprobs)
     
     try:
         ac = sampler.acor
@@ -1,7 +1,22 @@
-import kepler as kp
+from collections import OrderedDict
 import numpy as np
 import parameters as params
-import scipy.optimize as so
+import time
+
+try:
+    import kepler as kp
+except ImportError:
+    kp = None
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# The most Halley steps the NumPy and numba solvers take, so that
+# they finish for any input; from their starters they converge in a
+# few steps for all e < 1.
+KEPLER_MAXITER = 32
 
 def kepler_f(M, E, e):
     """Returns the residual of Kepler's equation with mean anomaly M,
@@ -22,34 +37,99 @@ def kepler_fppp(E, e):
 
 def kepler_solve_ea(n, e, t):
     """Solve for the eccentric anomaly for an orbit with mean motion
-    n, eccentricity e, and time since pericenter passage t."""
+    n, eccentricity e, and time since pericenter passage t.  The
+    arguments are broadcast against each other.
 
-    t=np.atleast_1d(t)
+    Each iteration only updates the elements that have not yet
+    converged."""
 
-    M = np.fmod(n*t, 2.0*np.pi)
+    n, e, t = np.broadcast_arrays(n, e, np.atleast_1d(t))
 
-    while np.any(M < 0.0):
-        M[M<0.0] += 2.0*np.pi
+    M = np.mod(n*t, 2.0*np.pi)
 
     # Method taken from Danby, J.M.A.  The Solution of Kepler's
     # Equations - Part Three.  Celestial Mechanics, Vol. 40,
     # pp. 303-312, 1987.
-    E=np.zeros_like(M)
-    E[M<np.pi]=M[M<np.pi] + 0.85*e
-    E[M>np.pi]=M[M>np.pi] - 0.85*e
+    E = np.where(M < np.pi, M + 0.85*e, M - 0.85*e)
+
+    M = M.reshape(-1)
+    E = E.reshape(-1)
+    e = e.reshape(-1)
 
     f = kepler_f(M, E, e)
+    active = np.nonzero(np.abs(f) > 1e-8)[0]
+    f = f[active]
+    while active.shape[0] > 0:
+        Ma, Ea, ea = M[active], E[active], e[active]
 
-    while np.any(np.abs(f) > 1e-8):
-        fp = kepler_fp(E,e)
-        disc = np.sqrt(np.abs(16.0*fp*fp - 20.0*f*kepler_fpp(E,e)))
-        d = -5.0*f / (fp + np.sign(fp)*disc)
+        fp = kepler_fp(Ea, ea)
+        disc = np.sqrt(np.abs(16.0*fp*fp - 20.0*f*kepler_fpp(Ea, ea)))
+        Ea += -5.0*f / (fp + np.sign(fp)*disc)
+        E[active] = Ea
 
-        E += d
-        f = kepler_f(M,E,e)
+        f = kepler_f(Ma, Ea, ea)
+        unconverged = np.abs(f) > 1e-8
+        active = active[unconverged]
+        f = f[unconverged]
+
+    return E.reshape(n.shape)
+
+def kepler_starter(M, e):
+    """The starter of Markley (1995, CeMDA 63, 101) for the eccentric
+    anomaly with mean anomaly ``0 <= M <= pi``, accurate to about 1e-4
+    for all ``e < 1``."""
+
+    alpha = (3.0*np.pi*np.pi + 1.6*np.pi*(np.pi - M)/(1.0 + e))/(np.pi*np.pi - 6.0)
+    d = 3.0*(1.0 - e) + alpha*e
+    q = 2.0*alpha*d*(1.0 - e) - M*M
+    r = 3.0*alpha*d*(d - 1.0 + e)*M + M*M*M
+    w = (np.abs(r) + np.sqrt(q*q*q + r*r))**(2.0/3.0)
+
+    return (2.0*r*w/(w*w + w*q + q*q) + M)/d
+
+def kepler_solve_ea_halley(n, e, t, tol=1e-8, maxiter=KEPLER_MAXITER):
+    """As :func:`kepler_solve_ea`, but from the starter of
+    :func:`kepler_starter` with Halley steps, which converge to
+    ``tol`` in one or two steps almost everywhere.  At most
+    ``maxiter`` steps are taken, so the solver always finishes.
+    Returns the eccentric anomaly in :math:`[-\\pi, \\pi]`."""
+
+    n, e, t = np.broadcast_arrays(n, e, np.atleast_1d(t))
+    shape = n.shape
+
+    M = np.mod(n*t, 2.0*np.pi).reshape(-1)
+    # NaN off the bound orbits, where the iteration need not converge.
+    e = np.where((e >= 0.0) & (e < 1.0), e, np.nan).reshape(-1)
+
+    # Solve for M in [0, pi]; E is odd in M.
+    sgn = np.where(M > np.pi, -1.0, 1.0)
+    M = np.where(M > np.pi, 2.0*np.pi - M, M)
+
+    E = kepler_starter(M, e)
+    sinE = np.sin(E)
+    f = E - e*sinE - M
+
+    active = np.nonzero(np.abs(f) > tol)[0]
+    f = f[active]
+    for i in range(maxiter):
+        if active.shape[0] == 0:
+            break
+
+        Ea, ea, sinEa = E[active], e[active], sinE[active]
+
+        fp = 1.0 - ea*np.cos(Ea)
+        Ea -= f/(fp - 0.5*f*ea*sinEa/fp)
+        sinEa = np.sin(Ea)
+        E[active] = Ea
+        sinE[active] = sinEa
+
+        f = Ea - ea*sinEa - M[active]
+        unconverged = np.abs(f) > tol
+        active = active[unconverged]
+        f = f[unconverged]
+
+    return (sgn*E).reshape(shape)
 
-    return E
-    
 
 def kepler_solve_ta(n, e, t):
     """Solve for the true anomaly of a Keplerian orbit with mean
@@ -65,14 +145,366 @@ def kepler_solve_ta(n, e, t):
 
     return f
 
+def numpy_rv_model(ts, Ks, es, omegas, chis, ns):
+    """The pure NumPy backend of :func:`rv_model`, taking the planet
+    parameters as arrays of shape ``(Npl,)`` and returning the
+    velocities of shape ``(Npl, Nts)``.  The true anomaly enters only
+    through its sine and cosine, computed from the eccentric anomaly
+    of :func:`kepler_solve_ea_halley`."""
+
+    n = ns[:,np.newaxis]
+    e = es[:,np.newaxis]
+    omega = omegas[:,np.newaxis]
+
+    t0 = -chis[:,np.newaxis]*2.0*np.pi/n
+    E = kepler_solve_ea_halley(n, e, ts[np.newaxis,:] - t0)
+
+    cosE = np.cos(E)
+    g = 1.0 - e*cosE
+    cosf = (cosE - e)/g
+    sinf = np.sqrt(1.0 - e*e)*np.sin(E)/g
+
+    return Ks[:,np.newaxis]*(cosf*np.cos(omega) - sinf*np.sin(omega) + e*np.cos(omega))
+
+def numpy_rv_model_gradient(ts, Ks, es, omegas, chis, ns):
+    """The pure NumPy version of :func:`rv_model_gradient`, with the
+    arguments of :func:`numpy_rv_model`.  The derivatives of the true
+    anomaly are :math:`\\partial f/\\partial M = (1 + e \\cos
+    f)^2/(1-e^2)^{3/2}` and :math:`\\partial f/\\partial e = \\sin f
+    (2 + e \\cos f)/(1-e^2)`."""
+
+    K = Ks[:,np.newaxis]
+    n = ns[:,np.newaxis]
+    e = es[:,np.newaxis]
+    omega = omegas[:,np.newaxis]
+
+    t0 = -chis[:,np.newaxis]*2.0*np.pi/n
+    E = kepler_solve_ea_halley(n, e, ts[np.newaxis,:] - t0)
+
+    cosE = np.cos(E)
+    g = 1.0 - e*cosE
+    cosf = (cosE - e)/g
+    sinf = np.sqrt(1.0 - e*e)*np.sin(E)/g
+
+    cosw = np.cos(omega)
+    sinw = np.sin(omega)
+    cosfw = cosf*cosw - sinf*sinw
+    sinfw = sinf*cosw + cosf*sinw
+
+    dfdM = (1.0 + e*cosf)**2/(1.0 - e*e)**1.5
+    dfde = sinf*(2.0 + e*cosf)/(1.0 - e*e)
+
+    rvs = K*(cosfw + e*cosw)
+
+    drvs = np.zeros((Ks.shape[0], 5, ts.shape[0]))
+    drvs[:,0,:] = cosfw + e*cosw
+    drvs[:,1,:] = -K*sinfw*dfdM*ts[np.newaxis,:]
+    drvs[:,2,:] = -K*sinfw*dfdM*2.0*np.pi
+    drvs[:,3,:] = K*(cosw - sinfw*dfde)
+    drvs[:,4,:] = -K*(sinfw + e*sinw)
+
+    return rvs, drvs
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _numba_rv_model(ts, Ks, es, omegas, chis, ns, rvs):
+        for i in range(Ks.shape[0]):
+            e = es[i]
+            n = ns[i]
+            if not (e >= 0.0 and e < 1.0):
+                rvs[i,:] = np.nan
+                continue
+
+            t0 = -chis[i]*2.0*np.pi/n
+            cosw = np.cos(omegas[i])
+            sinw = np.sin(omegas[i])
+
+            for j in range(ts.shape[0]):
+                M = np.fmod(n*(ts[j] - t0), 2.0*np.pi)
+                if M < 0.0:
+                    M += 2.0*np.pi
+
+                if M < np.pi:
+                    E = M + 0.85*e
+                else:
+                    E = M - 0.85*e
+
+                f = E - e*np.sin(E) - M
+                for k in range(KEPLER_MAXITER):
+                    if abs(f) <= 1e-8:
+                        break
+                    fp = 1.0 - e*np.cos(E)
+                    E -= f/(fp - 0.5*f*e*np.sin(E)/fp)
+                    f = E - e*np.sin(E) - M
+
+                cosE = np.cos(E)
+                g = 1.0 - e*cosE
+                cosf = (cosE - e)/g
+                sinf = np.sqrt(1.0 - e*e)*np.sin(E)/g
+
+                rvs[i,j] = Ks[i]*(cosf*cosw - sinf*sinw + e*cosw)
+
+    def numba_rv_model(ts, Ks, es, omegas, chis, ns):
+        """The JIT-compiled backend of :func:`rv_model`, with the
+        signature of :func:`numpy_rv_model`; available when ``numba``
+        is installed."""
+        rvs = np.zeros((Ks.shape[0], ts.shape[0]))
+        _numba_rv_model(ts, Ks, es, omegas, chis, ns, rvs)
+        return rvs
+
+# The registered backends of rv_model, by name; each is called as
+# model(ts, Ks, es, omegas, chis, ns) and returns an (Npl, Nts) array.
+_backends = OrderedDict()
+_backend = None
+
+def register_backend(name, model):
+    """Registers ``model`` as a backend of :func:`rv_model` under
+    ``name``.  It must take ``(ts, Ks, es, omegas, chis, ns)``, the
+    times and arrays of the parameters of each planet, and return the
+    velocities of shape ``(Npl, Nts)``."""
+    global _backend
+
+    _backends[name] = model
+    _backend = None
+
+if kp is not None:
+    register_backend('cython', kp.rv_model)
+if numba is not None:
+    register_backend('numba', numba_rv_model)
+register_backend('numpy', numpy_rv_model)
+
+def backends():
+    """Returns the names of the registered backends."""
+    return list(_backends.keys())
+
+def benchmark_backends(nts=500, npl=2, repeat=3):
+    """Returns a dictionary of the best time, in seconds, of each
+    registered backend over ``repeat`` evaluations of ``npl`` planets
+    at ``nts`` times.  Backends that fail, or whose velocities
+    disagree with the others by more than 1e-6 of ``K``, are
+    omitted."""
+
+    ts = np.linspace(0.0, 1000.0, nts)
+    Ks = np.ones(npl)
+    es = np.linspace(0.1, 0.8, npl)
+    omegas = np.linspace(0.5, 2.5, npl)
+    chis = np.linspace(0.2, 0.7, npl)
+    ns = 2.0*np.pi/np.linspace(10.0, 300.0, npl)
+
+    times = {}
+    reference = None
+    for name, model in _backends.items():
+        try:
+            # The first call also triggers any JIT compilation.
+            rvs = model(ts, Ks, es, omegas, chis, ns)
+            if reference is None:
+                reference = rvs
+            elif not np.allclose(rvs, reference, rtol=0.0, atol=1e-6):
+                continue
+
+            best = float('inf')
+            for i in range(repeat):
+                tstart = time.time()
+                model(ts, Ks, es, omegas, chis, ns)
+                best = min(best, time.time() - tstart)
+            times[name] = best
+        except Exception:
+            continue
+
+    return times
+
+def set_backend(name=None):
+    """Selects the backend of :func:`rv_model` by name.  If ``name``
+    is ``None``, selects ``'cython'`` when the compiled :mod:`kepler`
+    module is available (its kernels compute the residuals and
+    ensembles in any case), and otherwise the fastest on this host
+    according to :func:`benchmark_backends`.  Returns the name
+    selected.
+
+    Programs that evaluate the model in worker processes should call
+    this once before starting them, and pass the name to each worker
+    (for example as the initializer of a
+    :class:`multiprocessing.Pool`), so that the benchmark is not
+    repeated in every worker."""
+    global _backend
+
+    if name is None:
+        if 'cython' in _backends:
+            name = 'cython'
+        else:
+            times = benchmark_backends()
+            name = min(times, key=times.get)
+    elif name not in _backends:
+        raise ValueError('unknown rv_model backend \'%s\''%name)
+
+    _backend = name
+
+    return name
+
+def backend():
+    """Returns the name of the backend of :func:`rv_model`, choosing
+    it with :func:`set_backend` on first use."""
+    if _backend is None:
+        set_backend()
+    return _backend
+
 def rv_model(ts, ps):
     """Returns the radial velocity measurements associated with the
     planets in parameters ps at times ts.  The returned array has
-    shape (Npl, Nts)."""
+    shape (Npl, Nts).  The computation is done by the selected
+    :func:`backend`."""
+
+    assert ts.ndim == 1, 'ts must be one-dimensional'
+
+    return _backends[backend()](ts, ps.K, ps.e, ps.omega, ps.chi, ps.n)
+
+def rv_model_gradient(ts, ps):
+    """Returns ``(rvs, drvs)``: the radial velocities of
+    :func:`rv_model`, shape (Npl, Nts), and their derivatives with
+    respect to the parameters ``(K, n, chi, e, omega)`` of each planet,
+    shape (Npl, 5, Nts).  Without the compiled :mod:`kepler` module,
+    the derivatives come from :func:`numpy_rv_model_gradient`."""
+
+    assert ts.ndim == 1, 'ts must be one-dimensional'
+
+    if kp is None:
+        return numpy_rv_model_gradient(ts, ps.K, ps.e, ps.omega, ps.chi, ps.n)
+
+    return kp.rv_model_gradient(ts, ps.K, ps.e, ps.omega, ps.chi, ps.n)
+
+def rv_residuals(ts, rvs, ps, out, tol=1e-8, maxiter=None, table=False):
+    """Stores in ``out`` the radial velocities ``rvs`` observed at
+    times ``ts`` less the total model velocity of the planets in
+    parameters ps, in a single pass without intermediate arrays.
+
+    If ``maxiter`` is not ``None``, Kepler's equation is solved with
+    at most ``maxiter`` iterations to tolerance ``tol`` (see
+    :func:`kepler.rv_residuals_bounded`).  If ``table``, it is
+    instead interpolated in a precomputed table (see
+    :func:`kepler.rv_residuals_table`).  Returns the number of
+    solutions that did not converge (always 0 for the default,
+    unbounded solver and the table).  Without the compiled
+    :mod:`kepler` module, the velocities come from :func:`rv_model`,
+    whatever ``maxiter`` and ``table``."""
+
+    assert ts.ndim == 1, 'ts must be one-dimensional'
+
+    if kp is None:
+        out[:] = rvs - np.sum(rv_model(ts, ps), axis=0)
+        return 0
+    elif table:
+        kp.rv_residuals_table(ts, rvs, ps.K, ps.e, ps.omega, ps.chi, ps.n, out)
+        return 0
+    elif maxiter is None:
+        kp.rv_residuals(ts, rvs, ps.K, ps.e, ps.omega, ps.chi, ps.n, out)
+        return 0
+    else:
+        return kp.rv_residuals_bounded(ts, rvs, ps.K, ps.e, ps.omega, ps.chi, ps.n, out, tol, maxiter)
+
+def rv_residuals_warm(ts, rvs, ps, out, anomalies, warm, tol=1e-8, maxiter=8):
+    """As :func:`rv_residuals`, warm-starting the Kepler solver from
+    the previous solution in ``anomalies`` (if ``warm``), which is
+    replaced by the new one (see :func:`kepler.rv_residuals_warm` and
+    :class:`AnomalyCache`).  Returns ``(niter, ncold, nfailed)``.
+    Without the compiled :mod:`kepler` module there is nothing to
+    warm-start, and this is :func:`rv_residuals`, returning ``(0, 0,
+    0)``."""
+
+    assert ts.ndim == 1, 'ts must be one-dimensional'
+
+    if kp is None:
+        rv_residuals(ts, rvs, ps, out)
+        return 0, 0, 0
+
+    return kp.rv_residuals_warm(ts, rvs, ps.K, ps.e, ps.omega, ps.chi, ps.n, out, anomalies, warm, tol, maxiter)
+
+class AnomalyCache(object):
+    """A bounded cache of the eccentric anomalies last solved for each
+    of a number of walkers, used to warm-start the Kepler solver (see
+    :func:`rv_residuals_warm`).  Each entry takes ``3*Npl*Nts``
+    doubles; when more than ``maxsize`` walkers are cached, the least
+    recently used is evicted."""
+
+    def __init__(self, maxsize):
+        self._maxsize = maxsize
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def maxsize(self):
+        return self._maxsize
+
+    def anomalies(self, key, npl, nts):
+        """Returns ``(anomalies, warm)`` for the walker ``key``: the
+        buffer of shape ``(3, npl, nts)`` holding its last solution,
+        and whether that solution is valid.  A new walker gets a
+        fresh buffer, evicting the least recently used walker if the
+        cache is full."""
+
+        entry = self._entries.pop(key, None)
+
+        if entry is not None and entry.shape == (3, npl, nts):
+            warm = True
+        else:
+            entry = np.zeros((3, npl, nts))
+            warm = False
+            while len(self._entries) >= self._maxsize:
+                self._entries.popitem(last=False)
+
+        self._entries[key] = entry
+
+        return entry, warm
+
+    def evict(self, key):
+        """Drops the solution of walker ``key``, for example when the
+        walker has been replaced by another."""
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+def rv_shapes(ts, ps):
+    """Returns the radial velocity curves of unit amplitude (``K =
+    1``) associated with the planets in parameters ps (which may be
+    reduced) at times ts.  The returned array has shape (Npl, Nts)."""
+
+    assert ts.ndim == 1, 'ts must be one-dimensional'
+
+    return _backends[backend()](ts, np.ones(ps.npl), ps.e, ps.omega, ps.chi, ps.n)
+
+def rv_model_ensemble(ts, ps, nthreads=0):
+    """Returns the total radial velocity (summed over planets) for
+    each of the parameter sets in ps, of shape ``(..., Ndim)``, at
+    times ts.  The returned array has shape ``(..., Nts)``.
+
+    The samples are evaluated in parallel over ``nthreads`` threads
+    (by default, all cores) by :func:`kepler.rv_model_samples`.
+    Without the compiled :mod:`kepler` module, the :func:`backend` of
+    :func:`rv_model` evaluates the planets of all samples in one
+    call."""
 
     assert ts.ndim == 1, 'ts must be one-dimensional'
 
-    return kp.rv_model(ts, ps.K, ps.e, ps.omega, ps.chi, ps.n)
+    if ps.npl == 0:
+        return np.zeros(ps.shape[:-1] + ts.shape)
+
+    def samples(x):
+        return np.ascontiguousarray(np.reshape(x, (-1, ps.npl)), dtype=np.float64)
+
+    if kp is None:
+        # The backends treat each planet independently, so the planets
+        # of all samples can be passed as one long list.
+        flat = [np.reshape(samples(x), -1) for x in (ps.K, ps.e, ps.omega, ps.chi, ps.n)]
+        rvs = _backends[backend()](ts, *flat)
+        return np.reshape(np.sum(np.reshape(rvs, (-1, ps.npl, ts.shape[0])), axis=1), ps.shape[:-1] + ts.shape)
+
+    rvs = kp.rv_model_samples(np.ascontiguousarray(ts, dtype=np.float64),
+                              samples(ps.K), samples(ps.e), samples(ps.omega),
+                              samples(ps.chi), samples(ps.n), nthreads)
+
+    return np.reshape(rvs, ps.shape[:-1] + ts.shape)
 
 def old_rv_model(ts, ps):
     """Returns the radial velocity measurements associated with the
@@ -103,8 +103,8 @@ class DataGenerator(object):
     def generate_noise(self, ts):
         
         noise=[]
-        for t, V, sigma0, sigma, tau in zip(ts, self.params.V, self.params.sigma0, self.params.sigma, self.params.tau):
-            cov = cl.generate_covariance(t, sigma0, sigma, tau)
+        for t, V, sigma0, sigma, tau, terms in zip(ts, self.params.V, self.params.sigma0, self.params.sigma, self.params.tau, self.params.terms):
+            cov = cl.generate_covariance(t, sigma0, sigma, tau, terms)
             A = nl.cholesky(cov)
             xs = nr.normal(size=len(t))
             noise.append(V + np.dot(A, xs))
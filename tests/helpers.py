@@ -0,0 +1,45 @@
+"""Synthetic data and fixed parameters shared by the tests.
+
+The tests import this module as ``tests.helpers``, which resolves
+from the top of the tree under both ``python -m unittest discover
+tests`` and ``pytest tests``."""
+
+import correlated_likelihood as cl
+import numpy as np
+import numpy.random as nr
+import parameters as pr
+import unittest
+
+def synthetic_data(nobs=2, nts=60, seed=42):
+    """Returns ``(ts, rvs)`` for ``nobs`` observatories of ``nts``
+    sorted, irregular times each."""
+
+    rng = nr.RandomState(seed)
+
+    ts = [np.sort(rng.uniform(0.0, 200.0, size=nts)) for i in range(nobs)]
+    rvs = [5.0*np.sin(2.0*np.pi*t/13.0) + rng.normal(scale=2.0, size=nts) for t in ts]
+
+    return ts, rvs
+
+def fixed_parameters(nobs=2, npl=1, nterms=0):
+    """Returns fixed parameters near the synthetic signal."""
+
+    p = pr.Parameters(nobs=nobs, npl=npl, nterms=nterms)
+
+    p.V = np.linspace(-0.5, 0.5, nobs)
+    p.sigma0 = np.linspace(1.5, 2.0, nobs)
+    p.sigma = np.linspace(0.8, 1.2, nobs)
+    p.tau = np.linspace(3.0, 6.0, nobs)
+
+    p.K = np.linspace(5.0, 2.0, npl)
+    p.n = 2.0*np.pi/np.linspace(13.0, 41.0, npl)
+    p.chi = np.linspace(0.3, 0.7, npl)
+    p.e = np.linspace(0.2, 0.4, npl)
+    p.omega = np.linspace(1.0, 4.0, npl)
+
+    p.terms = [np.tile([0.7, 10.0, 0.5], (nt, 1)) for nt in p.nterms]
+
+    return p
+
+needs_noise = unittest.skipIf(cl.noise is None, 'the compiled noise module is not built')
+needs_kepler = unittest.skipIf(cl.kp is None, 'the compiled kepler module is not built')
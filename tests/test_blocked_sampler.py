@@ -0,0 +1,73 @@
+"""Checks of :class:`blocked_sampler.BlockedPTSampler` and the noise
+factorizations it caches."""
+
+from blocked_sampler import BlockedPTSampler
+import correlated_likelihood as cl
+import numpy as np
+import numpy.random as nr
+import unittest
+
+from tests.helpers import synthetic_data, fixed_parameters, needs_noise
+
+class TestFactored(unittest.TestCase):
+    def test_planet_moves(self):
+        # A factorization at p serves any point that differs from p
+        # only in V and the planet parameters.
+        ts, rvs = synthetic_data()
+        p = fixed_parameters(npl=2, nterms=1)
+
+        q = p.copy()
+        q.V = [0.3, -0.2]
+        q.K = [4.0, 3.0]
+        q.e = [0.5, 0.1]
+        q.chi = [0.1, 0.9]
+
+        for method in ('dense',) if cl.noise is None else ('dense', 'celerite'):
+            ll = cl.LogLikelihood(ts, rvs, method=method, nterms=1)
+            factors = ll.factor(p)
+
+            self.assertAlmostEqual(ll.factored(p, factors), ll(p), places=8)
+            self.assertAlmostEqual(ll.factored(q, factors), ll(q), places=8)
+
+    @needs_noise
+    def test_kalman(self):
+        ts, rvs = synthetic_data()
+        p = fixed_parameters(npl=2)
+        q = p.copy()
+        q.V = [0.3, -0.2]
+        q.K = [4.0, 3.0]
+
+        ll = cl.LogLikelihood(ts, rvs, method='kalman')
+        self.assertAlmostEqual(ll.factored(q, ll.factor(p)), ll(q), places=8)
+
+class TestBlockedPTSampler(unittest.TestCase):
+    def test_cached_values(self):
+        # After every iteration, the cached log-prior and
+        # log-likelihood of each walker (carried through accepted
+        # moves in either block and temperature swaps) are those of
+        # its current position.
+        nr.seed(5)
+
+        ts, rvs = synthetic_data(nobs=1, nts=30)
+        pmin, pmax = cl.prior_bounds_from_data(1, ts, rvs)
+        log_prior = cl.LogPrior(pmin, pmax, npl=1, nobs=1)
+        log_likelihood = cl.LogLikelihood(ts, rvs)
+
+        ntemps = 2
+        nwalkers = 20
+        p0 = cl.generate_initial_sample(pmin, pmax, ntemps, nwalkers)
+
+        sampler = BlockedPTSampler(ntemps, nwalkers, p0.shape[-1], log_likelihood, log_prior, pmin.noise_mask)
+
+        for p, lnprob, logl in sampler.sample(p0, iterations=5):
+            for k in range(ntemps):
+                for j in range(nwalkers):
+                    self.assertAlmostEqual(logl[k,j], log_likelihood(p[k,j,:]), places=8)
+                    self.assertAlmostEqual(lnprob[k,j], sampler.betas[k]*logl[k,j] + log_prior(p[k,j,:]), places=8)
+
+        self.assertEqual(sampler.chain.shape, (ntemps, nwalkers, 5, p0.shape[-1]))
+        self.assertTrue(np.all(sampler.acceptance_fraction >= 0.0))
+        self.assertTrue(np.any(sampler.acceptance_fraction > 0.0))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+"""Round trips of :mod:`chain_io`: a binary chain written by
+:class:`chain_io.ChainWriter`, read back by :class:`chain_io.ChainReader`
+directly and after :func:`chain_io.export_text`."""
+
+import chain_io as cio
+import numpy as np
+import numpy.random as nr
+import os
+import parameters as pr
+import shutil
+import tempfile
+import unittest
+
+class TestChainIO(unittest.TestCase):
+    ntemps = 3
+    nwalkers = 4
+    nsteps = 5
+    nobs = 2
+    npl = 1
+    nterms = (0, 1)
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.prefix = os.path.join(self.dir, 'chain')
+
+        rng = nr.RandomState(7)
+        ndim = pr.ndim(self.nobs, self.npl, self.nterms)
+        shape = (self.nsteps, self.ntemps, self.nwalkers)
+
+        self.betas = np.array([1.0, 0.5, 0.25])
+        self.logls = rng.normal(size=shape)
+        self.logps = rng.normal(size=shape)
+        self.pts = rng.uniform(size=shape + (ndim,))
+        self.acceptance = rng.uniform(size=(self.nsteps, self.ntemps))
+        self.tswap = rng.uniform(size=(self.nsteps, self.ntemps))
+
+        with cio.ChainWriter(self.prefix + '.chain', self.ntemps, self.nwalkers, self.nobs, self.npl, nterms=self.nterms, betas=self.betas, chunk=2) as out:
+            for args in zip(self.logls, self.logps, self.pts, self.acceptance, self.tswap):
+                out.append(*args)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def check(self, reader, places=12):
+        self.assertEqual(reader.nobs, self.nobs)
+        self.assertEqual(reader.npl, self.npl)
+        self.assertEqual(list(reader.nterms), list(self.nterms))
+        self.assertEqual(reader.ntemps, self.ntemps)
+        self.assertEqual(reader.nwalkers, self.nwalkers)
+        self.assertEqual(reader.nsamples, self.nsteps)
+
+        tol = 10.0**(-places)
+        self.assertTrue(np.allclose(reader.betas, self.betas, rtol=tol, atol=0))
+        self.assertTrue(np.allclose(reader.logl[:], self.logls, rtol=tol, atol=0))
+        self.assertTrue(np.allclose(reader.logp[:], self.logps, rtol=tol, atol=0))
+        self.assertTrue(np.allclose(reader.params[:], self.pts, rtol=tol, atol=0))
+        self.assertTrue(np.allclose(reader.acceptance[:], self.acceptance, rtol=tol, atol=0))
+        self.assertTrue(np.allclose(reader.tswap[:], self.tswap, rtol=tol, atol=0))
+
+        ps = reader.parameters(samples=slice(1, 3), temps=0)
+        self.assertEqual(ps.shape, (2, self.nwalkers, self.pts.shape[-1]))
+        self.assertEqual(ps.nterms, self.nterms)
+
+    def test_binary(self):
+        reader = cio.ChainReader(self.prefix)
+        self.assertEqual(reader.format, 'binary')
+        self.check(reader)
+
+    def test_partial_record(self):
+        # A record still being written is not counted.
+        with open(self.prefix + '.chain', 'ab') as out:
+            out.write('\0'*17)
+
+        self.assertEqual(cio.ChainReader(self.prefix).nsamples, self.nsteps)
+
+    def test_append(self):
+        args = (self.prefix + '.chain', self.ntemps, self.nwalkers, self.nobs, self.npl)
+        with cio.ChainWriter(*args, nterms=self.nterms, mode='a') as out:
+            out.append(self.logls[0], self.logps[0], self.pts[0], self.acceptance[0], self.tswap[0])
+        self.assertEqual(cio.ChainReader(self.prefix).nsamples, self.nsteps + 1)
+
+        # The same number of parameters in a different layout, or
+        # under a different prior, is refused.
+        self.assertRaises(ValueError, cio.ChainWriter, *args, nterms=self.nterms[::-1], mode='a')
+        self.assertRaises(ValueError, cio.ChainWriter, *args, nterms=self.nterms, mode='a', marginalize='marginal')
+
+    def test_export_text(self):
+        cio.export_text(self.prefix + '.chain', self.prefix)
+
+        reader = cio.ChainReader(self.prefix, format='text')
+        self.assertEqual(reader.format, 'text')
+
+        # np.savetxt keeps 18 significant digits.
+        self.check(reader, places=15)
+
+if __name__ == '__main__':
+    unittest.main()
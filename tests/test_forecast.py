@@ -0,0 +1,62 @@
+"""Checks of the streaming statistics of
+:class:`forecast.CurveAccumulator` against those of the stored
+curves, and of the chains :func:`forecast.stream_chain` accepts."""
+
+import chain_io as cio
+import forecast as fc
+import numpy as np
+import numpy.random as nr
+import os
+import shutil
+import tempfile
+import unittest
+
+class TestCurveAccumulator(unittest.TestCase):
+    def test_statistics(self):
+        rng = nr.RandomState(7)
+        ngrid = 5
+        nbins = 256
+
+        curves = rng.normal(size=(2000, ngrid))*np.linspace(1.0, 3.0, ngrid) + np.linspace(-2.0, 2.0, ngrid)
+
+        acc = fc.CurveAccumulator(ngrid, nbins=nbins)
+        for batch in np.split(curves, 4):
+            acc.add(batch)
+            acc.count(batch.shape[0])
+
+        self.assertEqual(acc.n, curves.shape[0])
+        self.assertTrue(np.allclose(acc.mean, np.mean(curves, axis=0), rtol=0.0, atol=1e-10))
+        self.assertTrue(np.allclose(acc.std, np.std(curves, axis=0, ddof=1), rtol=0.0, atol=1e-10))
+
+        # The histogram spans at most twice the range of the first
+        # batch, so each bin is at most that wide.
+        width = 2.0*np.ptp(curves, axis=0)/nbins
+
+        qs = (0.05, 0.16, 0.5, 0.84, 0.95)
+        exact = np.array([np.percentile(curves, 100.0*q, axis=0) for q in qs])
+
+        self.assertTrue(np.all(np.abs(acc.quantiles(qs) - exact) <= width))
+
+class TestStreamChain(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, marginalize):
+        filename = os.path.join(self.dir, 'chain.chain')
+        with cio.ChainWriter(filename, 2, 3, 1, 1, marginalize=marginalize) as out:
+            out.append(np.zeros((2, 3)), np.zeros((2, 3)), np.ones((2, 3, 9)), np.zeros(2), np.zeros(2))
+        return filename
+
+    def test_marginal(self):
+        batches = list(fc.stream_chain(self.write('marginal')))
+        self.assertEqual(sum(b.shape[0] for b in batches), 3)
+
+    def test_profile(self):
+        # Best-fit offsets and amplitudes would narrow the forecast.
+        self.assertRaises(ValueError, fc.stream_chain, self.write('profile'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,412 @@
+"""Cross-checks of the fast likelihood paths against the dense
+reference, :func:`correlated_likelihood.correlated_gaussian_loglikelihood`
+of the full covariance of
+:func:`correlated_likelihood.generate_covariance`, on fixed synthetic
+data.
+
+Run from the top of the tree with ``python -m unittest discover
+tests`` (or ``pytest tests``)."""
+
+import correlated_likelihood as cl
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import numpy.random as nr
+import parameters as pr
+import rv_model as rv
+import scipy.optimize as so
+import unittest
+
+from tests.helpers import synthetic_data, fixed_parameters, needs_noise, needs_kepler
+
+def reference_loglikelihood(ts, rvs, p):
+    """The log-likelihood of ``p`` from dense covariances."""
+
+    ll = 0.0
+    for t, rvobs, V, sigma0, sigma, tau, terms in zip(ts, rvs, p.V, p.sigma0, p.sigma, p.tau, p.terms):
+        residual = rvobs - np.sum(rv.rv_model(t, p), axis=0)
+        ll += cl.correlated_gaussian_loglikelihood(residual, V*np.ones_like(t), cl.generate_covariance(t, sigma0, sigma, tau, terms))
+
+    return ll
+
+
+# The methods that can run in this build.
+methods = ('dense',) if cl.noise is None else ('dense', 'kalman', 'celerite')
+
+class TestGaussian(unittest.TestCase):
+    def test_log_density(self):
+        rng = nr.RandomState(3)
+        A = rng.normal(size=(20, 20))
+        cov = np.dot(A, A.T) + 20.0*np.eye(20)
+        xs = rng.normal(size=20)
+        means = rng.normal(size=20)
+
+        sign, logdet = np.linalg.slogdet(cov)
+        r = xs - means
+        expected = -10.0*np.log(2.0*np.pi) - 0.5*logdet - 0.5*np.dot(r, np.linalg.solve(cov, r))
+
+        self.assertAlmostEqual(cl.correlated_gaussian_loglikelihood(xs, means, cov), expected, places=10)
+
+    def test_not_positive_definite(self):
+        cov = np.array([[1.0, 2.0], [2.0, 1.0]])
+        self.assertEqual(cl.correlated_gaussian_loglikelihood(np.zeros(2), np.zeros(2), cov), float('-inf'))
+
+        cov[0, 1] = cov[1, 0] = float('nan')
+        self.assertEqual(cl.correlated_gaussian_loglikelihood(np.zeros(2), np.zeros(2), cov), float('-inf'))
+
+    def test_kalman_not_positive(self):
+        ts = np.linspace(0.0, 10.0, 5)
+        self.assertEqual(cl.exponential_gaussian_loglikelihood(ts, np.zeros(5), np.zeros(5), 0.0, 0.0, 1.0), float('-inf'))
+
+class TestLogPrior(unittest.TestCase):
+    def test_batch(self):
+        ts, rvs = synthetic_data()
+        rng = nr.RandomState(11)
+        nr.seed(11)
+
+        for npl, nterms in ((1, 0), (2, 1)):
+            pmin, pmax = cl.prior_bounds_from_data(npl, ts, rvs, nterms=nterms)
+            lp = cl.LogPrior(pmin, pmax, npl=npl, nobs=2, nterms=nterms)
+
+            # Half the points perturbed, many of them out of bounds or
+            # out of period order.
+            ps = np.array(cl.generate_initial_sample(pmin, pmax, 1, 200))[0]
+            ps[1::2] *= rng.uniform(0.5, 1.5, size=ps[1::2].shape)
+
+            lps = lp.batch(np.reshape(ps, (2, 100, -1)))
+            self.assertEqual(lps.shape, (2, 100))
+
+            expected = np.array([lp(p) for p in ps])
+            self.assertTrue(np.any(expected == float('-inf')))
+            self.assertTrue(np.any(expected > float('-inf')))
+
+            lps = lps.flatten()
+            self.assertTrue(np.all((lps == float('-inf')) == (expected == float('-inf'))))
+            inprior = expected > float('-inf')
+            self.assertTrue(np.allclose(lps[inprior], expected[inprior], rtol=0.0, atol=1e-10))
+
+    def test_wrap(self):
+        ts, rvs = synthetic_data()
+        p = fixed_parameters(npl=2)
+        layout = p.layout
+
+        # The same point with chi and omega shifted by a period and
+        # the planets in the opposite order.
+        q = p.copy()
+        for name in ('K', 'n', 'chi', 'e', 'omega'):
+            q[getattr(layout, name)] = p[getattr(layout, name)][::-1]
+        q[layout.chi] += 1.0
+        q[layout.omega] -= 2.0*np.pi
+
+        ll = cl.LogLikelihood(ts, rvs)
+        self.assertAlmostEqual(ll(q), ll(p), places=8)
+
+        self.assertEqual(cl.LogPrior(npl=2, nobs=2)(q), float('-inf'))
+
+        lp = cl.LogPrior(npl=2, nobs=2, wrap=True)
+        self.assertTrue(np.allclose(lp.canonical(q), p, rtol=0.0, atol=1e-12))
+
+        self.assertAlmostEqual(lp(q), lp(p), places=10)
+        self.assertEqual(lp.nwrapped, 1)
+
+        lps = lp.batch(np.array([p, q]))
+        self.assertAlmostEqual(lps[1], lps[0], places=10)
+        self.assertEqual(lp.nwrapped, 2)
+
+class TestMethods(unittest.TestCase):
+    def check(self, method, nterms=0):
+        ts, rvs = synthetic_data()
+        p = fixed_parameters(nterms=nterms)
+
+        ll = cl.LogLikelihood(ts, rvs, method=method, nterms=nterms)
+
+        self.assertAlmostEqual(ll(p), reference_loglikelihood(ts, rvs, p), places=8)
+
+    def test_dense(self):
+        self.check('dense')
+        self.check('dense', nterms=1)
+
+    def test_seasons(self):
+        self.check('seasons')
+
+    @needs_noise
+    def test_kalman(self):
+        self.check('kalman')
+
+    @needs_noise
+    def test_celerite(self):
+        self.check('celerite')
+        self.check('celerite', nterms=2)
+        self.check('celerite', nterms=[0, 1])
+
+    def test_batch(self):
+        ts, rvs = synthetic_data()
+        p = fixed_parameters()
+
+        # An ensemble of shape (ntemps, nwalkers, ndim).
+        ps = np.array([[p, p, p], [p, p, p]])
+        # A more eccentric orbit, and a larger correlated noise.
+        ps[0, 1, 4*2+3] = 0.6
+        ps[1, 2, 2] = 3.0
+
+        ll = cl.LogLikelihood(ts, rvs)
+
+        lls = ll.batch(ps)
+        self.assertEqual(lls.shape, (2, 3))
+
+        # The ensemble solves Kepler's equation separately, to about
+        # 1e-8, which moves the log-likelihood by about 1e-7.
+        for pp, l in zip(np.reshape(ps, (-1, ps.shape[-1])), lls.flatten()):
+            self.assertAlmostEqual(l, reference_loglikelihood(ts, rvs, pr.Parameters(pp, nobs=2, npl=1)), places=6)
+
+    @needs_noise
+    def test_threads(self):
+        ts, rvs = synthetic_data()
+        p = fixed_parameters()
+        ps = np.array([p]*16)
+        ps[:, 4*2] = np.linspace(1.0, 8.0, 16)
+
+        ll = cl.LogLikelihood(ts, rvs, method='celerite')
+        self.assertTrue(ll.thread_safe)
+
+        expected = [ll(pp) for pp in ps]
+        pool = ThreadPool(4)
+        try:
+            self.assertEqual(pool.map(ll, ps), expected)
+        finally:
+            pool.close()
+
+class TestGradient(unittest.TestCase):
+    def check(self, method):
+        ts, rvs = synthetic_data()
+        p = fixed_parameters(npl=2)
+
+        ll, dll = cl.LogLikelihood(ts, rvs, method=method).gradient(p)
+
+        self.assertAlmostEqual(ll, reference_loglikelihood(ts, rvs, p), places=8)
+
+        for i in range(p.shape[0]):
+            h = 1e-6*max(abs(p[i]), 1.0)
+            pp = p.copy()
+            pm = p.copy()
+            pp[i] += h
+            pm[i] -= h
+            fd = (reference_loglikelihood(ts, rvs, pp) - reference_loglikelihood(ts, rvs, pm))/(2.0*h)
+
+            self.assertTrue(abs(dll[i] - fd) < 1e-4*max(abs(fd), 1.0), 'component %d: %g != %g'%(i, dll[i], fd))
+
+    def test_dense(self):
+        self.check('dense')
+
+    @needs_noise
+    def test_kalman(self):
+        self.check('kalman')
+
+class TestCompression(unittest.TestCase):
+    def test_coincident_times(self):
+        # Each time observed 1-3 times; compression at dt = 0 is exact.
+        ts, rvs = synthetic_data(nts=40)
+        rng = nr.RandomState(1)
+        fullts = []
+        fullrvs = []
+        for t, rvobs in zip(ts, rvs):
+            repeats = rng.randint(1, 4, size=t.shape[0])
+            fullts.append(np.repeat(t, repeats))
+            fullrvs.append(np.repeat(rvobs, repeats) + rng.normal(scale=0.5, size=np.sum(repeats)))
+
+        p = fixed_parameters()
+        expected = reference_loglikelihood(fullts, fullrvs, p)
+
+        cts, crvs, counts, scatters = cl.compress_observations(fullts, fullrvs)
+        self.assertEqual([t.shape[0] for t in cts], [t.shape[0] for t in ts])
+
+        for method in methods:
+            ll = cl.LogLikelihood(cts, crvs, method=method, counts=counts, scatters=scatters)
+            self.assertAlmostEqual(ll(p), expected, places=8)
+
+@needs_noise
+class TestIncrementalUpdate(unittest.TestCase):
+    def test_append(self):
+        ts, rvs = synthetic_data()
+        nold = [35, 50]
+        p = fixed_parameters()
+
+        for method in ('kalman', 'celerite'):
+            old = cl.LogLikelihood([t[:n] for t, n in zip(ts, nold)], [r[:n] for r, n in zip(rvs, nold)], method=method)
+            full = cl.LogLikelihood(ts, rvs, method=method)
+
+            states = old.empty_states()
+            llold = old.update(p, states, [0, 0])
+            self.assertAlmostEqual(llold, old(p), places=8)
+
+            llnew = full.update(p, states, nold)
+            self.assertAlmostEqual(llold + llnew, reference_loglikelihood(ts, rvs, p), places=8)
+
+@needs_kepler
+class TestKeplerSolvers(unittest.TestCase):
+    def test_table(self):
+        ts, rvs = synthetic_data()
+        p = fixed_parameters(npl=2)
+
+        ll = cl.LogLikelihood(ts, rvs, kepler_precision=1.0)
+
+        # The model velocities are within the table's error bound, so
+        # the log-likelihood moves by at most that bound times the
+        # gradient with respect to the residuals.
+        self.assertAlmostEqual(ll(p, approximate=True), reference_loglikelihood(ts, rvs, p), places=2)
+        self.assertAlmostEqual(ll(p, approximate=False), reference_loglikelihood(ts, rvs, p), places=8)
+
+    def test_warm_start(self):
+        ts, rvs = synthetic_data()
+        p = fixed_parameters(npl=2)
+
+        ll = cl.LogLikelihood(ts, rvs, warm_start=2, kepler_tolerance=1e-12)
+
+        # The reference model solves Kepler's equation only to about
+        # 1e-8, which moves the log-likelihood by about 1e-7.
+        for e in (0.2, 0.25, 0.5, 0.1):
+            p.e = e*np.ones(p.npl)
+            self.assertAlmostEqual(ll(p, walker=0), reference_loglikelihood(ts, rvs, p), places=6)
+        self.assertTrue(ll.kepler_iterations > 0)
+
+    def test_bounded(self):
+        ts = np.linspace(0.0, 200.0, 400)
+        rvs = np.zeros_like(ts)
+        planet = [np.array([5.0]), np.array([0.999]), np.array([1.0]), np.array([0.3]), np.array([2.0*np.pi/13.0])]
+
+        expected = np.zeros_like(ts)
+        cl.kp.rv_residuals(ts, rvs, *(planet + [expected]))
+
+        # One Halley step from the starter does not reach 1e-12 near
+        # pericenter of so eccentric an orbit; two do everywhere.
+        out = np.zeros_like(ts)
+        self.assertTrue(cl.kp.rv_residuals_bounded(ts, rvs, *(planet + [out]), tol=1e-12, maxiter=1) > 0)
+
+        # The unbounded solver stops at a residual of 1e-8.
+        self.assertEqual(cl.kp.rv_residuals_bounded(ts, rvs, *(planet + [out]), tol=1e-12, maxiter=2), 0)
+        self.assertTrue(np.allclose(out, expected, rtol=0.0, atol=1e-6))
+
+    def test_failures(self):
+        ts, rvs = synthetic_data()
+        p = fixed_parameters()
+        p.e = 0.999
+
+        ll = cl.LogLikelihood(ts, rvs, kepler_maxiter=1, kepler_tolerance=1e-12)
+
+        ll(p)
+        nfailed = ll.kepler_failures
+        self.assertTrue(nfailed > 0)
+
+        ll(p)
+        self.assertEqual(ll.kepler_failures, 2*nfailed)
+
+class TestMarginalization(unittest.TestCase):
+    def setUp(self):
+        self.ts, self.rvs = synthetic_data()
+        self.p = fixed_parameters(npl=2, nterms=1)
+        self.reduced = self.p.to_reduced()
+        self.nobs = self.p.nobs
+        self.nlin = self.p.nobs + self.p.npl
+
+    def full_loglikelihood(self, method):
+        ll = cl.LogLikelihood(self.ts, self.rvs, method=method, nterms=1)
+        return lambda beta: ll(self.reduced.to_full(beta[:self.nobs], beta[self.nobs:]))
+
+    def test_profile(self):
+        for method in ('dense',) if cl.noise is None else ('dense', 'celerite'):
+            full = self.full_loglikelihood(method)
+            result = so.minimize(lambda beta: -full(beta), np.zeros(self.nlin), method='BFGS', options={'gtol' : 1e-8})
+
+            profile = cl.LogLikelihood(self.ts, self.rvs, method=method, nterms=1, marginalize='profile')
+
+            self.assertAlmostEqual(profile(self.reduced), -result.fun, places=6)
+
+            # The maximum, with negative amplitudes folded to K > 0.
+            Ks = result.x[self.nobs:]
+            omegas = np.where(Ks < 0, np.mod(self.reduced.omega + np.pi, 2.0*np.pi), self.reduced.omega)
+
+            best = profile.full_parameters(self.reduced)
+            self.assertTrue(np.allclose(best.V, result.x[:self.nobs], atol=1e-4))
+            self.assertTrue(np.allclose(best.K, np.abs(Ks), atol=1e-4))
+            self.assertTrue(np.allclose(best.omega, omegas, rtol=0.0, atol=1e-12))
+
+    def test_fold(self):
+        # Shifting omega by pi flips the sign of the best-fit K; the
+        # folded full parameters are the same either way.
+        profile = cl.LogLikelihood(self.ts, self.rvs, method='dense', nterms=1, marginalize='profile')
+
+        shifted = self.reduced.copy()
+        shifted.omega = np.mod(shifted.omega + np.pi, 2.0*np.pi)
+
+        best = profile.full_parameters(self.reduced)
+        self.assertTrue(np.all(best.K > 0))
+        self.assertTrue(np.allclose(profile.full_parameters(shifted), best, rtol=0.0, atol=1e-8))
+        self.assertAlmostEqual(profile(shifted), profile(self.reduced), places=8)
+
+    def test_marginal(self):
+        # The full likelihood is Gaussian in the linear parameters, so
+        # integrating them out adds the log-volume of the Gaussian,
+        # whose inverse covariance is minus the (constant) Hessian.
+        full = self.full_loglikelihood('dense')
+
+        H = np.zeros((self.nlin, self.nlin))
+        I = np.eye(self.nlin)
+        for i in range(self.nlin):
+            for j in range(self.nlin):
+                H[i,j] = -(full(I[i] + I[j]) - full(I[i] - I[j]) - full(-I[i] + I[j]) + full(-I[i] - I[j]))/4.0
+
+        sign, logdet = np.linalg.slogdet(H)
+        self.assertEqual(sign, 1.0)
+
+        profile = cl.LogLikelihood(self.ts, self.rvs, method='dense', nterms=1, marginalize='profile')
+        marginal = cl.LogLikelihood(self.ts, self.rvs, method='dense', nterms=1, marginalize='marginal')
+
+        self.assertAlmostEqual(marginal(self.reduced) - profile(self.reduced), 0.5*self.nlin*np.log(2.0*np.pi) - 0.5*logdet, places=6)
+
+class TestLayout(unittest.TestCase):
+    def test_fields(self):
+        p = fixed_parameters(npl=2, nterms=[0, 2])
+        layout = p.layout
+        self.assertTrue(layout is pr.layout(nobs=2, npl=2, nterms=[0, 2]))
+
+        for q in (p, p.to_reduced()):
+            arr = np.ascontiguousarray(q)
+            fields = q.layout.fields(arr)
+
+            for name in ('sigma0', 'sigma', 'tau', 'n', 'chi', 'e', 'omega'):
+                self.assertTrue(np.all(getattr(fields, name) == getattr(q, name)), name)
+            if not q.reduced:
+                self.assertTrue(np.all(fields.V == q.V))
+                self.assertTrue(np.all(fields.K == q.K))
+            for t, tq in zip(fields.terms, q.terms):
+                self.assertTrue(np.all(t == tq))
+
+            # The fields are views of the vector.
+            fields.e[:] = 0.7
+            self.assertTrue(np.all(arr[q.layout.e] == 0.7))
+
+    def test_round_trip(self):
+        layout = pr.layout(nobs=2, npl=2, nterms=1)
+        p = np.array(fixed_parameters(npl=2, nterms=1))
+
+        q = layout.to_natural(layout.to_sampling(p))
+
+        self.assertTrue(np.allclose(q, p, rtol=1e-12, atol=1e-12))
+
+    def test_log_jacobian(self):
+        layout = pr.layout(nobs=2, npl=2, nterms=1)
+        u = layout.to_sampling(fixed_parameters(npl=2, nterms=1))
+
+        # The Jacobian matrix by central differences.
+        h = 1e-6
+        J = np.zeros((u.shape[0], u.shape[0]))
+        for i in range(u.shape[0]):
+            du = np.zeros_like(u)
+            du[i] = h
+            J[:,i] = (layout.to_natural(u + du) - layout.to_natural(u - du))/(2.0*h)
+
+        sign, logdet = np.linalg.slogdet(J)
+
+        self.assertAlmostEqual(layout.log_jacobian(u), logdet, places=6)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+"""Checks of the sampler pools of :mod:`ptutils`."""
+
+import correlated_likelihood as cl
+from emcee.ptsampler import PTSampler
+import numpy as np
+import numpy.random as nr
+import ptutils as pt
+import unittest
+
+from tests.helpers import synthetic_data, needs_kepler
+
+class CountingPrior(cl.LogPrior):
+    """A prior that counts its single-point evaluations."""
+
+    ncalls = 0
+
+    def __call__(self, p):
+        self.ncalls += 1
+        return super(CountingPrior, self).__call__(p)
+
+class TestPriorPool(unittest.TestCase):
+    def test_map(self):
+        ts, rvs = synthetic_data()
+        nr.seed(3)
+
+        pmin, pmax = cl.prior_bounds_from_data(2, ts, rvs)
+        log_prior = CountingPrior(pmin, pmax, npl=2, nobs=2)
+        log_likelihood = cl.LogLikelihood(ts, rvs)
+
+        ps = np.array(cl.generate_initial_sample(pmin, pmax, 1, 40))[0]
+        ps[1::2] *= nr.uniform(0.5, 1.5, size=ps[1::2].shape)
+
+        # The batched prior is not evaluated again point by point.
+        results = pt.PriorPool(log_likelihood, log_prior).map(None, ps)
+        self.assertEqual(log_prior.ncalls, 0)
+
+        logps = log_prior.batch(ps)
+        self.assertTrue(np.any(logps == float('-inf')))
+        self.assertTrue(np.any(logps > float('-inf')))
+
+        for p, lp, (logl, logp) in zip(ps, logps, results):
+            self.assertEqual(logp, lp)
+            if lp == float('-inf'):
+                self.assertEqual(logl, float('-inf'))
+            else:
+                self.assertAlmostEqual(logl, log_likelihood(p), places=10)
+
+    def test_warm_start(self):
+        ts, rvs = synthetic_data()
+
+        ntemps, nwalkers = 2, 26
+
+        pmin, pmax = cl.prior_bounds_from_data(1, ts, rvs)
+        log_prior = cl.LogPrior(pmin, pmax, npl=1, nobs=2)
+
+        results = []
+        for warm_start in (0, ntemps*nwalkers):
+            nr.seed(7)
+            log_likelihood = cl.LogLikelihood(ts, rvs, warm_start=warm_start)
+            keys = pt.WalkerKeys(ntemps, nwalkers) if warm_start > 0 else None
+            pool = pt.PriorPool(log_likelihood, log_prior, walker_keys=keys)
+            sampler = PTSampler(ntemps, nwalkers, pmin.shape[-1], log_likelihood, log_prior, pool=pool)
+
+            pts = cl.generate_initial_sample(pmin, pmax, ntemps, nwalkers)
+            for pts, lnprobs, logls in sampler.sample(pts, iterations=10):
+                pass
+            results.append((pts, logls, log_likelihood))
+
+        (cold_pts, cold_logls, cold), (warm_pts, warm_logls, warm) = results
+
+        # The warm-started solver converges to the same anomalies.
+        self.assertTrue(np.allclose(warm_pts, cold_pts, rtol=1e-8, atol=0))
+        self.assertTrue(np.allclose(warm_logls, cold_logls, rtol=1e-8, atol=1e-6))
+
+        self.assertEqual(cold.kepler_iterations, 0)
+        self.assertTrue(warm.kepler_iterations > 0)
+        self.assertEqual(len(warm.anomaly_cache), ntemps*nwalkers)
+
+class TestWalkerKeys(unittest.TestCase):
+    def test_keys(self):
+        keys = pt.WalkerKeys(2, 6)
+
+        self.assertEqual(keys(12), [(k, j) for k in range(2) for j in range(6)])
+        self.assertEqual(keys(6), [(0, 0), (0, 2), (0, 4), (1, 0), (1, 2), (1, 4)])
+        self.assertEqual(keys(6), [(0, 1), (0, 3), (0, 5), (1, 1), (1, 3), (1, 5)])
+        self.assertEqual(keys(6)[:3], [(0, 0), (0, 2), (0, 4)])
+
+        self.assertRaises(ValueError, keys, 5)
+
+class TestRejuvenate(unittest.TestCase):
+    def test_full_rank(self):
+        ts, rvs = synthetic_data()
+        nr.seed(11)
+
+        pmin, pmax = cl.prior_bounds_from_data(1, ts, rvs)
+        log_prior = cl.LogPrior(pmin, pmax, npl=1, nobs=2)
+        log_likelihood = cl.LogLikelihood(ts, rvs)
+
+        nwalkers = 30
+        ndim = pmin.shape[-1]
+        pts = np.array(cl.generate_initial_sample(pmin, pmax, 1, nwalkers))[0]
+        logls = np.array([log_likelihood(p) for p in pts])
+
+        # All the weight on three walkers
+        log_weights = np.zeros(nwalkers) + float('-inf')
+        log_weights[[2, 9, 17]] = 0.0
+        isel, ess = pt.resample_ensemble(log_weights)
+        self.assertAlmostEqual(ess, 3.0)
+        self.assertEqual(len(set(isel)), 3)
+
+        cov = np.cov(pts, rowvar=0)
+        new_pts, new_logls, new_logps = pt.rejuvenate_ensemble(pts[isel,:], logls[isel], 0.1, log_likelihood, log_prior, cov)
+
+        self.assertEqual(np.linalg.matrix_rank(new_pts - np.mean(new_pts, axis=0)), ndim)
+        self.assertTrue(len(set(map(tuple, new_pts))) > ndim)
+
+        self.assertTrue(np.all(new_logps == log_prior.batch(new_pts)))
+        for p, logl in zip(new_pts, new_logls):
+            self.assertAlmostEqual(logl, log_likelihood(p), places=8)
+
+@needs_kepler
+class TestTemperedPool(unittest.TestCase):
+    def test_exact(self):
+        ts, rvs = synthetic_data()
+        nr.seed(5)
+
+        ntemps, nwalkers = 4, 26
+        betas = np.array([1.0, 0.7, 0.3, 0.1])
+
+        pmin, pmax = cl.prior_bounds_from_data(1, ts, rvs)
+        log_prior = cl.LogPrior(pmin, pmax, npl=1, nobs=2)
+        log_likelihood = cl.LogLikelihood(ts, rvs, kepler_precision=0.0)
+
+        pool = pt.TemperedPool(log_likelihood, log_prior, betas, 0.5)
+        sampler = PTSampler(ntemps, nwalkers, pmin.shape[-1], log_likelihood, log_prior, pool=pool, betas=betas)
+
+        pts = cl.generate_initial_sample(pmin, pmax, ntemps, nwalkers)
+        nexact = 0
+        for pts, lnprobs, logls in sampler.sample(pts, iterations=30):
+            nexact += pool.exact(pts, logls, lnprobs)
+
+            # The two colder temperatures hold exact values only.
+            for k in range(2):
+                for j in range(nwalkers):
+                    self.assertEqual(logls[k,j], log_likelihood(pts[k,j], approximate=False))
+
+            logps = log_prior.batch(pts)
+            self.assertTrue(np.allclose(lnprobs, betas[:,np.newaxis]*logls + logps, rtol=1e-12, atol=1e-8))
+
+        # Swaps did bring tabulated values down.
+        self.assertTrue(nexact > 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+"""Checks of the :func:`rv_model.rv_model` backends against each
+other, and of the multi-sample kernel against a loop over samples."""
+
+import numpy as np
+import numpy.random as nr
+import parameters as pr
+import rv_model as rv
+import unittest
+
+from tests.helpers import fixed_parameters, needs_kepler
+
+class TestBackends(unittest.TestCase):
+    def tearDown(self):
+        rv.set_backend()
+
+    def test_agreement(self):
+        ts = np.linspace(0.0, 200.0, 300)
+        p = fixed_parameters(npl=2)
+        p.e = np.array([0.05, 0.9])
+
+        expected = rv.numpy_rv_model(ts, p.K, p.e, p.omega, p.chi, p.n)
+
+        # Each backend solves Kepler's equation to a residual of 1e-8,
+        # which near e = 1 moves the velocities by about 1e-7 K; the
+        # agreement asked of them by benchmark_backends is 1e-6 K.
+        for name in rv.backends():
+            self.assertEqual(rv.set_backend(name), name)
+            self.assertTrue(np.allclose(rv.rv_model(ts, p), expected, rtol=0.0, atol=1e-6), name)
+
+    def test_default(self):
+        if rv.kp is not None:
+            self.assertEqual(rv.set_backend(), 'cython')
+        else:
+            self.assertTrue(rv.set_backend() in rv.backends())
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, rv.set_backend, 'fortran')
+
+class TestEnsemble(unittest.TestCase):
+    def setUp(self):
+        rng = nr.RandomState(5)
+        self.ts = np.linspace(0.0, 200.0, 150)
+
+        self.ps = pr.Parameters(np.zeros((3, 4, pr.ndim(1, 3))), nobs=1, npl=3)
+        self.ps.K = rng.uniform(1.0, 10.0, size=(3, 4, 3))
+        self.ps.e = rng.uniform(0.0, 0.95, size=(3, 4, 3))
+        self.ps.omega = rng.uniform(0.0, 2.0*np.pi, size=(3, 4, 3))
+        self.ps.chi = rng.uniform(0.0, 1.0, size=(3, 4, 3))
+        self.ps.n = 2.0*np.pi/rng.uniform(5.0, 50.0, size=(3, 4, 3))
+
+    def expected(self):
+        flat = np.reshape(self.ps, (-1, self.ps.shape[-1]))
+        return np.array([np.sum(rv.rv_model(self.ts, pr.Parameters(p, nobs=1, npl=3)), axis=0) for p in flat])
+
+    @needs_kepler
+    def test_samples(self):
+        def samples(x):
+            return np.ascontiguousarray(np.reshape(x, (-1, 3)))
+
+        expected = np.array([np.sum(rv.kp.rv_model(self.ts, K, e, omega, chi, n), axis=0)
+                             for K, e, omega, chi, n in zip(*[samples(x) for x in (self.ps.K, self.ps.e, self.ps.omega, self.ps.chi, self.ps.n)])])
+
+        rvs = rv.kp.rv_model_samples(self.ts, samples(self.ps.K), samples(self.ps.e), samples(self.ps.omega),
+                                     samples(self.ps.chi), samples(self.ps.n), 4)
+
+        self.assertTrue(np.allclose(rvs, expected, rtol=0.0, atol=1e-12))
+
+    def test_ensemble(self):
+        rvs = rv.rv_model_ensemble(self.ts, self.ps, nthreads=4)
+
+        self.assertEqual(rvs.shape, (3, 4, self.ts.shape[0]))
+        self.assertTrue(np.allclose(np.reshape(rvs, (-1, self.ts.shape[0])), self.expected(), rtol=0.0, atol=1e-6))
+
+if __name__ == '__main__':
+    unittest.main()